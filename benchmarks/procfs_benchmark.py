@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmarks process tree crawling with the procfs reader against `psutil`.
+
+A chain of nested processes is forked for each of the requested depths, and the
+tree of the deepest one is crawled repeatedly with both implementations, with and
+without the ancestry cache (with the cache only the leaf process is fully inspected).
+Since the whole tree is crawled, the chain is as deep as requested plus the
+ancestors of the benchmark itself.
+
+Run from the repository root with `PYTHONPATH=. python3 benchmarks/procfs_benchmark.py`.
+"""
+import argparse
+import os
+import signal
+import timeit
+from typing import List
+from typing import Tuple
+
+import psutil
+
+from pidtree_bcc.utils import crawl_process_tree
+from pidtree_bcc.utils import ProcessInfoCache
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Process tree crawling benchmark')
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 10, 50, 200], help='Process tree depths')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timing repetitions, the best is reported')
+    parser.add_argument('--number', type=int, default=200, help='Number of crawls in each repetition')
+    return parser.parse_args()
+
+
+def psutil_crawl_process_tree(pid: int, cache: ProcessInfoCache) -> List[dict]:
+    """ Reference implementation with `psutil`, as used before the procfs reader """
+    result = []
+    while pid != 0:
+        proc = psutil.Process(pid)
+        key = (proc.pid, proc.create_time())
+        cached = cache.get(key) if result else None
+        if cached is None:
+            info = {
+                'pid': proc.pid,
+                'cmdline': ' '.join(proc.cmdline()),
+                'username': proc.username(),
+            }
+            ppid = proc.ppid()
+            cache.put(key, info, ppid)
+        else:
+            info, ppid = cached
+        result.append(dict(info))
+        pid = ppid
+    return result
+
+
+def spawn_chain(depth: int) -> Tuple[int, int]:
+    """ Fork a chain of nested processes, each waiting for its child
+
+    :param int depth: number of processes in the chain
+    :return: PIDs of the first and of the deepest process
+    """
+    read_fd, write_fd = os.pipe()
+    first = os.fork()
+    if first == 0:
+        os.close(read_fd)
+        for _ in range(depth - 1):
+            child = os.fork()
+            if child:
+                os.waitpid(child, 0)
+                os._exit(0)
+        os.write(write_fd, '{}\n'.format(os.getpid()).encode())
+        signal.pause()
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        return first, int(f.readline())
+
+
+def main(args: argparse.Namespace):
+    implementations = (('procfs', crawl_process_tree), ('psutil', psutil_crawl_process_tree))
+    print('{:>6} {:>7} {:>14} {:>14} {:>8}'.format('depth', 'cache', 'procfs (us)', 'psutil (us)', 'speedup'))
+    for depth in args.depths:
+        first, leaf = spawn_chain(depth)
+        try:
+            tree_depth = len(crawl_process_tree(leaf, ProcessInfoCache(max_size=0)))
+            results = {}
+            for cached in (False, True):
+                for name, crawl in implementations:
+                    cache = ProcessInfoCache(max_size=4096 if cached else 0)
+                    assert len(crawl(leaf, cache)) == tree_depth
+                    timer = timeit.Timer(lambda: crawl(leaf, cache))
+                    results[name] = min(timer.repeat(args.repeat, args.number)) / args.number * 1e6
+                print('{:>6} {:>7} {:>14.1f} {:>14.1f} {:>7.1f}x'.format(
+                    tree_depth,
+                    'yes' if cached else 'no',
+                    results['procfs'],
+                    results['psutil'],
+                    results['psutil'] / results['procfs'],
+                ))
+        finally:
+            # killing the leaf makes all the chain exit in cascade
+            os.kill(leaf, signal.SIGTERM)
+            os.waitpid(first, 0)
+
+
+if __name__ == '__main__':
+    main(parse_args())
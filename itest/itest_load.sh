@@ -0,0 +1,69 @@
+#!/bin/bash -e
+# Load test: generates network events at the configured rates and reports
+# how many of them were captured by pidtree-bcc, together with lost events,
+# resource usage and end-to-end latency of each probe.
+
+export CONTAINER_NAME=pidtree-load-itest-$$
+export FIFONAME=itest/itest-load-$$
+export RESULTS_DIR=${LOAD_RESULTS_DIR:-itest/tmp/load-$$}
+LOAD_ADDRESS=${LOAD_ADDRESS:-127.1.33.7}
+LOAD_DURATION=${LOAD_DURATION:-30}
+LOAD_CONNECT_RATE=${LOAD_CONNECT_RATE:-100}
+LOAD_LISTEN_RATE=${LOAD_LISTEN_RATE:-10}
+LOAD_BIND_RATE=${LOAD_BIND_RATE:-10}
+LOAD_UDP_RATE=${LOAD_UDP_RATE:-100}
+LOAD_EXTRA_ARGS=${LOAD_EXTRA_ARGS:-}
+# The container takes a while to bootstrap so we have to wait before generating load
+SPIN_UP_TIME=10
+# Time allowed for events to be flushed after the load stops
+GRACE_TIME=10
+
+function cleanup {
+    set +e
+    [ -n "$COLLECTOR_PID" ] && kill $COLLECTOR_PID
+    docker kill $CONTAINER_NAME
+    rm -f $FIFONAME
+}
+
+trap cleanup INT EXIT
+
+mkdir -p $RESULTS_DIR
+mkfifo $FIFONAME
+python3 itest/load_report.py config $LOAD_ADDRESS itest/load_config.yml $RESULTS_DIR/config.yml
+
+if [ -f /etc/lsb-release ]; then
+    source /etc/lsb-release
+else
+    echo "WARNING: Could not source /etc/lsb-release, tentatively creating bionic docker image"
+    DISTRIB_CODENAME=bionic
+fi
+docker build -t pidtree-itest-base --build-arg OS_RELEASE=$DISTRIB_CODENAME .
+docker build -t pidtree-itest itest
+echo "Creating background pidtree-bcc container to catch traffic"
+docker run --name $CONTAINER_NAME --rm -d \
+    --privileged --cap-add sys_admin --pid host \
+    -v $(realpath $RESULTS_DIR/config.yml):/work/config.yml \
+    -v $(git rev-parse --show-toplevel)/$FIFONAME:/work/output \
+    pidtree-itest -c /work/config.yml -f /work/output \
+    --timestamp-format epoch_ns --lost-event-telemetry 100 --dropped-event-telemetry 5 $LOAD_EXTRA_ARGS
+
+python3 itest/load_report.py collect $FIFONAME $RESULTS_DIR/output.txt $RESULTS_DIR/resources.json &
+COLLECTOR_PID=$!
+sleep $SPIN_UP_TIME
+
+echo "Generating load for ${LOAD_DURATION}s"
+python3 itest/load_generator.py \
+    --address $LOAD_ADDRESS \
+    --duration $LOAD_DURATION \
+    --connect-rate $LOAD_CONNECT_RATE \
+    --listen-rate $LOAD_LISTEN_RATE \
+    --bind-rate $LOAD_BIND_RATE \
+    --udp-rate $LOAD_UDP_RATE \
+    > $RESULTS_DIR/summary.json
+sleep $GRACE_TIME
+
+kill $COLLECTOR_PID
+wait $COLLECTOR_PID || true
+COLLECTOR_PID=
+python3 itest/load_report.py report $RESULTS_DIR/output.txt $RESULTS_DIR/resources.json $RESULTS_DIR/summary.json
+echo "Raw results available in $RESULTS_DIR"
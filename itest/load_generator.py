@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Generates network events at configurable rates for load testing pidtree-bcc:
+- TCP connections towards a local listener (tcp_connect);
+- TCP listen calls (net_listen);
+- UDP bind calls (net_listen, with `udp` protocol enabled);
+- UDP sessions made of a single datagram towards a local receiver (udp_session).
+
+At the end a JSON summary with the number of generated events per probe is written to stdout.
+"""
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+from typing import Callable
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='pidtree-bcc load generator')
+    parser.add_argument('--address', default='127.1.33.7', help='Address to generate traffic on (loopback or veth)')
+    parser.add_argument('--duration', type=float, default=30, help='Load duration in seconds')
+    parser.add_argument('--connect-rate', type=float, default=100, help='TCP connections per second')
+    parser.add_argument('--listen-rate', type=float, default=10, help='TCP listen calls per second')
+    parser.add_argument('--bind-rate', type=float, default=10, help='UDP bind calls per second')
+    parser.add_argument('--udp-rate', type=float, default=100, help='UDP sessions per second')
+    parser.add_argument('--connect-port', type=int, default=31337)
+    parser.add_argument('--listen-port', type=int, default=31338)
+    parser.add_argument('--bind-port', type=int, default=31339)
+    parser.add_argument('--udp-port', type=int, default=31340)
+    return parser.parse_args()
+
+
+def paced(rate: float, duration: float, action: Callable[[], bool]) -> int:
+    """ Invoke action at a constant rate
+
+    :param float rate: invocations per second
+    :param float duration: seconds to run for
+    :param Callable[[], bool] action: function to invoke, returning whether the event was generated
+    :return: number of generated events
+    """
+    if rate <= 0:
+        return 0
+    count = 0
+    start = time.monotonic()
+    scheduled = 0
+    while True:
+        next_time = start + scheduled / rate
+        if next_time - start >= duration:
+            return count
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        scheduled += 1
+        try:
+            count += 1 if action() else 0
+        except OSError as e:
+            sys.stderr.write('Error generating event: {}\n'.format(e))
+
+
+def tcp_server(address: str, port: int, stop: threading.Event):
+    """ Accept and immediately close TCP connections """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((address, port))
+    server.listen(1024)
+    server.settimeout(0.5)
+    while not stop.is_set():
+        try:
+            conn, _ = server.accept()
+            conn.close()
+        except socket.timeout:
+            continue
+    server.close()
+
+
+def udp_server(address: str, port: int, stop: threading.Event):
+    """ Receive and discard UDP datagrams """
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind((address, port))
+    server.settimeout(0.5)
+    while not stop.is_set():
+        try:
+            server.recv(65536)
+        except socket.timeout:
+            continue
+    server.close()
+
+
+def main(args: argparse.Namespace):
+    stop = threading.Event()
+    servers = [
+        threading.Thread(target=tcp_server, args=(args.address, args.connect_port, stop), daemon=True),
+        threading.Thread(target=udp_server, args=(args.address, args.udp_port, stop), daemon=True),
+    ]
+    for server in servers:
+        server.start()
+    time.sleep(1)
+
+    def connect() -> bool:
+        with socket.create_connection((args.address, args.connect_port), timeout=1):
+            return True
+
+    def listen() -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((args.address, args.listen_port))
+            sock.listen(1)
+            return True
+
+    def bind() -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((args.address, args.bind_port))
+            return True
+
+    def udp_send() -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b'pidtree-bcc load test', (args.address, args.udp_port))
+            return True
+
+    results = {}
+    generators = [
+        ('connect', args.connect_rate, connect),
+        ('listen', args.listen_rate, listen),
+        ('bind', args.bind_rate, bind),
+        ('udp_send', args.udp_rate, udp_send),
+    ]
+
+    def run_generator(name: str, rate: float, action: Callable[[], bool]):
+        results[name] = paced(rate, args.duration, action)
+
+    start = time.time()
+    threads = [threading.Thread(target=run_generator, args=generator) for generator in generators]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    end = time.time()
+    stop.set()
+    json.dump(
+        {
+            'start': start,
+            'end': end,
+            'generated': results,
+            'expected': {
+                'tcp_connect': results['connect'],
+                'net_listen': results['listen'] + results['bind'],
+                'udp_session': results['udp_send'],
+            },
+            'ports': {
+                'tcp_connect': [args.connect_port],
+                'net_listen': [args.listen_port, args.bind_port],
+                'udp_session': [args.udp_port],
+            },
+        },
+        sys.stdout,
+    )
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Load test reporting for pidtree-bcc.
+
+`config` writes the pidtree-bcc configuration for the test, completing the probe
+sections of `load_config.yml` with subnet filters excluding all the traffic not
+directed to the load address, so that any local address (e.g. a veth) can be used.
+
+`collect` reads pidtree-bcc output (e.g. from a FIFO), annotating each line with its
+arrival time, and samples CPU and memory usage of pidtree-bcc processes until terminated.
+
+`report` compares the captured events with the load generator summary, and prints
+capture ratio, lost events, resource usage and end-to-end latency for each probe.
+Latency is computed as the difference between arrival time and event timestamp, so
+pidtree-bcc must be run with `--timestamp-format epoch_ns`.
+"""
+import argparse
+import ipaddress
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Dict
+from typing import List
+
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='pidtree-bcc load test reporting')
+    subparsers = parser.add_subparsers(dest='command')
+    config = subparsers.add_parser('config', help='Write pidtree-bcc configuration for the load address')
+    config.add_argument('address', help='Address the load is generated against')
+    config.add_argument('template', help='Probe configuration, referencing the `net_filters` anchor')
+    config.add_argument('config', help='Where to write the configuration')
+    collect = subparsers.add_parser('collect', help='Collect pidtree-bcc output and resource usage')
+    collect.add_argument('output', help='pidtree-bcc output file or FIFO')
+    collect.add_argument('annotated', help='Where to write output lines annotated with arrival time')
+    collect.add_argument('resources', help='Where to write resource usage of pidtree-bcc processes')
+    collect.add_argument('--process-pattern', default='pidtree', help='Match processes with this in their cmdline')
+    report = subparsers.add_parser('report', help='Report load test results')
+    report.add_argument('annotated', help='Annotated output written by `collect`')
+    report.add_argument('resources', help='Resource usage written by `collect`')
+    report.add_argument('summary', help='Load generator summary')
+    args = parser.parse_args()
+    if not args.command:
+        parser.error('a command is required')
+    return args
+
+
+def write_config(args: argparse.Namespace):
+    target = ipaddress.ip_network('{}/32'.format(args.address))
+    with open(args.config, 'w') as f:
+        f.write('---\n_net_filters: &net_filters\n')
+        for network in sorted(ipaddress.ip_network('0.0.0.0/0').address_exclude(target)):
+            f.write('  - subnet_name: {}\n'.format(str(network).replace('.', '_').replace('/', '__')))
+            f.write('    network: {}\n'.format(network.network_address))
+            f.write('    network_mask: {}\n'.format(network.netmask))
+            f.write('    description: "Not the load address"\n')
+        with open(args.template) as template:
+            f.write(template.read())
+
+
+def read_process_stats(pid: str) -> dict:
+    """ Read CPU time (seconds) and RSS (bytes) of a process """
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return {
+        'cpu': (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+        'rss': int(fields[21]) * PAGE_SIZE,
+    }
+
+
+def sample_processes(pattern: str, stats: Dict[str, dict], stop: threading.Event):
+    """ Periodically sample resource usage of matching processes """
+    own_pid = str(os.getpid())
+    while not stop.is_set():
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit() or pid == own_pid:
+                continue
+            try:
+                with open('/proc/{}/cmdline'.format(pid), 'rb') as f:
+                    cmdline = f.read().replace(b'\0', b' ').decode(errors='replace').strip()
+                if pattern not in cmdline:
+                    continue
+                sample = read_process_stats(pid)
+            except OSError:
+                continue
+            entry = stats.setdefault(pid, {'cmdline': cmdline, 'samples': []})
+            entry['samples'].append((time.time(), sample['cpu'], sample['rss']))
+        stop.wait(1)
+
+
+def collect(args: argparse.Namespace):
+    stats = {}  # type: Dict[str, dict]
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_processes, args=(args.process_pattern, stats, stop), daemon=True)
+    sampler.start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        with open(args.output) as fin, open(args.annotated, 'w') as fout:
+            for line in fin:
+                fout.write('{} {}'.format(time.time_ns(), line))
+    finally:
+        stop.set()
+        sampler.join()
+        with open(args.resources, 'w') as f:
+            json.dump(stats, f)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """ Nearest-rank percentile """
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def event_ports(event: dict) -> List[int]:
+    """ Get destination or listening ports of an event """
+    if 'destinations' in event:
+        return [dest['port'] for dest in event['destinations']]
+    return [event['port']] if 'port' in event else []
+
+
+def report(args: argparse.Namespace):
+    with open(args.summary) as f:
+        summary = json.load(f)
+    with open(args.resources) as f:
+        resources = json.load(f)
+    captured = defaultdict(int)
+    latencies = defaultdict(list)
+    lost = defaultdict(int)
+    dropped = defaultdict(int)
+    port_probes = {port: probe for probe, ports in summary['ports'].items() for port in ports}
+    with open(args.annotated) as f:
+        for annotated_line in f:
+            arrival, line = annotated_line.split(' ', 1)
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            probe = event.get('probe')
+            if event.get('type') == 'lost_event_telemetry':
+                lost[probe] = max(lost[probe], event['count'])
+            elif event.get('type') == 'dropped_event_telemetry':
+                dropped[probe] = max(dropped[probe], event['count'])
+            elif any(port_probes.get(port) == probe for port in event_ports(event)):
+                captured[probe] += 1
+                if isinstance(event.get('timestamp'), int):
+                    latencies[probe].append((int(arrival) - event['timestamp']) / 1e6)
+    duration = summary['end'] - summary['start']
+    print('Load duration: {:.1f}s'.format(duration))
+    print('{:<12} {:>10} {:>10} {:>8} {:>8} {:>8} {:>12} {:>12}'.format(
+        'probe', 'generated', 'captured', 'ratio', 'lost', 'dropped', 'p50 (ms)', 'p99 (ms)',
+    ))
+    for probe, expected in sorted(summary['expected'].items()):
+        print('{:<12} {:>10} {:>10} {:>8.3f} {:>8} {:>8} {:>12.2f} {:>12.2f}'.format(
+            probe,
+            expected,
+            captured[probe],
+            captured[probe] / expected if expected else float('nan'),
+            lost[probe],
+            dropped[probe],
+            percentile(latencies[probe], 50),
+            percentile(latencies[probe], 99),
+        ))
+    print()
+    print('{:>8} {:>10} {:>12} {}'.format('pid', 'cpu (%)', 'max rss (MB)', 'cmdline'))
+    for pid, entry in sorted(resources.items(), key=lambda item: int(item[0])):
+        # only consider samples taken while load was being generated
+        samples = [sample for sample in entry['samples'] if summary['start'] <= sample[0] <= summary['end']]
+        if len(samples) < 2:
+            continue
+        print('{:>8} {:>10.1f} {:>12.1f} {}'.format(
+            pid,
+            100 * (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0]),
+            max(sample[2] for sample in samples) / 2 ** 20,
+            entry['cmdline'][:80],
+        ))
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.command == 'config':
+        write_config(arguments)
+    elif arguments.command == 'collect':
+        collect(arguments)
+    else:
+        report(arguments)
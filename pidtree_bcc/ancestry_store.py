@@ -0,0 +1,196 @@
+import json
+import mmap
+import multiprocessing
+import struct
+import time
+from collections import OrderedDict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+# sequence number, PID, process start time, parent PID, storage time (monotonic), payload length
+SLOT_HEADER = struct.Struct('=QIdIdH')
+SEQUENCE = struct.Struct('=Q')
+
+
+class SharedAncestryStore:
+    """ Process information cache shared among probe processes.
+
+    Entries live in an anonymous shared memory mapping, created before probe
+    processes are forked, divided in fixed-size slots. A (PID, start time) key
+    hashes to a bucket, and the entry is stored in one of the `PROBE_WINDOW`
+    slots following it. When all those slots are taken by valid entries, the
+    least recently stored one is evicted. Entries expire after `ttl` seconds,
+    and the ones not fitting in a slot are not stored at all.
+
+    Writers are serialized by a lock, which is never waited on: if another
+    process is writing, publishing the entry is just skipped. Readers do not
+    lock: each slot carries a sequence number which writers make odd while
+    updating it, and a read is only valid if the sequence number is even and
+    did not change while copying the slot (seqlock).
+
+    Implements the same `get` and `put` methods of `utils.ProcessInfoCache`.
+    """
+
+    PROBE_WINDOW = 8
+    READ_RETRIES = 3
+
+    def __init__(self, slots: int = 8192, slot_size: int = 512, ttl: float = 30):
+        """ Constructor
+
+        :param int slots: number of slots in the store
+        :param int slot_size: size in bytes of each slot, including its header
+        :param float ttl: seconds after which entries expire
+        """
+        if slot_size <= SLOT_HEADER.size:
+            raise ValueError('slot_size must be greater than {} bytes'.format(SLOT_HEADER.size))
+        self.slots = max(slots, self.PROBE_WINDOW)
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.memory = mmap.mmap(-1, self.slots * slot_size)
+        self.lock = multiprocessing.Lock()
+        # counters are local to each process
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.skipped = 0
+
+    def _bucket(self, key: Tuple[int, float]) -> int:
+        """ Get index of the first slot where to look for a key
+
+        :param Tuple[int, float] key: PID and process start time
+        :return: slot index
+        """
+        pid, create_time = key
+        return ((pid * 2654435761) ^ int(create_time * 100)) % self.slots
+
+    def _window(self, key: Tuple[int, float]) -> Iterator[int]:
+        """ Get offsets of the slots where a key may be stored
+
+        :param Tuple[int, float] key: PID and process start time
+        :return: yields slot offsets
+        """
+        start = self._bucket(key)
+        return (((start + i) % self.slots) * self.slot_size for i in range(self.PROBE_WINDOW))
+
+    def _read_slot(self, offset: int) -> Optional[bytes]:
+        """ Copy slot content consistently
+
+        :param int offset: slot offset
+        :return: slot bytes, or None if a writer kept updating it
+        """
+        for _ in range(self.READ_RETRIES):
+            sequence = SEQUENCE.unpack_from(self.memory, offset)[0]
+            if sequence & 1:
+                continue
+            data = self.memory[offset:offset + self.slot_size]
+            if SEQUENCE.unpack_from(self.memory, offset)[0] == sequence:
+                return data
+        return None
+
+    def get(self, key: Tuple[int, float]) -> Optional[Tuple[dict, int]]:
+        """ Get cached process information
+
+        :param Tuple[int, float] key: PID and process start time
+        :return: process info dictionary and parent PID, or None if missing or expired
+        """
+        pid, create_time = key
+        now = time.monotonic()
+        for offset in self._window(key):
+            data = self._read_slot(offset)
+            if data is None:
+                continue
+            _, slot_pid, slot_create_time, ppid, stored_at, length = SLOT_HEADER.unpack_from(data)
+            if slot_pid == pid and slot_create_time == create_time and now - stored_at <= self.ttl:
+                self.hits += 1
+                payload = data[SLOT_HEADER.size:SLOT_HEADER.size + length]
+                return json.loads(payload.decode()), ppid
+        self.misses += 1
+        return None
+
+    def put(self, key: Tuple[int, float], info: dict, ppid: int, stored_at: float = None):
+        """ Publish process information, evicting the least recently stored entry if needed
+
+        :param Tuple[int, float] key: PID and process start time
+        :param dict info: process info dictionary
+        :param int ppid: parent PID
+        :param float stored_at: (optional) monotonic time the information was read at, defaults to now
+        """
+        payload = json.dumps(info).encode()
+        if len(payload) > self.slot_size - SLOT_HEADER.size or not self.lock.acquire(False):
+            self.skipped += 1
+            return
+        try:
+            offset = self._select_slot(key)
+            sequence = SEQUENCE.unpack_from(self.memory, offset)[0]
+            SEQUENCE.pack_into(self.memory, offset, sequence + 1)
+            self.memory[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(payload)] = payload
+            SLOT_HEADER.pack_into(
+                self.memory, offset, sequence + 1,
+                key[0], key[1], ppid, time.monotonic() if stored_at is None else stored_at, len(payload),
+            )
+            SEQUENCE.pack_into(self.memory, offset, sequence + 2)
+        finally:
+            self.lock.release()
+
+    def stats(self) -> dict:
+        """ Cache statistics (of the calling process only)
+
+        :return: dictionary with hits, misses, evictions and skipped writes
+        """
+        return OrderedDict((
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('evictions', self.evictions),
+            ('skipped', self.skipped),
+        ))
+
+    def dump(self) -> List[dict]:
+        """ List valid entries
+
+        :return: dictionaries with PID, start time, parent PID, age (seconds) and process info of each entry
+        """
+        now = time.monotonic()
+        entries = []
+        for offset in range(0, self.slots * self.slot_size, self.slot_size):
+            data = self._read_slot(offset)
+            if data is None:
+                continue
+            _, pid, create_time, ppid, stored_at, length = SLOT_HEADER.unpack_from(data)
+            if pid == 0 or now - stored_at > self.ttl:
+                continue
+            entries.append({
+                'pid': pid,
+                'start_time': create_time,
+                'ppid': ppid,
+                'age': round(now - stored_at, 3),
+                'info': json.loads(data[SLOT_HEADER.size:SLOT_HEADER.size + length].decode()),
+            })
+        return entries
+
+    def _select_slot(self, key: Tuple[int, float]) -> int:
+        """ Find slot where to store a key. Must be called holding the write lock.
+
+        Picks, in order of preference, the slot already holding the key,
+        an empty or expired slot, or the least recently stored slot.
+
+        :param Tuple[int, float] key: PID and process start time
+        :return: slot offset
+        """
+        now = time.monotonic()
+        free = oldest = None
+        oldest_time = None
+        for offset in self._window(key):
+            _, pid, create_time, _, stored_at, _ = SLOT_HEADER.unpack_from(self.memory, offset)
+            if (pid, create_time) == key:
+                return offset
+            if pid == 0 or now - stored_at > self.ttl:
+                free = offset if free is None else free
+            elif oldest_time is None or stored_at < oldest_time:
+                oldest, oldest_time = offset, stored_at
+        if free is not None:
+            return free
+        self.evictions += 1
+        return oldest
@@ -0,0 +1,94 @@
+import mmap
+import os
+import struct
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Mapping
+
+
+MAGIC = b'PTREECKP'
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct('=8sH16sdH')  # magic, format version, boot ID, creation time, number of sections
+SECTION_HEADER = struct.Struct('=16sI')  # section name, payload size
+POINTER = struct.Struct('=Q')
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+MAX_AGE = 300  # seconds
+
+
+def get_boot_id() -> bytes:
+    """ Identifier of the current boot, as kernel addresses and PIDs are meaningless across reboots """
+    with open(BOOT_ID_PATH) as f:
+        return uuid.UUID(f.read().strip()).bytes
+
+
+def write_checkpoint(filename: str, sections: Mapping[str, bytes]):
+    """ Write checkpoint file, atomically replacing any existing one.
+
+    The file is made of a fixed size header followed by named sections, each
+    made of a fixed size header and its payload, so that it can be memory
+    mapped and sections located without parsing their content.
+
+    :param str filename: checkpoint file path
+    :param Mapping[str, bytes] sections: section payloads by name (up to 16 characters)
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION, get_boot_id(), time.time(), len(sections)))
+        for name, payload in sections.items():
+            f.write(SECTION_HEADER.pack(name.encode(), len(payload)))
+            f.write(payload)
+    os.replace(tmp_filename, filename)
+
+
+def read_checkpoint(filename: str, max_age: float = MAX_AGE) -> Dict[str, bytes]:
+    """ Read checkpoint file, checking that it was written during the current boot and is recent enough
+
+    :param str filename: checkpoint file path
+    :param float max_age: max age of the checkpoint in seconds
+    :return: section payloads by name
+    :raise ValueError: if the checkpoint is malformed, too old or from a different boot
+    """
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if len(data) < FILE_HEADER.size:
+            raise ValueError('Truncated checkpoint')
+        magic, version, boot_id, created, section_count = FILE_HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('Not a checkpoint file, or unsupported format version')
+        if boot_id != get_boot_id():
+            raise ValueError('Checkpoint was written before the last reboot')
+        if time.time() - created > max_age:
+            raise ValueError('Checkpoint is older than {} seconds'.format(max_age))
+        sections = OrderedDict()
+        offset = FILE_HEADER.size
+        for _ in range(section_count):
+            if offset + SECTION_HEADER.size > len(data):
+                raise ValueError('Truncated checkpoint')
+            name, size = SECTION_HEADER.unpack_from(data, offset)
+            offset += SECTION_HEADER.size
+            if offset + size > len(data):
+                raise ValueError('Truncated checkpoint')
+            sections[name.rstrip(b'\0').decode()] = data[offset:offset + size]
+            offset += size
+    return sections
+
+
+def pack_pointers(pointers: Iterable[int]) -> bytes:
+    """ Serialize kernel addresses (e.g. BPF map keys) as an array of 64 bit integers
+
+    :param Iterable[int] pointers: kernel addresses
+    :return: packed array
+    """
+    return b''.join(POINTER.pack(pointer) for pointer in pointers)
+
+
+def unpack_pointers(data: bytes) -> List[int]:
+    """ Deserialize array packed with `pack_pointers`
+
+    :param bytes data: packed array
+    :return: kernel addresses
+    """
+    return [pointer for pointer, in POINTER.iter_unpack(data)]
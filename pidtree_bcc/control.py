@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import socket
+import stat
+from collections import OrderedDict
+from itertools import count
+from multiprocessing.connection import Connection
+from threading import Lock
+from threading import Thread
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+from pidtree_bcc.utils import never_crash
+
+if TYPE_CHECKING:
+    from pidtree_bcc.probes import BPFProbe  # noqa: F401
+
+
+# command name -> (handler receiving the command arguments, description)
+CommandTable = Mapping[str, Tuple[Callable[[List[str]], Any], str]]
+
+
+class ProbeControl:
+    """ Main process side of the control channels of probe processes.
+
+    Each probe gets a pipe, created before probe processes are forked, which is
+    served by a sidecar thread in the probe process (see `BPFProbe.handle_control`).
+    Requests carry a sequence number, so that late replies to timed out requests
+    are recognized and discarded.
+    """
+
+    TIMEOUT = 5  # seconds
+
+    def __init__(self, probes: Mapping[str, 'BPFProbe']):
+        """ Constructor, to be invoked before probe processes are forked
+
+        :param Mapping[str, BPFProbe] probes: loaded probes by name
+        """
+        self.commands = {name: probe.CONTROL_COMMANDS for name, probe in probes.items()}
+        self.connections = {name: probe.enable_control() for name, probe in probes.items()}
+        self.sequence = count()
+        self.lock = Lock()
+
+    def request(self, command: str, args: List[str]) -> Dict[str, Any]:
+        """ Send command to the probes supporting it
+
+        :param str command: command name
+        :param List[str] args: command arguments, the first one can be a probe name to only target that probe
+        :return: results by probe name
+        """
+        targets = [name for name, commands in self.commands.items() if command in commands]
+        if args and args[0] in self.commands:
+            if args[0] not in targets:
+                raise ValueError('Probe {} does not support {}'.format(args[0], command))
+            targets, args = [args[0]], args[1:]
+        if not targets:
+            raise ValueError('No probe supports {}'.format(command))
+        with self.lock:
+            return OrderedDict((name, self._request_probe(name, command, args)) for name in targets)
+
+    def _request_probe(self, name: str, command: str, args: List[str]) -> Any:
+        """ Send command to a probe and wait for its reply
+
+        :param str name: probe name
+        :param str command: command name
+        :param List[str] args: command arguments
+        :return: command result, or dictionary with error message
+        """
+        connection = self.connections[name]
+        request_id = next(self.sequence)
+        try:
+            connection.send((request_id, command, args))
+            while connection.poll(self.TIMEOUT):
+                reply_id, reply = connection.recv()
+                if reply_id == request_id:
+                    return reply
+        except (OSError, EOFError) as e:
+            return {'error': 'Probe not reachable: {}'.format(e)}
+        return {'error': 'Probe did not reply within {} seconds'.format(self.TIMEOUT)}
+
+
+def serve_probe_control(connection: Connection, handler: Callable[[str, List[str]], Any]):
+    """ Probe process side of the control channel: handle requests until the channel is closed
+
+    :param Connection connection: control pipe end
+    :param Callable[[str, List[str]], Any] handler: function executing a command with its arguments
+    """
+    while True:
+        try:
+            request_id, command, args = connection.recv()
+        except EOFError:
+            return
+        try:
+            reply = {'result': handler(command, args)}
+        except Exception as e:
+            reply = {'error': str(e)}
+        connection.send((request_id, reply))
+
+
+class ControlServer:
+    """ Serves commands on a UNIX domain socket from a thread of the main process.
+
+    The protocol is line based: each request is a command name followed by its
+    space-separated arguments, and each reply a JSON object on a single line,
+    with either a `result` or an `error` field. For instance:
+
+        $ echo stats | socat - UNIX-CONNECT:/run/pidtree-bcc.sock
+
+    Connections are served one at a time, as requests are quick and infrequent.
+    """
+
+    CONNECTION_TIMEOUT = 30  # seconds
+    MAX_REQUEST_SIZE = 4096
+
+    def __init__(self, path: str, commands: CommandTable):
+        """ Constructor
+
+        :param str path: socket path
+        :param CommandTable commands: command handlers and descriptions by name
+        """
+        self.path = path
+        self.commands = OrderedDict(commands)
+        self.commands.setdefault('help', (self._help, 'List available commands'))
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise RuntimeError('Control socket path {} exists and is not a socket'.format(path))
+            os.unlink(path)  # left over by a previous run
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0o600)
+        self.sock.listen(8)
+        self.thread = Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def handle(self, request: str) -> dict:
+        """ Execute request
+
+        :param str request: command name and arguments
+        :return: reply dictionary
+        """
+        parts = request.split()
+        if not parts:
+            return {'error': 'Empty request'}
+        command = self.commands.get(parts[0])
+        if command is None:
+            return {'error': 'Unknown command {}, use `help` to list commands'.format(parts[0])}
+        try:
+            return {'result': command[0](parts[1:])}
+        except Exception as e:
+            return {'error': str(e)}
+
+    def close(self):
+        """ Stop accepting connections and remove the socket """
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _help(self, args: List[str]) -> Dict[str, str]:
+        """ Describe available commands """
+        return OrderedDict((name, description) for name, (_, description) in self.commands.items())
+
+    @never_crash
+    def _serve(self):
+        """ Handler function for the server thread """
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                if self.sock.fileno() < 0:
+                    return  # closed
+                raise
+            with conn:
+                conn.settimeout(self.CONNECTION_TIMEOUT)
+                try:
+                    self._handle_connection(conn)
+                except (OSError, ValueError) as e:
+                    logging.warning('Error serving control connection: {}'.format(e))
+
+    def _handle_connection(self, conn: socket.socket):
+        """ Reply to requests until the client closes the connection
+
+        :param socket.socket conn: client connection
+        """
+        with conn.makefile('r') as reader, conn.makefile('w') as writer:
+            while True:
+                request = reader.readline(self.MAX_REQUEST_SIZE)
+                if not request:
+                    return
+                writer.write(json.dumps(self.handle(request), default=str) + '\n')
+                writer.flush()
@@ -0,0 +1,337 @@
+import argparse
+import json
+import logging
+import queue
+import re
+import sqlite3
+import sys
+import time
+from threading import Thread
+from typing import List
+from typing import Tuple
+from urllib.parse import quote
+
+from pidtree_bcc.utils import event_destinations
+
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY,
+        time REAL NOT NULL,
+        probe TEXT,
+        pid INTEGER,
+        event TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS destinations (
+        event_id INTEGER NOT NULL,
+        daddr TEXT,
+        port INTEGER
+    )''',
+    'CREATE INDEX IF NOT EXISTS events_time ON events (time)',
+    'CREATE INDEX IF NOT EXISTS events_pid ON events (pid, time)',
+    'CREATE INDEX IF NOT EXISTS destinations_event ON destinations (event_id)',
+    'CREATE INDEX IF NOT EXISTS destinations_daddr ON destinations (daddr, port)',
+    'CREATE INDEX IF NOT EXISTS destinations_port ON destinations (port)',
+)
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class EventStore:
+    """ Local event store, backed by SQLite in WAL mode.
+
+    Events are inserted in batches by a background thread, each batch in a single
+    transaction, and indexed by time, PID, destination address and port. WAL mode
+    allows readers (i.e. the `query` subcommand) to run concurrently with the writer
+    without blocking it. Since events are only ever appended, row IDs follow insertion
+    time, so retention can simply delete the lowest IDs. If the writer falls behind
+    (e.g. on a slow disk), batches are dropped rather than stalling the output loop.
+    """
+
+    BATCH_SIZE = 1000  # events
+    FLUSH_INTERVAL = 1  # seconds
+    MAX_QUEUED_BATCHES = 100
+    RETENTION_CHECK_INTERVAL = 60  # seconds
+    RETENTION_CHUNK = 10000  # events deleted at a time to enforce size retention
+
+    def __init__(self, path: str, retention_seconds: int = 0, retention_bytes: int = 0):
+        """ Constructor
+
+        :param str path: database file path
+        :param int retention_seconds: delete events older than this many seconds (<= 0 to disable)
+        :param int retention_bytes: delete oldest events when the database exceeds this size (<= 0 to disable)
+        """
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self.retention_bytes = retention_bytes
+        # transactions are handled explicitly
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.pending = []  # type: List[Tuple[float, str]]
+        self.oldest_pending = None
+        self.dropped = 0
+        self.next_retention = time.monotonic()
+        self.write_queue = queue.Queue(self.MAX_QUEUED_BATCHES)
+        self.writer_thread = Thread(target=self._writer_worker, daemon=True)
+        self.writer_thread.start()
+
+    def add(self, line: str):
+        """ Queue serialized event for insertion
+
+        :param str line: JSON event
+        """
+        if self.oldest_pending is None:
+            self.oldest_pending = time.monotonic()
+        self.pending.append((time.time(), line))
+
+    def flush(self, force: bool = False):
+        """ Queue pending events for insertion if the current batch is complete
+
+        :param bool force: (optional) queue pending events regardless of the batch size
+        """
+        if self.pending and (
+            force
+            or len(self.pending) >= self.BATCH_SIZE
+            or time.monotonic() - self.oldest_pending >= self.FLUSH_INTERVAL
+        ):
+            self._queue_batch(self.pending)
+            self.pending = []
+            self.oldest_pending = None
+
+    def close(self, timeout: float = None):
+        """ Insert pending events and close the database
+
+        :param float timeout: (optional) max seconds to wait for pending insertions
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if self.pending:
+            self._queue_batch(self.pending, timeout)
+            self.pending = []
+        try:
+            self.write_queue.put(None, timeout=max(deadline - time.monotonic(), 0) if deadline else None)
+        except queue.Full:
+            return  # the writer thread is a daemon, pending batches are abandoned
+        self.writer_thread.join(max(deadline - time.monotonic(), 0) if deadline else None)
+
+    def _queue_batch(self, batch: List[Tuple[float, str]], timeout: float = 0):
+        """ Queue batch for insertion, dropping it if the writer does not free up space in time
+
+        :param List[Tuple[float, str]] batch: storage timestamps and serialized events
+        :param float timeout: (optional) max seconds to wait for space in the queue (None to wait indefinitely)
+        """
+        try:
+            if timeout == 0:
+                self.write_queue.put_nowait(batch)
+            else:
+                self.write_queue.put(batch, timeout=timeout)
+        except queue.Full:
+            self.dropped += len(batch)
+            logging.warning('Event store {} is falling behind, dropped {} events so far'.format(
+                self.path,
+                self.dropped,
+            ))
+
+    def apply_retention(self) -> int:
+        """ Delete events exceeding the time or size retention
+
+        :return: number of deleted events
+        """
+        deleted = 0
+        if self.retention_seconds > 0:
+            last_id, = self.connection.execute(
+                'SELECT max(id) FROM events WHERE time < ?',
+                (time.time() - self.retention_seconds,),
+            ).fetchone()
+            if last_id is not None:
+                deleted += self._delete_until(last_id)
+        if self.retention_bytes > 0:
+            while self.used_bytes() > self.retention_bytes:
+                row = self.connection.execute(
+                    'SELECT id FROM events ORDER BY id LIMIT 1 OFFSET ?',
+                    (self.RETENTION_CHUNK - 1,),
+                ).fetchone()
+                if row is None:
+                    row = self.connection.execute('SELECT max(id) FROM events').fetchone()
+                    if row[0] is None:
+                        break
+                deleted += self._delete_until(row[0])
+        return deleted
+
+    def used_bytes(self) -> int:
+        """ Size of the database pages in use (freed pages are reused by later inserts) """
+        page_size, = self.connection.execute('PRAGMA page_size').fetchone()
+        page_count, = self.connection.execute('PRAGMA page_count').fetchone()
+        free_pages, = self.connection.execute('PRAGMA freelist_count').fetchone()
+        return (page_count - free_pages) * page_size
+
+    def _delete_until(self, last_id: int) -> int:
+        """ Delete events up to an ID (included)
+
+        :param int last_id: event ID
+        :return: number of deleted events
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN')
+        cursor.execute('DELETE FROM destinations WHERE event_id <= ?', (last_id,))
+        cursor.execute('DELETE FROM events WHERE id <= ?', (last_id,))
+        deleted = cursor.rowcount
+        cursor.execute('COMMIT')
+        return deleted
+
+    def _write_batch(self, batch: List[Tuple[float, str]]):
+        """ Insert events in a single transaction
+
+        :param List[Tuple[float, str]] batch: storage timestamps and serialized events
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN')
+        for timestamp, line in batch:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                event = None
+            if not isinstance(event, dict):
+                event = {}
+            cursor.execute(
+                'INSERT INTO events (time, probe, pid, event) VALUES (?, ?, ?, ?)',
+                (timestamp, event.get('probe'), event.get('pid'), line),
+            )
+            event_id = cursor.lastrowid
+            cursor.executemany(
+                'INSERT INTO destinations (event_id, daddr, port) VALUES (?, ?, ?)',
+                [
+                    (event_id, daddr, port)
+                    for daddr, port in event_destinations(event)
+                    if daddr is not None or port is not None
+                ],
+            )
+        cursor.execute('COMMIT')
+
+    def _writer_worker(self):
+        """ Handler function for the writer thread, also enforcing retention when due """
+        while True:
+            try:
+                batch = self.write_queue.get(timeout=self.RETENTION_CHECK_INTERVAL)
+            except queue.Empty:
+                batch = []
+            if batch is None:
+                self.connection.close()
+                return
+            try:
+                if batch:
+                    self._write_batch(batch)
+                if time.monotonic() >= self.next_retention:
+                    self.next_retention = time.monotonic() + self.RETENTION_CHECK_INTERVAL
+                    self.apply_retention()
+            except sqlite3.Error as e:
+                if self.connection.in_transaction:
+                    self.connection.execute('ROLLBACK')
+                logging.error('Error writing to event store {}: {}'.format(self.path, e))
+
+
+def parse_duration(duration: str) -> float:
+    """ Parse duration string
+
+    :param str duration: number of seconds, optionally with a unit suffix (s, m, h, d)
+    :return: duration in seconds
+    """
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhd]?)$', duration.strip())
+    if not match:
+        raise ValueError('Invalid duration: {}'.format(duration))
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
+def query_events(
+    path: str,
+    since: float = None,
+    until: float = None,
+    daddr: str = None,
+    port: int = None,
+    pid: int = None,
+    probe: str = None,
+    limit: int = 1000,
+) -> List[str]:
+    """ Look up events in the store, opened in read-only mode
+
+    :param str path: database file path
+    :param float since: (optional) only events stored after this UNIX timestamp
+    :param float until: (optional) only events stored before this UNIX timestamp
+    :param str daddr: (optional) destination (or listening) address
+    :param int port: (optional) destination (or listening) port
+    :param int pid: (optional) process ID
+    :param str probe: (optional) probe name
+    :param int limit: (optional) max number of events, the most recent are returned
+    :return: serialized events, in chronological order
+    """
+    conditions = []
+    params = []
+    for column, value in (
+        ('e.time >= ?', since),
+        ('e.time <= ?', until),
+        ('d.daddr = ?', daddr),
+        ('d.port = ?', port),
+        ('e.pid = ?', pid),
+        ('e.probe = ?', probe),
+    ):
+        if value is not None:
+            conditions.append(column)
+            params.append(value)
+    query = 'SELECT DISTINCT e.id, e.event FROM events e'
+    if daddr is not None or port is not None:
+        query += ' JOIN destinations d ON d.event_id = e.id'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY e.id DESC LIMIT ?'
+    params.append(limit)
+    connection = sqlite3.connect('file:{}?mode=ro'.format(quote(path)), uri=True)
+    try:
+        rows = connection.execute(query, params).fetchall()
+    finally:
+        connection.close()
+    return [event for _, event in reversed(rows)]
+
+
+def query_main(argv: List[str]):
+    """ Entrypoint of the `query` subcommand
+
+    :param List[str] argv: command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        'pidtree-bcc query',
+        description='Look up events in a pidtree-bcc event store',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('store', type=str, help='Event store path (see --event-store)')
+    parser.add_argument(
+        '--since', type=parse_duration, metavar='DURATION',
+        help='Only events stored in the last DURATION (seconds, or with unit suffix s, m, h or d)',
+    )
+    parser.add_argument(
+        '--until', type=parse_duration, metavar='DURATION',
+        help='Only events stored until DURATION ago (seconds, or with unit suffix s, m, h or d)',
+    )
+    parser.add_argument('--daddr', type=str, help='Destination address (listening address for net_listen)')
+    parser.add_argument('--port', type=int, help='Destination port (listening port for net_listen)')
+    parser.add_argument('--pid', type=int, help='Process ID')
+    parser.add_argument('--probe', type=str, help='Probe name')
+    parser.add_argument('--limit', type=int, default=1000, help='Max number of events, the most recent are returned')
+    args = parser.parse_args(argv)
+    now = time.time()
+    try:
+        events = query_events(
+            args.store,
+            since=now - args.since if args.since is not None else None,
+            until=now - args.until if args.until is not None else None,
+            daddr=args.daddr,
+            port=args.port,
+            pid=args.pid,
+            probe=args.probe,
+            limit=args.limit,
+        )
+    except sqlite3.Error as e:
+        sys.stderr.write('Error querying {}: {}\n'.format(args.store, e))
+        sys.exit(1)
+    for event in events:
+        print(event)
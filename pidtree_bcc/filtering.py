@@ -1,4 +1,6 @@
 from collections import namedtuple
+from typing import Any
+from typing import Dict
 from typing import List
 from typing import Union
 
@@ -47,3 +49,112 @@ class NetFilter:
             ):
                 return True
         return False
+
+
+class ProcessFilter:
+    """ Allow and deny lists of processes, enforced in kernel via BPF maps.
+
+    Processes can be matched by command name, user ID, cgroup ID and inode of
+    their executable. An event is filtered if its process matches any deny
+    rule, or if an allow list is set for a criterion and the process does not
+    match any of its entries. Since rules are stored in BPF maps, they can be
+    updated without recompiling the BPF program.
+    """
+
+    # Order matters: it is used to index `process_filter_allow` in BPF code
+    CRITERIA = ('comm', 'uid', 'cgroup_id', 'exe_inode')
+    # Criteria always compiled in BPF code, the others only if present in the initial config
+    DEFAULT_CRITERIA = ('comm', 'uid')
+    MAP_NAMES = {
+        'comm': 'process_filter_comm',
+        'uid': 'process_filter_uid',
+        'cgroup_id': 'process_filter_cgroup',
+        'exe_inode': 'process_filter_inode',
+    }
+    DENY = 1
+    ALLOW = 2
+    COMM_MAX_LENGTH = 15  # TASK_COMM_LEN without null terminator
+
+    def __init__(self, config: dict):
+        """ Constructor
+
+        :param dict config: allow and deny lists. Format:
+                            {
+                                'exclude': {'comm': ['consul'], 'uid': [65534]},
+                                'include': {'cgroup_id': [1234], 'exe_inode': [5678]},
+                            }
+        """
+        unknown = set(config) - {'include', 'exclude'}
+        if unknown:
+            raise ValueError('Unknown process filter sections: {}'.format(', '.join(sorted(unknown))))
+        self.rules = {criterion: {} for criterion in self.CRITERIA}  # type: Dict[str, Dict[Any, int]]
+        self.criteria = set(self.DEFAULT_CRITERIA)
+        for section, action in (('exclude', self.DENY), ('include', self.ALLOW)):
+            for criterion, values in (config.get(section) or {}).items():
+                if criterion not in self.CRITERIA:
+                    raise ValueError('Unknown process filter criterion: {}'.format(criterion))
+                self.criteria.add(criterion)
+                for value in values or []:
+                    value = self._normalize(criterion, value)
+                    if self.rules[criterion].get(value, action) != action:
+                        raise ValueError('{} {} is both included and excluded'.format(criterion, value))
+                    self.rules[criterion][value] = action
+
+    def _normalize(self, criterion: str, value: Union[int, str]) -> Union[int, bytes]:
+        """ Convert rule value to the representation used as BPF map key
+
+        :param str criterion: filter criterion
+        :param Union[int, str] value: rule value
+        :return: normalized value
+        """
+        if criterion == 'comm':
+            return str(value).encode()[:self.COMM_MAX_LENGTH]
+        return int(value)
+
+    def has_allow_list(self, criterion: str) -> bool:
+        """ Check if an allow list is set for a criterion
+
+        :param str criterion: filter criterion
+        :return: True if the criterion has any allow rule
+        """
+        return self.ALLOW in self.rules[criterion].values()
+
+    def is_filtered(self, comm: str, uid: int, cgroup_id: int = None, exe_inode: int = None) -> bool:
+        """ Check if a process is filtered, mirroring the BPF implementation
+
+        :param str comm: process command name
+        :param int uid: user ID
+        :param int cgroup_id: (optional) cgroup ID
+        :param int exe_inode: (optional) inode of the process executable
+        :return: True if filtered
+        """
+        values = {'comm': comm, 'uid': uid, 'cgroup_id': cgroup_id, 'exe_inode': exe_inode}
+        for criterion in self.CRITERIA:
+            if criterion not in self.criteria or values[criterion] is None:
+                continue
+            action = self.rules[criterion].get(self._normalize(criterion, values[criterion]))
+            if action == self.DENY or (action is None and self.has_allow_list(criterion)):
+                return True
+        return False
+
+    def apply(self, bpf: Any, previous: 'ProcessFilter' = None):
+        """ Write rules to BPF maps.
+
+        New rules and allow list flags are written before stale rules are removed,
+        so that no event is wrongly filtered while the update is in progress.
+
+        :param Any bpf: BPF program instance
+        :param ProcessFilter previous: (optional) filter currently loaded in the maps
+        """
+        for criterion in self.CRITERIA:
+            table = bpf[self.MAP_NAMES[criterion]]
+            for value, action in self.rules[criterion].items():
+                table[table.Key(value)] = table.Leaf(action)
+        allow_table = bpf['process_filter_allow']
+        for index, criterion in enumerate(self.CRITERIA):
+            allow_table[allow_table.Key(index)] = allow_table.Leaf(int(self.has_allow_list(criterion)))
+        if previous:
+            for criterion in self.CRITERIA:
+                table = bpf[self.MAP_NAMES[criterion]]
+                for value in set(previous.rules[criterion]) - set(self.rules[criterion]):
+                    del table[table.Key(value)]
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import time
+from typing import Dict
+from typing import List
+from typing import Set
+
+
+def truncate_cmdlines(proctree: List[dict], max_length: int):
+    """ Truncate command lines in process tree (in place)
+
+    :param List[dict] proctree: process tree
+    :param int max_length: max command line length
+    """
+    for proc in proctree:
+        cmdline = proc.get('cmdline')
+        if cmdline and len(cmdline) > max_length:
+            proc['cmdline'] = cmdline[:max_length]
+
+
+class ProcessInterner:
+    """ Replaces process tree entries in events with compact references.
+
+    Each process is identified by a digest of its information, so that its
+    identifier changes whenever the information (e.g. the command line after
+    an `exec`) changes. The first time an identifier is seen, a `process`
+    record with the full information is emitted before the event referencing
+    it. The set of emitted identifiers is reset periodically, so that records
+    are re-emitted and consumers can start reading mid-stream.
+    """
+
+    MAX_SEEN = 100000
+
+    def __init__(self, refresh_interval: float, cmdline_max_length: int = 0):
+        """ Constructor
+
+        :param float refresh_interval: seconds after which process records are emitted again
+        :param int cmdline_max_length: (optional) if > 0, truncate command lines to this length
+        """
+        self.refresh_interval = refresh_interval
+        self.cmdline_max_length = cmdline_max_length
+        self.seen = set()  # type: Set[str]
+        # memoized identifiers, to avoid hashing the same process information over and over
+        self.ids = {}  # type: Dict[tuple, str]
+        self.next_refresh = time.monotonic() + refresh_interval
+
+    @staticmethod
+    def process_id(proc: dict) -> str:
+        """ Compute compact process identifier
+
+        :param dict proc: process information
+        :return: identifier string
+        """
+        digest = hashlib.sha1(json.dumps(proc, sort_keys=True).encode()).hexdigest()
+        return '{}-{}'.format(proc.get('pid'), digest[:8])
+
+    def intern(self, event: dict) -> List[dict]:
+        """ Replace process tree in event with process identifiers (in place)
+
+        :param dict event: event dictionary
+        :return: process records to be emitted before the event
+        """
+        proctree = event.get('proctree')
+        if not proctree:
+            return []
+        now = time.monotonic()
+        if now >= self.next_refresh or len(self.ids) >= self.MAX_SEEN:
+            self.seen = set()
+            self.ids = {}
+            self.next_refresh = now + self.refresh_interval
+        if self.cmdline_max_length > 0:
+            truncate_cmdlines(proctree, self.cmdline_max_length)
+        records = []
+        references = []
+        for proc in proctree:
+            try:
+                key = tuple(proc.items())
+                proc_id = self.ids.get(key)
+                if proc_id is None:
+                    proc_id = self.ids[key] = self.process_id(proc)
+            except TypeError:
+                # unhashable values added by plugins
+                proc_id = self.process_id(proc)
+            references.append(proc_id)
+            if proc_id not in self.seen:
+                self.seen.add(proc_id)
+                records.append(dict(proc, type='process', id=proc_id))
+        event['proctree'] = references
+        return records
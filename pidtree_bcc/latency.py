@@ -0,0 +1,127 @@
+import time
+from collections import OrderedDict
+from typing import Dict
+from typing import Iterable
+from typing import Tuple
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """ HDR-style histogram of latencies in nanoseconds.
+
+    Values are grouped in buckets covering a power of two range, each split in
+    linear sub-buckets by keeping the `SUB_BUCKET_BITS` most significant bits of the
+    value. As the leading bit is always set, that makes 2^(`SUB_BUCKET_BITS` - 1)
+    sub-buckets per range, so that the relative error of the reported percentiles is
+    bounded (~3%) regardless of the magnitude of the value.
+    """
+
+    SUB_BUCKET_BITS = 6
+
+    def __init__(self):
+        self.counts = {}  # type: Dict[int, int]
+        self.count = 0
+        self.max = 0
+
+    def record(self, value: int):
+        """ Add value to the histogram
+
+        :param int value: latency in nanoseconds
+        """
+        value = max(value, 0)
+        shift = value.bit_length() - self.SUB_BUCKET_BITS
+        bucket = (value >> shift) << shift if shift > 0 else value
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile: float) -> int:
+        """ Get value at percentile
+
+        :param float percentile: percentile between 0 and 100
+        :return: lower bound of the bucket containing the percentile
+        """
+        threshold = self.count * percentile / 100
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= threshold:
+                return bucket
+        return self.max
+
+    def summary(self) -> dict:
+        """ Summarize histogram in microseconds
+
+        :return: dictionary with count, percentiles and max value
+        """
+        result = OrderedDict([('count', self.count)])
+        for percentile in PERCENTILES:
+            result['p{}_us'.format(percentile).replace('.', '_')] = self.percentile(percentile) / 1000
+        result['max_us'] = self.max / 1000
+        return result
+
+
+class LatencyTracer:
+    """ Aggregates per-stage latencies of a pipeline into histograms,
+    and decides which events should carry their individual timings.
+    """
+
+    def __init__(self, report_interval: float, sample_rate: int = 0):
+        """ Constructor
+
+        :param float report_interval: seconds between histogram reports
+        :param int sample_rate: add timings to 1 every this many events (<= 0 to disable)
+        """
+        self.report_interval = report_interval
+        self.sample_rate = sample_rate
+        self.sample_counter = 0
+        self.histograms = OrderedDict()  # type: Dict[str, LatencyHistogram]
+        self.next_report = time.monotonic() + report_interval
+
+    def record(self, stages: Iterable[Tuple[str, int]]):
+        """ Record latencies of pipeline stages
+
+        :param Iterable[Tuple[str, int]] stages: stage names and their latency in nanoseconds
+        """
+        for stage, value in stages:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.record(value)
+
+    def sample(self) -> bool:
+        """ Check if the current event should carry its individual timings
+
+        :return: True once every `sample_rate` invocations
+        """
+        if self.sample_rate <= 0:
+            return False
+        self.sample_counter += 1
+        if self.sample_counter >= self.sample_rate:
+            self.sample_counter = 0
+            return True
+        return False
+
+    def report_due(self) -> bool:
+        """ Check if it is time to report histograms """
+        return time.monotonic() >= self.next_report
+
+    def summary(self) -> Dict[str, dict]:
+        """ Summarize histograms since the last report, without resetting them
+
+        :return: histogram summaries by stage
+        """
+        return OrderedDict((stage, histogram.summary()) for stage, histogram in list(self.histograms.items()))
+
+    def report(self) -> Dict[str, dict]:
+        """ Summarize histograms and reset them
+
+        :return: histogram summaries by stage
+        """
+        self.next_report = time.monotonic() + self.report_interval
+        result = self.summary()
+        self.histograms = OrderedDict()
+        return result
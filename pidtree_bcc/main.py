@@ -1,29 +1,53 @@
 import argparse
+import json
 import logging
 import os
+import queue
 import select
 import signal
 import sys
 import time
+from collections import OrderedDict
 from functools import partial
 from multiprocessing import Process
-from multiprocessing import SimpleQueue
 from threading import Thread
 from typing import Any
 from typing import Callable
+from typing import Iterable
 from typing import List
+from typing import Mapping
 from typing import TextIO
-
-import yaml
+from typing import TYPE_CHECKING
 
 from pidtree_bcc import __version__
-from pidtree_bcc.probes import load_probes
+from pidtree_bcc.ancestry_store import SharedAncestryStore
+from pidtree_bcc.control import CommandTable
+from pidtree_bcc.control import ControlServer
+from pidtree_bcc.control import ProbeControl
+from pidtree_bcc.latency import LatencyTracer
+from pidtree_bcc.output_queue import OutputQueue
+from pidtree_bcc.profiling import SamplingProfiler
+from pidtree_bcc.recording import EventRecorder
+from pidtree_bcc.recording import monotonic_ns
+from pidtree_bcc.recording import replay_events
+from pidtree_bcc.sinks import ColumnarSink
+from pidtree_bcc.sinks import CompressedStreamSink
+from pidtree_bcc.sinks import RotatingFileSink
+from pidtree_bcc.timestamps import TIMESTAMP_FORMATS
+from pidtree_bcc.timestamps import TimestampFormatter
+from pidtree_bcc.utils import ProcessInfoCache
+from pidtree_bcc.utils import set_ancestry_cache
 from pidtree_bcc.utils import smart_open
 
+if TYPE_CHECKING:
+    from pidtree_bcc.probes import BPFProbe  # noqa: F401
+
 
 EXIT_CODE = 0
+SHUTDOWN_DEADLINE = None  # type: float
 HEALTH_CHECK_PERIOD = 60  # seconds
 HANDLED_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+PROFILING_SIGNAL = signal.SIGUSR2
 
 
 def parse_args() -> argparse.Namespace:
@@ -46,6 +70,71 @@ def parse_args() -> argparse.Namespace:
         '-f', '--output_file', type=str, default='-',
         help='File to output to (default is STDOUT, denoted by -)',
     )
+    parser.add_argument(
+        '--output-rotate-size', type=int, default=0, metavar='BYTES',
+        help='Rotate output file once it exceeds BYTES in size (requires --output_file)',
+    )
+    parser.add_argument(
+        '--output-rotate-interval', type=int, default=0, metavar='SECONDS',
+        help='Rotate output file every SECONDS (requires --output_file)',
+    )
+    parser.add_argument(
+        '--output-compression', type=str, default='none', choices=RotatingFileSink.COMPRESSIONS,
+        help='Compression applied in background to rotated output files',
+    )
+    parser.add_argument(
+        '--event-store', type=str, metavar='PATH',
+        help=(
+            'Also write events to a local SQLite database at PATH, indexed by time, PID, '
+            'destination address and port, which can be searched with `pidtree-bcc query`'
+        ),
+    )
+    parser.add_argument(
+        '--event-store-retention', type=int, default=0, metavar='SECONDS',
+        help='Delete events older than SECONDS from the event store (0 keeps them forever)',
+    )
+    parser.add_argument(
+        '--event-store-max-size', type=int, default=0, metavar='BYTES',
+        help='Delete the oldest events when the event store exceeds BYTES in size (0 for no limit)',
+    )
+    parser.add_argument(
+        '--columnar-output', type=str, metavar='DIR',
+        help='Also write events to Arrow IPC or Parquet files in DIR, in typed batches with a table per probe',
+    )
+    parser.add_argument(
+        '--columnar-format', type=str, default='parquet', choices=ColumnarSink.FORMATS,
+        help='File format of columnar output',
+    )
+    parser.add_argument(
+        '--columnar-row-group-size', type=int, default=65536, metavar='NEVENTS',
+        help='Number of events in each row group (Parquet) or record batch (Arrow IPC) of columnar output',
+    )
+    parser.add_argument(
+        '--columnar-rollover', type=int, default=3600, metavar='SECONDS',
+        help='Start new columnar output files every SECONDS',
+    )
+    parser.add_argument(
+        '--timestamp-format', type=str, default='iso', choices=TIMESTAMP_FORMATS,
+        help='Format of event timestamps: ISO 8601 UTC string or integer nanoseconds since epoch',
+    )
+    parser.add_argument(
+        '--intern-processes', type=int, default=-1, metavar='SECONDS',
+        help=(
+            'If set and greater than 0, output process information as separate `process` records, '
+            'referenced by ID in event process trees, and re-emit them every SECONDS'
+        ),
+    )
+    parser.add_argument(
+        '--cmdline-max-length', type=int, default=0, metavar='NCHARS',
+        help='If set and greater than 0, truncate process command lines to NCHARS characters',
+    )
+    parser.add_argument(
+        '--stream-compression', type=str, default='none', choices=('none',) + CompressedStreamSink.COMPRESSIONS,
+        help=(
+            'Compress the output stream (e.g. towards a FIFO or STDOUT), flushing compressed '
+            'data in batches rather than on every event'
+        ),
+    )
     parser.add_argument(
         '--lost-event-telemetry', type=int, default=-1, metavar='NEVENTS',
         help=(
@@ -53,6 +142,110 @@ def parse_args() -> argparse.Namespace:
             'of events dropped due to the kernel -> userland communication channel filling up'
         ),
     )
+    parser.add_argument(
+        '--queue-size', type=int, default=10000, metavar='NEVENTS',
+        help='Max number of events buffered between probes and output writer (<= 0 means unbounded)',
+    )
+    parser.add_argument(
+        '--queue-policy', type=str, default='block', choices=OutputQueue.POLICIES,
+        help=(
+            'What to do with events when the output queue is full: wait for free space, drop the '
+            'newest or oldest event, or drop events from probes exceeding their share of the queue '
+            'according to their `queue_priority` configuration value'
+        ),
+    )
+    parser.add_argument(
+        '--dropped-event-telemetry', type=int, default=-1, metavar='SECONDS',
+        help=(
+            'If set and greater than 0, output telemetry every SECONDS about the number '
+            'of events dropped due to the output queue filling up'
+        ),
+    )
+    parser.add_argument(
+        '--kernel-counters-telemetry', type=int, default=-1, metavar='SECONDS',
+        help=(
+            'If set and greater than 0, output telemetry every SECONDS about the number of '
+            'events entering each probe in kernel, filtered by each filter type, and submitted'
+        ),
+    )
+    parser.add_argument(
+        '--resource-telemetry', type=int, default=-1, metavar='SECONDS',
+        help=(
+            'If set and greater than 0, output telemetry every SECONDS about memory '
+            'and CPU usage of pidtree-bcc processes'
+        ),
+    )
+    parser.add_argument(
+        '--latency-tracing', type=int, default=-1, metavar='SECONDS',
+        help=(
+            'If set and greater than 0, trace the latency of each event processing stage and '
+            'output per-probe latency histograms every SECONDS'
+        ),
+    )
+    parser.add_argument(
+        '--latency-sample-rate', type=int, default=0, metavar='NEVENTS',
+        help='When latency tracing is enabled, add a `_timing` field with stage latencies to 1 every NEVENTS events',
+    )
+    parser.add_argument(
+        '--single-process', action='store_true', default=False,
+        help=(
+            'Run all probes in a single process polling events from one event loop, sharing '
+            'caches and plugin instances, rather than forking one process per probe'
+        ),
+    )
+    parser.add_argument(
+        '--shared-ancestry-cache', type=int, default=0, metavar='NSLOTS',
+        help=(
+            'If set and greater than 0, cache process ancestry information in a shared memory '
+            'store with NSLOTS slots, so that it is reused across probe processes'
+        ),
+    )
+    replay_group = parser.add_mutually_exclusive_group()
+    replay_group.add_argument(
+        '--record', type=str, metavar='FILE',
+        help='Record raw BPF events to FILE, so that they can later be replayed with --replay',
+    )
+    replay_group.add_argument(
+        '--replay', type=str, metavar='FILE',
+        help='Replay events recorded in FILE through event enrichment and output, instead of running the probes',
+    )
+    parser.add_argument(
+        '--replay-speed', type=float, default=1, metavar='FACTOR',
+        help='Replay speed relative to the recorded one (<= 0 to replay as fast as possible)',
+    )
+    parser.add_argument(
+        '--profile-dir', type=str, metavar='DIR',
+        help=(
+            'If set, sending SIGUSR2 to the main pidtree-bcc process starts a sampling profiler in '
+            'all its processes, writing collapsed stack files to DIR'
+        ),
+    )
+    parser.add_argument(
+        '--profile-duration', type=int, default=30, metavar='SECONDS',
+        help='Duration of profiling sessions started with SIGUSR2',
+    )
+    parser.add_argument(
+        '--control-socket', type=str, metavar='PATH',
+        help='Serve queries on live state and commands on a UNIX domain socket at PATH (send `help` for details)',
+    )
+    parser.add_argument(
+        '--shutdown-timeout', type=float, default=5, metavar='SECONDS',
+        help=(
+            'On termination, max seconds to wait for probes to drain their event buffers and for '
+            'queued events to be written out, after which remaining events are abandoned'
+        ),
+    )
+    parser.add_argument(
+        '--checkpoint-dir', type=str, metavar='DIR',
+        help=(
+            'If set, probes save UDP sessions, process ancestry cache and kernel tracing state to DIR '
+            'when terminated, and restore it on the next start if still valid'
+        ),
+    )
+    parser.add_argument(
+        '--startup-profile', action='store_true', default=False,
+        help='Log time spent importing modules, rendering, compiling and attaching each probe',
+    )
     parser.add_argument(
         '--extra-probe-path', type=str,
         help='Extra dot-notation package path where to look for probes to load',
@@ -68,6 +261,21 @@ def parse_args() -> argparse.Namespace:
     args = parser.parse_args()
     if args.config is not None and not os.path.exists(args.config):
         sys.stderr.write('--config file does not exist\n')
+    rotation_enabled = args.output_rotate_size > 0 or args.output_rotate_interval > 0
+    if rotation_enabled and args.output_file == '-':
+        parser.error('output rotation requires --output_file to be set')
+    if args.output_compression != 'none' and not rotation_enabled:
+        parser.error('--output-compression requires output rotation to be enabled')
+    if args.stream_compression != 'none' and rotation_enabled:
+        parser.error('--stream-compression cannot be used with output rotation, see --output-compression')
+    if (args.event_store_retention > 0 or args.event_store_max_size > 0) and not args.event_store:
+        parser.error('event store retention requires --event-store to be set')
+    if args.columnar_output and not os.path.isdir(args.columnar_output):
+        parser.error('--columnar-output must be an existing directory')
+    if args.profile_dir and not os.path.isdir(args.profile_dir):
+        parser.error('--profile-dir must be an existing directory')
+    if args.checkpoint_dir and not os.path.isdir(args.checkpoint_dir):
+        parser.error('--checkpoint-dir must be an existing directory')
     return args
 
 
@@ -79,21 +287,98 @@ def parse_config(config_file: str) -> dict:
     """
     if config_file is None:
         return {}
+    import yaml
     with open(config_file) as f:
         return yaml.safe_load(f)
 
 
-def termination_handler(probe_workers: List[Process], signum: int, frame: Any):
-    """ Generic termination signal handler
+def termination_handler(
+    probe_workers: List[Process],
+    output_queue: OutputQueue,
+    shutdown_timeout: float,
+    signum: int,
+    frame: Any,
+):
+    """ Generic termination signal handler: starts the shutdown sequence, letting the
+    main loop write out the events drained by probes until the shutdown deadline.
 
     :param List[Process] probe_workers: list of probe processes
+    :param OutputQueue output_queue: output queue
+    :param float shutdown_timeout: max seconds to wait for events to be drained and written
     :param int signum: signal integer code
     :param Any frame: signal stack frame
     """
-    logging.warning('Caught termination signal, shutting off probes and exiting')
+    global SHUTDOWN_DEADLINE
+    if SHUTDOWN_DEADLINE is not None:
+        return  # already shutting down
+    if not probe_workers:
+        logging.warning('Caught termination signal, exiting')
+        sys.exit(EXIT_CODE)
+    logging.warning('Caught termination signal, draining probes and output for up to {} seconds'.format(
+        shutdown_timeout,
+    ))
+    SHUTDOWN_DEADLINE = time.monotonic() + shutdown_timeout
+    Thread(target=shutdown_worker, args=(probe_workers, output_queue, SHUTDOWN_DEADLINE), daemon=True).start()
+
+
+def shutdown_worker(probe_workers: List[Process], output_queue: OutputQueue, deadline: float):
+    """ Handler function for the shutdown thread: stops probe processes, waiting for them
+    to drain their events until the deadline, then signals the end of the event stream.
+
+    :param List[Process] probe_workers: list of probe processes
+    :param OutputQueue output_queue: output queue
+    :param float deadline: monotonic time by which probe processes must be done
+    """
     for worker in probe_workers:
         worker.terminate()
-    sys.exit(EXIT_CODE)
+    for worker in probe_workers:
+        worker.join(max(deadline - time.monotonic(), 0))
+    stuck = [worker.name for worker in probe_workers if worker.is_alive()]
+    if stuck:
+        logging.warning('Probes did not drain their events in time: {}'.format(', '.join(stuck)))
+    kill_workers(probe_workers)
+    output_queue.put_end_of_stream()
+
+
+def kill_workers(probe_workers: List[Process]):
+    """ Forcefully terminate probe processes still running
+
+    :param List[Process] probe_workers: list of probe processes
+    """
+    for worker in probe_workers:
+        if worker.is_alive():
+            os.kill(worker.pid, signal.SIGKILL)
+
+
+def profiling_handler(
+    profile_dir: str,
+    duration: int,
+    probe_workers: List[Process],
+    main_pid: int,
+    signum: int,
+    frame: Any,
+):
+    """ Profiling signal handler: starts a profiling session in the current
+    process and, if invoked in the main process, forwards the signal to probe processes.
+
+    :param str profile_dir: directory where to write profiles
+    :param int duration: profiling session duration in seconds
+    :param List[Process] probe_workers: list of probe processes
+    :param int main_pid: PID of the main process
+    :param int signum: signal integer code
+    :param Any frame: signal stack frame
+    """
+    if not SamplingProfiler.start_session(profile_dir, duration):
+        logging.warning('Profiling session already in progress')
+        return
+    if os.getpid() == main_pid:
+        for worker in probe_workers:
+            if not worker.pid or not worker.is_alive():
+                continue
+            try:
+                os.kill(worker.pid, signum)
+            except ProcessLookupError:
+                pass  # exited in the meantime
 
 
 def deregister_signals(func: Callable):
@@ -109,6 +394,46 @@ def deregister_signals(func: Callable):
     return helper
 
 
+def stop_handler(probes: Iterable['BPFProbe'], signum: int, frame: Any):
+    """ Termination signal handler for probe processes: stops polling, so that events are drained
+
+    :param Iterable[BPFProbe] probes: probes running in the current process
+    :param int signum: signal integer code
+    :param Any frame: signal stack frame
+    """
+    for probe in probes:
+        probe.stop()
+
+
+def graceful_probe_worker(func: Callable, probes: Iterable['BPFProbe'], checkpoint: bool = False):
+    """ Wrap probe process function so that termination signals make it return after
+    draining events. Before exiting, probe state is either saved or output as final events,
+    and buffered recordings are written out.
+
+    :param Callable func: function polling the probes
+    :param Iterable[BPFProbe] probes: probes run by the function
+    :param bool checkpoint: (optional) whether to write probe checkpoints
+    :return: wrapped function
+    """
+    def helper(*args, **kwargs):
+        for s in HANDLED_SIGNALS:
+            signal.signal(s, partial(stop_handler, probes))
+        func(*args, **kwargs)
+        for probe in probes:
+            if checkpoint:
+                try:
+                    probe.write_checkpoint()
+                    continue
+                except Exception as e:
+                    logging.error('Failed to write checkpoint for {}: {}'.format(probe.probe_name, e))
+            probe.flush_pending()
+        for probe in probes:
+            if probe.RECORDER:
+                probe.RECORDER.flush()
+                break
+    return helper
+
+
 def health_watchdog(probe_workers: List[Process], output_fh: TextIO):
     """ Check that probe processes are alive and output file is writable
 
@@ -117,9 +442,13 @@ def health_watchdog(probe_workers: List[Process], output_fh: TextIO):
     """
     global EXIT_CODE
     fs_poller = select.poll()
-    fs_poller.register(output_fh, select.POLLERR)
+    if hasattr(output_fh, 'fileno'):
+        # sinks handling their own files are not monitored
+        fs_poller.register(output_fh, select.POLLERR)
     while True:
         time.sleep(HEALTH_CHECK_PERIOD)
+        if SHUTDOWN_DEADLINE is not None:
+            break  # probe processes are expected to exit
         bad_fds = fs_poller.poll(0)
         if not all(worker.is_alive() for worker in probe_workers) or bad_fds:
             EXIT_CODE = 1
@@ -129,6 +458,107 @@ def health_watchdog(probe_workers: List[Process], output_fh: TextIO):
             break
 
 
+def dropped_event_telemetry(output_queue: OutputQueue, formatter: TimestampFormatter) -> Iterable[str]:
+    """ Generate telemetry events about events dropped from the output queue
+
+    :param OutputQueue output_queue: output queue
+    :param TimestampFormatter formatter: event timestamp formatter
+    :return: yields serialized telemetry events, one per probe
+    """
+    timestamp = formatter.format()
+    for probe_name, count in output_queue.dropped_counts():
+        yield json.dumps({
+            'type': 'dropped_event_telemetry',
+            'count': count,
+            'timestamp': timestamp,
+            'probe': probe_name,
+        })
+
+
+def resource_telemetry(probe_workers: List[Process], formatter: TimestampFormatter) -> str:
+    """ Generate telemetry event about resource usage of pidtree-bcc processes
+
+    :param List[Process] probe_workers: list of probe processes
+    :param TimestampFormatter formatter: event timestamp formatter
+    :return: serialized telemetry event
+    """
+    import psutil
+    rss = cpu_user = cpu_system = 0
+    pids = [os.getpid()] + [worker.pid for worker in probe_workers if worker.pid]
+    for pid in pids:
+        try:
+            proc = psutil.Process(pid)
+            with proc.oneshot():
+                rss += proc.memory_info().rss
+                cpu_times = proc.cpu_times()
+        except psutil.Error:
+            continue
+        cpu_user += cpu_times.user
+        cpu_system += cpu_times.system
+    return json.dumps({
+        'type': 'resource_telemetry',
+        'processes': len(pids),
+        'rss': rss,
+        'cpu_user': round(cpu_user, 3),
+        'cpu_system': round(cpu_system, 3),
+        'timestamp': formatter.format(),
+    })
+
+
+def control_commands(
+    output_queue: OutputQueue,
+    probe_control: ProbeControl = None,
+    profile_dir: str = None,
+) -> CommandTable:
+    """ Build the table of commands served on the control socket
+
+    :param OutputQueue output_queue: output queue
+    :param ProbeControl probe_control: (optional) control channels of the probes, None when replaying
+    :param str profile_dir: (optional) profile directory, if profiling is enabled
+    :return: command handlers and descriptions by name
+    """
+    commands = OrderedDict()
+
+    def stats(args: List[str]) -> dict:
+        result = OrderedDict((('queue', output_queue.stats()),))
+        if probe_control:
+            result['probes'] = probe_control.request('stats', args)
+        return result
+
+    commands['stats'] = (stats, 'Output queue depth and dropped events, statistics of each probe')
+    if probe_control:
+        for command, description in (
+            ('sessions', 'UDP sessions currently tracked'),
+            ('listeners', 'Current listeners'),
+            ('cache', 'Ancestry cache contents, optionally only for a PID'),
+            ('snapshot', 'Output a full snapshot of the listeners right away'),
+            ('reload-filters', 'Reload process filter rules files'),
+        ):
+            commands[command] = (partial(probe_control.request, command), description)
+    if profile_dir:
+
+        def profile(args: List[str]) -> str:
+            os.kill(os.getpid(), PROFILING_SIGNAL)
+            return 'Profiling session requested, writing to {}'.format(profile_dir)
+
+        commands['profile'] = (profile, 'Start a sampling profiler session, as with SIGUSR2')
+    return commands
+
+
+def replay_worker(filename: str, probes: Mapping[str, 'BPFProbe'], speed: float, output_queue: OutputQueue):
+    """ Replay recorded events and signal the end of the stream when done
+
+    :param str filename: path of the recording file
+    :param Mapping[str, BPFProbe] probes: loaded probes by name
+    :param float speed: replay speed relative to the recorded one
+    :param OutputQueue output_queue: output queue
+    """
+    try:
+        replay_events(filename, probes, speed)
+    finally:
+        output_queue.put_end_of_stream()
+
+
 def main(args: argparse.Namespace):
     global EXIT_CODE
     probe_workers = []
@@ -137,43 +567,197 @@ def main(args: argparse.Namespace):
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
     )
-    curried_handler = partial(termination_handler, probe_workers)
+    output_queue = OutputQueue(args.queue_size, args.queue_policy)
+    curried_handler = partial(termination_handler, probe_workers, output_queue, args.shutdown_timeout)
     for s in HANDLED_SIGNALS:
         signal.signal(s, curried_handler)
+    if args.profile_dir:
+        # inherited by probe processes, which will only profile themselves
+        signal.signal(
+            PROFILING_SIGNAL,
+            partial(profiling_handler, args.profile_dir, args.profile_duration, probe_workers, os.getpid()),
+        )
     config = parse_config(args.config)
-    out = smart_open(args.output_file, mode='w')
-    output_queue = SimpleQueue()
+    if args.output_rotate_size > 0 or args.output_rotate_interval > 0:
+        out = RotatingFileSink(
+            args.output_file,
+            args.output_rotate_size,
+            args.output_rotate_interval,
+            args.output_compression,
+        )
+    elif args.stream_compression != 'none':
+        out = CompressedStreamSink(
+            open(args.output_file, 'wb') if args.output_file != '-' else sys.stdout.buffer,
+            args.stream_compression,
+        )
+    else:
+        out = smart_open(args.output_file, mode='w')
+    # sinks receiving events in addition to the main output
+    extra_sinks = []
+    if args.event_store:
+        from pidtree_bcc.event_store import EventStore  # imported lazily, as only needed with this option
+        extra_sinks.append(EventStore(args.event_store, args.event_store_retention, args.event_store_max_size))
+    if args.columnar_output:
+        extra_sinks.append(ColumnarSink(
+            args.columnar_output,
+            args.columnar_format,
+            args.columnar_row_group_size,
+            args.columnar_rollover,
+            args.timestamp_format,
+            args.intern_processes > 0,
+        ))
+    timestamp_formatter = TimestampFormatter(args.timestamp_format)
+    if args.shared_ancestry_cache > 0:
+        set_ancestry_cache(SharedAncestryStore(args.shared_ancestry_cache))
+    elif args.single_process:
+        # all probes run in the same process, so they can share an in-memory cache
+        set_ancestry_cache(ProcessInfoCache())
+    # probe modules are imported here to keep CLI startup fast
+    import_start = time.perf_counter()
+    from pidtree_bcc.probes import load_probes
+    from pidtree_bcc.probes import log_startup_profile
+    from pidtree_bcc.probes import poll_probes
+    if args.startup_profile:
+        log_startup_profile('pidtree_bcc.probes', {'import': time.perf_counter() - import_start})
     probes = load_probes(
         config,
         output_queue,
         args.extra_probe_path,
         args.extra_plugin_path,
         args.lost_event_telemetry,
+        EventRecorder(args.record) if args.record else None,
+        args.single_process,
+        args.startup_profile,
+        args.timestamp_format,
+        args.latency_tracing,
+        args.latency_sample_rate,
+        args.intern_processes,
+        args.cmdline_max_length,
+        args.kernel_counters_telemetry,
+        args.checkpoint_dir,
     )
     logging.info('Loaded probes: {}'.format(', '.join(probes)))
+    if args.startup_profile:
+        for probe_name, probe in probes.items():
+            log_startup_profile(probe_name, probe.startup_timings)
     if args.print_and_quit:
         for probe_name, probe in probes.items():
             print('----- {} -----'.format(probe_name))
             print(probe.expanded_bpf_text)
             print('\n')
         sys.exit(0)
-    for probe in probes.values():
-        probe_workers.append(Process(target=deregister_signals(probe.start_polling)))
+    control_server = None
+    # control channels must be opened before probe processes are forked
+    probe_control = ProbeControl(probes) if args.control_socket and not args.replay else None
+    if args.replay:
+        probe_workers.append(Process(
+            name='replay',
+            target=deregister_signals(replay_worker),
+            args=(args.replay, probes, args.replay_speed, output_queue),
+        ))
+        probe_workers[-1].start()
+    elif args.single_process:
+        probe_workers.append(Process(
+            name='probes',
+            target=graceful_probe_worker(poll_probes, list(probes.values()), bool(args.checkpoint_dir)),
+            args=(list(probes.values()),),
+        ))
         probe_workers[-1].start()
+    else:
+        for probe_name, probe in probes.items():
+            probe_workers.append(Process(
+                name=probe_name,
+                target=graceful_probe_worker(probe.start_polling, [probe], bool(args.checkpoint_dir)),
+            ))
+            probe_workers[-1].start()
+    if args.control_socket:
+        control_server = ControlServer(args.control_socket, control_commands(
+            output_queue,
+            probe_control,
+            args.profile_dir,
+        ))
     watchdog_thread = Thread(target=health_watchdog, args=(probe_workers, out), daemon=True)
     watchdog_thread.start()
+    telemetry_periods = [
+        period for period in (args.dropped_event_telemetry, args.resource_telemetry, args.latency_tracing)
+        if period > 0
+    ]
+    if isinstance(out, CompressedStreamSink):
+        # wake up in time to flush compressed batches
+        telemetry_periods.append(out.FLUSH_INTERVAL)
+    telemetry_periods.extend(sink.FLUSH_INTERVAL for sink in extra_sinks)
+    telemetry_period = min(telemetry_periods) if telemetry_periods else None
+    next_dropped_telemetry = time.monotonic() + args.dropped_event_telemetry
+    next_resource_telemetry = time.monotonic() + args.resource_telemetry
+    output_tracer = LatencyTracer(args.latency_tracing) if args.latency_tracing > 0 else None
+    flushed_events = 0
     try:
         while True:
-            print(output_queue.get(), file=out)
+            if SHUTDOWN_DEADLINE is not None and time.monotonic() >= SHUTDOWN_DEADLINE:
+                break
+            try:
+                line = output_queue.get(timeout=telemetry_period)
+                if line is None:
+                    out.flush()
+                    break
+                if output_tracer:
+                    write_start = monotonic_ns()
+                    print(line, file=out)
+                    out.flush()
+                    output_tracer.record((('write', monotonic_ns() - write_start),))
+                else:
+                    print(line, file=out)
+                for sink in extra_sinks:
+                    sink.add(line)
+                if SHUTDOWN_DEADLINE is not None:
+                    flushed_events += 1
+            except queue.Empty:
+                pass
+            if args.dropped_event_telemetry > 0 and time.monotonic() >= next_dropped_telemetry:
+                next_dropped_telemetry += args.dropped_event_telemetry
+                for event in dropped_event_telemetry(output_queue, timestamp_formatter):
+                    print(event, file=out)
+            if args.resource_telemetry > 0 and time.monotonic() >= next_resource_telemetry:
+                next_resource_telemetry += args.resource_telemetry
+                print(resource_telemetry(probe_workers, timestamp_formatter), file=out)
+            if output_tracer and output_tracer.report_due():
+                print(json.dumps({
+                    'type': 'latency_telemetry',
+                    'stages': output_tracer.report(),
+                    'timestamp': timestamp_formatter.format(),
+                    'probe': 'output',
+                }), file=out)
             out.flush()
+            for sink in extra_sinks:
+                sink.flush()
     except Exception as e:
         # Terminate everything if something goes wrong
         EXIT_CODE = 1
         logging.error('Encountered unexpected error: {}'.format(e))
-        for worker in probe_workers:
-            worker.terminate()
+        kill_workers(probe_workers)
+    finally:
+        if control_server:
+            control_server.close()
+        sink_timeout = None
+        if SHUTDOWN_DEADLINE is not None:
+            sink_timeout = max(SHUTDOWN_DEADLINE - time.monotonic(), 0)
+            abandoned_events = output_queue.stats()['size']
+            logging.info('Shutdown: flushed {} events, abandoned {} queued events'.format(
+                flushed_events,
+                abandoned_events if abandoned_events is not None else 'an unknown number of',
+            ))
+        if isinstance(out, CompressedStreamSink):
+            out.close()
+        elif isinstance(out, RotatingFileSink):
+            out.close(sink_timeout)
+        for sink in extra_sinks:
+            sink.close(sink_timeout)
     sys.exit(EXIT_CODE)
 
 
 if __name__ == '__main__':
-    main(parse_args())
+    if sys.argv[1:2] == ['query']:
+        from pidtree_bcc.event_store import query_main
+        query_main(sys.argv[2:])
+    else:
+        main(parse_args())
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict
+from typing import Iterable
+
+from pidtree_bcc.utils import event_destinations
+
+
+class NoveltyFilter:
+    """ Suppresses events for (process lineage, destination) pairs already seen within a TTL.
+
+    Pairs are tracked as 64 bit digests in an insertion ordered hash, which makes it
+    cheap both to expire the oldest entries and to bound memory usage by evicting them.
+    The process lineage is identified by the command lines and users in the process
+    tree, so that e.g. periodic jobs connecting to the same destination are only
+    reported once per TTL. Re-emitted events carry the number of repeats which were
+    suppressed in the previous TTL window. Summaries are meant to be requested
+    periodically from a separate thread, so state is guarded by a lock.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 100000, summary_interval: float = 300):
+        """ Constructor
+
+        :param float ttl: seconds during which repeated pairs are suppressed
+        :param int max_entries: (optional) max number of tracked pairs, oldest are evicted first
+        :param float summary_interval: (optional) seconds between suppression summaries
+        """
+        if ttl <= 0 or max_entries <= 0:
+            raise ValueError('Novelty filter TTL and max entries must be positive')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.summary_interval = summary_interval
+        self.expirations = OrderedDict()  # type: Dict[int, float]
+        # suppressed repeats outlive expired pairs, to be reported when pairs are seen again
+        self.repeats = OrderedDict()  # type: Dict[int, int]
+        self.suppressed = 0
+        self.evicted = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def event_keys(event: dict) -> Iterable[int]:
+        """ Compute pair digests for an event
+
+        :param dict event: event dictionary
+        :return: yields a digest for each destination of the event
+        """
+        lineage = [(proc.get('cmdline'), proc.get('username')) for proc in event.get('proctree') or ()]
+        for daddr, port in event_destinations(event):
+            serialized = json.dumps([lineage, daddr, port, event.get('type')])
+            yield int.from_bytes(hashlib.sha1(serialized.encode()).digest()[:8], 'little')
+
+    def check(self, event: dict) -> bool:
+        """ Check if event is novel, updating tracked pairs.
+        If a pair is re-emitted after having been suppressed, the number of
+        suppressed repeats is added to the event (in place) as `repeats`.
+
+        :param dict event: event dictionary
+        :return: True if the event should be emitted
+        """
+        with self.lock:
+            return self._check(event)
+
+    def _check(self, event: dict) -> bool:
+        """ Actual `check` implementation, to be invoked holding the lock """
+        now = time.monotonic()
+        novel = False
+        repeats = 0
+        for key in self.event_keys(event):
+            expiration = self.expirations.get(key)
+            if expiration is not None and expiration > now:
+                if key in self.repeats:
+                    self.repeats[key] += 1
+                else:
+                    self.repeats[key] = 1
+                    if len(self.repeats) > self.max_entries:
+                        self.repeats.popitem(last=False)
+                continue
+            novel = True
+            repeats += self.repeats.pop(key, 0)
+            self.expirations.pop(key, None)
+            self.expirations[key] = now + self.ttl
+        if not novel:
+            self.suppressed += 1
+            return False
+        if repeats:
+            event['repeats'] = repeats
+        while len(self.expirations) > self.max_entries:
+            key, _ = self.expirations.popitem(last=False)
+            self.repeats.pop(key, None)
+            self.evicted += 1
+        return True
+
+    def summary(self) -> dict:
+        """ Summarize suppressed events since the previous summary, and drop expired pairs
+
+        :return: dictionary with number of suppressed events, evicted and tracked pairs
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.expirations:
+                key, expiration = next(iter(self.expirations.items()))
+                if expiration > now:
+                    break
+                del self.expirations[key]
+            result = OrderedDict((
+                ('suppressed', self.suppressed),
+                ('evicted', self.evicted),
+                ('tracked', len(self.expirations)),
+            ))
+            self.suppressed = self.evicted = 0
+        return result
@@ -0,0 +1,139 @@
+import multiprocessing
+import queue
+from collections import OrderedDict
+from typing import Iterator
+from typing import Tuple
+
+
+class OutputQueue:
+    """ Bounded queue connecting probe processes to the output writer.
+
+    When the queue is full, events are handled according to one of the load-shedding policies:
+    - block: producers wait for the consumer to free up space (as an effect, events will
+             eventually be lost in the kernel -> userland channel);
+    - drop_newest: the event being enqueued is discarded;
+    - drop_oldest: the event at the head of the queue is discarded to make room for the new one;
+    - priority: each producer can only fill the queue up to a fraction proportional to its
+                priority, events exceeding that are discarded. Producers with the highest
+                priority can use the whole queue.
+
+    Dropped events are counted per producer in shared memory, so that they can be reported
+    by the consumer process. With `drop_oldest`, evictions are charged to the producer
+    enqueueing the new event, as the owner of the evicted one is not tracked, so per
+    producer counts are approximate (the total is exact).
+    """
+
+    POLICIES = ('block', 'drop_newest', 'drop_oldest', 'priority')
+    EVICTION_TIMEOUT = 0.1  # seconds
+
+    def __init__(self, maxsize: int = 0, policy: str = 'block'):
+        """ Constructor
+
+        :param int maxsize: maximum number of events in the queue (<= 0 means unbounded)
+        :param str policy: load shedding policy (see class description)
+        """
+        if policy not in self.POLICIES:
+            raise ValueError('{} is not among supported queue policies {}'.format(policy, self.POLICIES))
+        self.maxsize = max(maxsize, 0)
+        self.policy = policy if self.maxsize else 'block'
+        self.queue = multiprocessing.Queue(self.maxsize)
+        self.drop_counters = {}
+        self.priorities = {}
+        self.max_priority = 0
+
+    def register_producer(self, name: str, priority: int = 0):
+        """ Register a producer, allocating its drop counter.
+        Must be invoked before producer processes are forked.
+
+        :param str name: producer name
+        :param int priority: producer priority (only used with `priority` policy)
+        """
+        self.drop_counters[name] = multiprocessing.Value('Q', 0)
+        self.priorities[name] = priority
+        self.max_priority = max(self.priorities.values())
+
+    def put(self, item: str, producer: str = None):
+        """ Enqueue item, applying the load shedding policy if the queue is full
+
+        :param str item: serialized event
+        :param str producer: name of the producer enqueueing the item
+        """
+        if self.policy == 'block':
+            self.queue.put(item)
+            return
+        if self.policy == 'priority' and producer in self.priorities:
+            limit = self.maxsize * (self.priorities[producer] + 1) // (self.max_priority + 1)
+            if self.queue.qsize() >= limit:
+                self._count_drop(producer)
+                return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.policy != 'drop_oldest':
+                self._count_drop(producer)
+                return
+            try:
+                # the queue is full, but items may still be in flight in the feeder thread
+                evicted = self.queue.get(True, self.EVICTION_TIMEOUT)
+            except queue.Empty:
+                pass
+            else:
+                if evicted is None:
+                    # never evict the end of stream marker
+                    self.queue.put_nowait(None)
+                    self._count_drop(producer)
+                    return
+                self._count_drop(producer)
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self._count_drop(producer)
+
+    def put_end_of_stream(self):
+        """ Signal the consumer that no more events will be produced.
+        This is never subject to load shedding.
+        """
+        self.queue.put(None)
+
+    def get(self, timeout: float = None) -> str:
+        """ Dequeue item
+
+        :param float timeout: (optional) max seconds to wait for an item
+        :raise queue.Empty: if timeout is set and no item was available
+        :return: serialized event, or None if the end of the stream was reached
+        """
+        return self.queue.get(True, timeout)
+
+    def dropped_counts(self) -> Iterator[Tuple[str, int]]:
+        """ Iterate over drop counters
+
+        :return: yields producer name and total number of events dropped
+        """
+        for producer, counter in self.drop_counters.items():
+            yield producer, counter.value
+
+    def stats(self) -> dict:
+        """ Queue statistics
+
+        :return: dictionary with current and max size, policy and dropped events by producer
+        """
+        try:
+            size = self.queue.qsize()
+        except NotImplementedError:
+            size = None  # not supported on every platform
+        return OrderedDict((
+            ('size', size),
+            ('maxsize', self.maxsize),
+            ('policy', self.policy),
+            ('dropped', dict(self.dropped_counts())),
+        ))
+
+    def _count_drop(self, producer: str):
+        """ Increment drop counter for producer
+
+        :param str producer: producer name
+        """
+        counter = self.drop_counters.get(producer)
+        if counter is not None:
+            with counter.get_lock():
+                counter.value += 1
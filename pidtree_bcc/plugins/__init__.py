@@ -1,4 +1,6 @@
+import json
 import logging
+from typing import Dict
 from typing import List
 
 from pidtree_bcc.utils import find_subclass
@@ -35,7 +37,12 @@ class BasePlugin:
         pass
 
 
-def load_plugins(plugin_dict: dict, calling_probe: str, extra_plugin_path: str = None) -> List[BasePlugin]:
+def load_plugins(
+    plugin_dict: dict,
+    calling_probe: str,
+    extra_plugin_path: str = None,
+    plugin_cache: Dict[str, BasePlugin] = None,
+) -> List[BasePlugin]:
     """ Load and configure plugins
 
     :param dict plugin_dict: where the keys are plugin names and the value
@@ -43,6 +50,8 @@ def load_plugins(plugin_dict: dict, calling_probe: str, extra_plugin_path: str =
                              must match a `.py` file in the plugin directory
     :param str calling_probe: name of the calling probe for support validation
     :param str extra_plugin_path: (optional) extra package path where to look for plugins
+    :param Dict[str, BasePlugin] plugin_cache: (optional) plugin instances shared among probes,
+                                               reused when name and parameters match.
     :return: list of loaded plugins
     """
     plugins = []
@@ -64,7 +73,13 @@ def load_plugins(plugin_dict: dict, calling_probe: str, extra_plugin_path: str =
                     '{} is not among supported probes for plugin {}: {}'
                     .format(calling_probe, plugin_name, plugin_class.PROBE_SUPPORT),
                 )
-            plugins.append(plugin_class(plugin_args))
+            if plugin_cache is None:
+                plugins.append(plugin_class(plugin_args))
+            else:
+                cache_key = '{}:{}'.format(plugin_name, json.dumps(plugin_args, sort_keys=True, default=str))
+                if cache_key not in plugin_cache:
+                    plugin_cache[cache_key] = plugin_class(plugin_args)
+                plugins.append(plugin_cache[cache_key])
         except ImportError as e:
             error = RuntimeError(
                 'Could not import {}: {}'
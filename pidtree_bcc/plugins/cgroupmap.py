@@ -0,0 +1,174 @@
+import json
+import os
+import re
+import time
+from threading import Thread
+from typing import Dict
+from typing import Optional
+
+from pidtree_bcc.plugins import BasePlugin
+from pidtree_bcc.utils import never_crash
+
+
+CONTAINER_ID_PATTERNS = (
+    # systemd cgroup driver: docker-<id>.scope, cri-containerd-<id>.scope, crio-<id>.scope
+    re.compile(r'^(?:docker|cri-containerd|crio|libpod)-([0-9a-f]{64})\.scope$'),
+    # cgroupfs cgroup driver: /docker/<id>, /kubepods/burstable/pod<uid>/<id>
+    re.compile(r'^([0-9a-f]{64})$'),
+)
+POD_UID_PATTERN = re.compile(r'pod([0-9a-f]{8}[-_][0-9a-f]{4}[-_][0-9a-f]{4}[-_][0-9a-f]{4}[-_][0-9a-f]{12})')
+
+
+def parse_cgroup_dirname(dirname: str, parent_info: Optional[dict]) -> Optional[dict]:
+    """ Extract container metadata from a cgroup directory name
+
+    :param str dirname: basename of the cgroup directory
+    :param dict parent_info: metadata inherited from the parent cgroup (if any)
+    :return: container metadata dictionary or None if not a container cgroup
+    """
+    pod_match = POD_UID_PATTERN.search(dirname)
+    if pod_match:
+        return {'pod_uid': pod_match.group(1).replace('_', '-')}
+    for pattern in CONTAINER_ID_PATTERNS:
+        match = pattern.match(dirname)
+        if match:
+            info = dict(parent_info) if parent_info else {}
+            info['container_id'] = match.group(1)
+            return info
+    return parent_info
+
+
+class CgroupMap(BasePlugin):
+    """ Plugin for mapping the cgroup ID captured in kernel to container metadata """
+
+    PROBE_SUPPORT = '*'
+    REFRESH_INTERVAL_DEFAULT = 5
+
+    def __init__(self, args: dict):
+        super().__init__(args)
+        self.cgroup_root = args.get('cgroup_root', '/sys/fs/cgroup')
+        self.docker_root = args.get('docker_root', None)
+        self.attribute_key = args.get('attribute_key', 'container')
+        self.refresh_interval = args.get('refresh_interval', self.REFRESH_INTERVAL_DEFAULT)
+        # cgroup ID (i.e. directory inode) -> container metadata
+        self.index = {}  # type: Dict[int, dict]
+        # cgroup directory path -> (inode, mtime, container metadata)
+        self.known_dirs = {}  # type: Dict[str, tuple]
+        self.refresh_thread = None
+        self.refresh_index()
+
+    def process(self, event: dict) -> dict:
+        if self.refresh_thread is None:
+            # Started lazily since plugins are initialized before probe processes are forked
+            self.refresh_thread = Thread(target=self._refresh_worker, daemon=True)
+            self.refresh_thread.start()
+        info = self.index.get(event.get('cgroup_id'))
+        if info is not None:
+            event[self.attribute_key] = info
+        return event
+
+    def refresh_index(self):
+        """ Incrementally update the cgroup index.
+
+        Only directories whose modification time changed since the previous refresh
+        are listed again, as creating or removing a child cgroup touches the parent.
+        """
+        if not self.known_dirs:
+            self._index_dir(self.cgroup_root, None)
+            return
+        for path, (inode, mtime, info) in list(self.known_dirs.items()):
+            if path not in self.known_dirs:
+                # removed while handling one of its ancestors
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self._remove_subtree(path)
+                continue
+            if stat.st_ino != inode:
+                self._remove_subtree(path)
+                self._index_dir(path, self._parent_info(path))
+            elif stat.st_mtime_ns != mtime:
+                self.known_dirs[path] = (inode, stat.st_mtime_ns, info)
+                self._index_children(path, info)
+
+    def _index_dir(self, path: str, parent_info: Optional[dict]):
+        """ Add directory and its whole subtree to the index
+
+        :param str path: cgroup directory path
+        :param dict parent_info: metadata inherited from the parent cgroup
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        info = parse_cgroup_dirname(os.path.basename(path), parent_info)
+        if info and 'container_id' in info and info is not parent_info:
+            info.update(self._container_names(info['container_id']))
+        self.known_dirs[path] = (stat.st_ino, stat.st_mtime_ns, info)
+        if info:
+            self.index[stat.st_ino] = info
+        self._index_children(path, info)
+
+    def _index_children(self, path: str, info: Optional[dict]):
+        """ Index child directories not yet known
+
+        :param str path: cgroup directory path
+        :param dict info: metadata of the cgroup
+        """
+        try:
+            entries = [entry.path for entry in os.scandir(path) if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return
+        for child in entries:
+            if child not in self.known_dirs:
+                self._index_dir(child, info)
+
+    def _remove_subtree(self, path: str):
+        """ Remove directory and its subtree from the index
+
+        :param str path: cgroup directory path
+        """
+        prefix = path + os.sep
+        for known in [p for p in self.known_dirs if p == path or p.startswith(prefix)]:
+            inode = self.known_dirs.pop(known)[0]
+            self.index.pop(inode, None)
+
+    def _parent_info(self, path: str) -> Optional[dict]:
+        """ Get container metadata of the parent of a cgroup directory """
+        parent = self.known_dirs.get(os.path.dirname(path))
+        return parent[2] if parent else None
+
+    def _container_names(self, container_id: str) -> dict:
+        """ Read container and pod names from docker metadata, if configured
+
+        :param str container_id: container identifier
+        :return: dictionary with `container_name` and `pod_name` when available
+        """
+        if not self.docker_root:
+            return {}
+        config_path = os.path.join(self.docker_root, 'containers', container_id, 'config.v2.json')
+        try:
+            with open(config_path) as f:
+                config = json.load(f)
+        except Exception:
+            return {}
+        names = {'container_name': config.get('Name', '').lstrip('/')}
+        pod_name = (config.get('Config') or {}).get('Labels', {}).get('io.kubernetes.pod.name')
+        if pod_name:
+            names['pod_name'] = pod_name
+        return names
+
+    @never_crash
+    def _refresh_worker(self):
+        """ Handler function for index refresh thread """
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh_index()
+
+    def validate_args(self, args: dict):
+        cgroup_root = args.get('cgroup_root', '/sys/fs/cgroup')
+        if not os.path.isdir(cgroup_root):
+            raise RuntimeError(
+                'cgroup_root `{}` passed to the cgroupmap plugin is not a directory'.format(cgroup_root),
+            )
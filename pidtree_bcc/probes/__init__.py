@@ -1,19 +1,84 @@
+import ctypes
 import inspect
 import json
+import logging
 import os.path
 import re
-from datetime import datetime
-from multiprocessing import SimpleQueue
+import select
+import time
+from collections import OrderedDict
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection
+from threading import Lock
 from threading import Thread
 from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
 from typing import Mapping
 
-from bcc import BPF
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
+from jinja2 import Template
 
+from pidtree_bcc.checkpoint import read_checkpoint
+from pidtree_bcc.checkpoint import write_checkpoint
+from pidtree_bcc.control import serve_probe_control
+from pidtree_bcc.filtering import ProcessFilter
+from pidtree_bcc.interning import ProcessInterner
+from pidtree_bcc.interning import truncate_cmdlines
+from pidtree_bcc.latency import LatencyTracer
+from pidtree_bcc.novelty import NoveltyFilter
+from pidtree_bcc.output_queue import OutputQueue
 from pidtree_bcc.plugins import load_plugins
+from pidtree_bcc.recording import EventRecorder
+from pidtree_bcc.recording import monotonic_ns
+from pidtree_bcc.timestamps import KernelClock
+from pidtree_bcc.timestamps import TimestampFormatter
 from pidtree_bcc.utils import find_subclass
+from pidtree_bcc.utils import get_ancestry_cache
+from pidtree_bcc.utils import never_crash
+from pidtree_bcc.utils import parse_proctree_config
+from pidtree_bcc.utils import process_matches
+
+
+# Jinja environments by template directory and compiled templates by (directory, source)
+JINJA_ENVIRONMENTS = {}  # type: Dict[str, Environment]
+COMPILED_TEMPLATES = {}  # type: Dict[tuple, Template]
+STOP_CHECK_INTERVAL = 0.2  # seconds
+
+
+def render_template(source: str, template_dir: str, variables: dict) -> str:
+    """ Render BPF program template, caching compiled templates and their environment.
+
+    Sharing the environment among probes in the same directory also avoids
+    compiling imported macro files (i.e. `utils.j2`) more than once.
+
+    :param str source: template source
+    :param str template_dir: directory where to look for imported templates
+    :param dict variables: templating variables
+    :return: rendered text
+    """
+    template = COMPILED_TEMPLATES.get((template_dir, source))
+    if template is None:
+        jinja_env = JINJA_ENVIRONMENTS.get(template_dir)
+        if jinja_env is None:
+            jinja_env = JINJA_ENVIRONMENTS[template_dir] = Environment(loader=FileSystemLoader(template_dir))
+        template = COMPILED_TEMPLATES[(template_dir, source)] = jinja_env.from_string(source)
+    return template.render(**variables)
+
+
+def log_startup_profile(name: str, timings: Mapping[str, float]):
+    """ Log time spent in startup stages
+
+    :param str name: name of the profiled component
+    :param Mapping[str, float] timings: seconds spent by stage
+    """
+    logging.info('Startup profile for {}: {}'.format(
+        name,
+        ', '.join('{} {:.1f}ms'.format(stage, seconds * 1000) for stage, seconds in timings.items()),
+    ))
 
 
 class BPFProbe:
@@ -30,13 +95,47 @@ class BPFProbe:
     # stable or self-healing.
     SIDECARS = []
 
+    # ctypes definition of the BPF event struct, used to decode recorded events
+    EVENT_STRUCT = None
+
+    # Converts kernel event timestamps to wall clock time
+    CLOCK = KernelClock()
+
+    # Seconds between checks for changes of the process filter rules file
+    PROCESS_FILTER_CHECK_INTERVAL = 5
+
+    # Names of the in-kernel event counters, in the same order as `utils.counters` in BPF code
+    KERNEL_COUNTERS = (
+        'entered',
+        'filtered_subnet',
+        'filtered_port',
+        'filtered_namespace',
+        'filtered_process',
+        'failed',
+        'submitted',
+        'closed',
+    )
+
+    # Commands accepted from the control socket (see `handle_control`)
+    CONTROL_COMMANDS = ('stats', 'cache', 'reload-filters')
+
     # To be populated by `load_probes`
     EXTRA_PLUGIN_PATH = None
+    RECORDER = None
+    PLUGIN_CACHE = None
+    STARTUP_PROFILE = False
+    TIMESTAMP_FORMATTER = TimestampFormatter()
+    LATENCY_REPORT_INTERVAL = 0
+    LATENCY_SAMPLE_RATE = 0
+    PROCESS_INTERNING_INTERVAL = 0
+    CMDLINE_MAX_LENGTH = 0
+    KERNEL_COUNTERS_INTERVAL = 0
+    CHECKPOINT_DIR = None
 
-    def __init__(self, output_queue: SimpleQueue, probe_config: dict = {}, lost_event_telemetry: int = -1):
+    def __init__(self, output_queue: OutputQueue, probe_config: dict = {}, lost_event_telemetry: int = -1):
         """ Constructor
 
-        :param Queue output_queue: queue for event output
+        :param OutputQueue output_queue: queue for event output
         :param dict probe_config: (optional) config passed as kwargs to BPF template
                                   all fields are passed to the template engine with the exception
                                   of "plugins". This behaviour can be overidden with the TEMPLATE_VARS
@@ -47,6 +146,10 @@ class BPFProbe:
                                          Set to <= 0 to disable.
         """
         self.output_queue = output_queue
+        self.bpf = None
+        self.stopping = False
+        self.startup_timings = OrderedDict()  # type: Dict[str, float]
+        self.SIDECARS = list(self.SIDECARS)  # avoid sharing sidecars among probe classes
         self.validate_config(probe_config)
         module_src = inspect.getsourcefile(type(self))
         self.probe_name = os.path.basename(module_src).split('.')[0]
@@ -54,6 +157,7 @@ class BPFProbe:
             probe_config.get('plugins', {}),
             self.probe_name,
             self.EXTRA_PLUGIN_PATH,
+            self.PLUGIN_CACHE,
         )
         if not hasattr(self, 'BPF_TEXT'):
             with open(re.sub(r'\.py$', '.j2', module_src)) as f:
@@ -63,15 +167,48 @@ class BPFProbe:
             if hasattr(self, 'CONFIG_DEFAULTS')
             else probe_config.copy()
         )
+        self.capture_cgroup_id = template_config.get('capture_cgroup_id', False)
+        self.process_filter = None
+        self.process_filter_lock = Lock()
+        self.process_filter_file = None
+        novelty_config = template_config.pop('novelty_filter', None)
+        self.novelty_filter = NoveltyFilter(**novelty_config) if novelty_config else None
+        if self.novelty_filter:
+            self.SIDECARS.append((self._novelty_summary_worker, (self.novelty_filter.summary_interval,)))
+        self.proctree_options = parse_proctree_config(template_config.pop('proctree', None) or {})
+        process_filter_config = template_config.pop('process_filters', None)
+        if process_filter_config is not None:
+            self.process_filter = ProcessFilter(self._read_process_filter_rules(process_filter_config))
+            if process_filter_config.get('file'):
+                self.process_filter_file = process_filter_config['file']
+                self.SIDECARS.append((self._process_filter_worker, (process_filter_config['file'],)))
         if hasattr(self, 'TEMPLATE_VARS'):
             template_config = {k: template_config[k] for k in self.TEMPLATE_VARS}
         else:
             template_config.pop('plugins', None)
-        jinja_env = Environment(loader=FileSystemLoader(os.path.dirname(module_src)))
-        self.expanded_bpf_text = jinja_env.from_string(self.BPF_TEXT).render(**template_config)
+        template_config['process_filter'] = self.process_filter
+        render_start = time.perf_counter()
+        self.expanded_bpf_text = render_template(self.BPF_TEXT, os.path.dirname(module_src), template_config)
+        self.startup_timings['render'] = time.perf_counter() - render_start
         self.lost_event_telemetry = lost_event_telemetry
         self.lost_event_timer = lost_event_telemetry
         self.lost_event_count = 0
+        # kernel -> userland delay stats since last lost event telemetry
+        self.delay_count = 0
+        self.delay_total_ns = 0
+        self.delay_max_ns = 0
+        self.process_interner = None
+        if self.PROCESS_INTERNING_INTERVAL > 0:
+            self.process_interner = ProcessInterner(self.PROCESS_INTERNING_INTERVAL, self.CMDLINE_MAX_LENGTH)
+        if self.KERNEL_COUNTERS_INTERVAL > 0:
+            self.SIDECARS.append((self._kernel_counters_worker, (self.KERNEL_COUNTERS_INTERVAL,)))
+        if self.RECORDER:
+            self.SIDECARS.append((self._recorder_flush_worker, ()))
+        self.latency_tracer = None
+        if self.LATENCY_REPORT_INTERVAL > 0:
+            self.latency_tracer = LatencyTracer(self.LATENCY_REPORT_INTERVAL, self.LATENCY_SAMPLE_RATE)
+            # swapping the implementation keeps the default code path free of instrumentation
+            self._process_events = self._process_events_traced
 
     def _process_events(self, cpu: Any, data: Any, size: Any, from_bpf: bool = True):
         """ BPF event callback
@@ -82,20 +219,121 @@ class BPFProbe:
         :param bool from_bpf: (optional, default=True) event generated by BPF code
         """
         event = self.bpf['events'].event(data) if from_bpf else data
+        # timestamps of replayed events are not meaningful in the current boot
+        ktime = getattr(event, 'ktime', 0) if from_bpf else 0
+        if ktime:
+            self._track_delay(monotonic_ns() - ktime)
         event = self.enrich_event(event)
-        if not event:
+        if not event or (self.novelty_filter and not self.novelty_filter.check(event)):
             return
-        self._add_event_metadata(event)
+        self._add_event_metadata(event, ktime)
         for event_plugin in self.plugins:
             event = event_plugin.process(event)
-        self.output_queue.put(json.dumps(event))
+        for line in self._serialize_event(event):
+            self.output_queue.put(line, self.probe_name)
 
-    def _add_event_metadata(self, event: dict):
-        """ Adds probe name and current ISO-format timestamp to event dictionary (in place)
+    def _serialize_event(self, event: dict) -> List[str]:
+        """ Serialize event, preceded by process records if process interning is enabled
 
         :param dict event: event dictionary
+        :return: serialized output lines
         """
-        event['timestamp'] = datetime.utcnow().isoformat() + 'Z'
+        lines = []
+        if self.process_interner:
+            for record in self.process_interner.intern(event):
+                self._add_event_metadata(record)
+                lines.append(json.dumps(record))
+        elif self.CMDLINE_MAX_LENGTH > 0 and 'proctree' in event:
+            truncate_cmdlines(event['proctree'], self.CMDLINE_MAX_LENGTH)
+        lines.append(json.dumps(event))
+        return lines
+
+    def _process_events_traced(self, cpu: Any, data: Any, size: Any, from_bpf: bool = True):
+        """ BPF event callback, same as `_process_events` but tracking the latency of each stage
+
+        :param Any cpu: unused arg required for callback
+        :param Any data: BPF raw event
+        :param Any size: unused arg required for callback
+        :param bool from_bpf: (optional, default=True) event generated by BPF code
+        """
+        start = monotonic_ns()
+        event = self.bpf['events'].event(data) if from_bpf else data
+        ktime = getattr(event, 'ktime', 0) if from_bpf else 0
+        stages = []
+        if ktime:
+            self._track_delay(start - ktime)
+            stages.append(('kernel', start - ktime))
+        event = self.enrich_event(event)
+        checkpoint = monotonic_ns()
+        stages.append(('enrich', checkpoint - start))
+        if event and self.novelty_filter:
+            event = event if self.novelty_filter.check(event) else None
+            now = monotonic_ns()
+            stages.append(('novelty', now - checkpoint))
+            checkpoint = now
+        if event:
+            self._add_event_metadata(event, ktime)
+            for event_plugin in self.plugins:
+                event = event_plugin.process(event)
+                now = monotonic_ns()
+                stages.append(('plugin_{}'.format(type(event_plugin).__name__.lower()), now - checkpoint))
+                checkpoint = now
+            if self.latency_tracer.sample():
+                event['_timing'] = {stage: value // 1000 for stage, value in stages}
+            lines = self._serialize_event(event)
+            now = monotonic_ns()
+            stages.append(('serialize', now - checkpoint))
+            for line in lines:
+                self.output_queue.put(line, self.probe_name)
+            stages.append(('queue_put', monotonic_ns() - now))
+        self.latency_tracer.record(stages)
+        if self.latency_tracer.report_due():
+            telemetry = {'type': 'latency_telemetry', 'stages': self.latency_tracer.report()}
+            self._add_event_metadata(telemetry)
+            self.output_queue.put(json.dumps(telemetry), self.probe_name)
+
+    def _track_delay(self, delay: int):
+        """ Update kernel -> userland delay stats
+
+        :param int delay: delay in nanoseconds
+        """
+        self.delay_count += 1
+        self.delay_total_ns += delay
+        self.delay_max_ns = max(self.delay_max_ns, delay)
+
+    def _record_and_process_events(self, cpu: Any, data: Any, size: Any):
+        """ BPF event callback recording raw events before processing them
+
+        :param Any cpu: unused arg required for callback
+        :param Any data: BPF raw event
+        :param Any size: raw event size
+        """
+        payload = ctypes.string_at(data, size)
+        # kernel timestamps make replay timing independent of userland processing delays
+        ktime_field = getattr(getattr(self, 'EVENT_STRUCT', None), 'ktime', None)
+        ktime = None
+        if ktime_field is not None and ktime_field.offset + ktime_field.size <= size:
+            ktime = ctypes.c_uint64.from_buffer_copy(payload, ktime_field.offset).value
+        self.RECORDER.record(self.probe_name, payload, ktime)
+        self._process_events(cpu, data, size)
+
+    @never_crash
+    def _recorder_flush_worker(self):
+        """ Handler function for the recorder flushing thread, so that records are written out during quiet periods """
+        while True:
+            time.sleep(self.RECORDER.FLUSH_INTERVAL)
+            self.RECORDER.flush()
+
+    def _add_event_metadata(self, event: dict, ktime: int = 0):
+        """ Adds probe name and timestamp to event dictionary (in place)
+
+        :param dict event: event dictionary
+        :param int ktime: (optional) kernel monotonic timestamp of the event,
+                          if not set the current time is used
+        """
+        event['timestamp'] = self.TIMESTAMP_FORMATTER.format(
+            self.CLOCK.to_wall_ns(ktime) if ktime else None,
+        )
         event['probe'] = self.probe_name
 
     def _lost_event_callback(self, lost_count: int):
@@ -105,30 +343,94 @@ class BPFProbe:
         """
         self.lost_event_count += lost_count
 
-    def _poll_and_check_lost(self):
-        """ Simple wrapper method which outputs lost event telemetry while polling """
-        self.bpf.perf_buffer_poll()
+    def _poll_and_check_lost(self, timeout: int = -1):
+        """ Simple wrapper method which outputs lost event telemetry while polling
+
+        :param int timeout: (optional) max milliseconds to wait for events, -1 to wait indefinitely
+        """
+        self.bpf.perf_buffer_poll(timeout)
         self.lost_event_timer -= 1
         if self.lost_event_timer == 0:
             self.lost_event_timer = self.lost_event_telemetry
             event = {'type': 'lost_event_telemetry', 'count': self.lost_event_count}
+            if self.delay_count:
+                event['delay_avg_us'] = self.delay_total_ns // self.delay_count // 1000
+                event['delay_max_us'] = self.delay_max_ns // 1000
+                self.delay_count = self.delay_total_ns = self.delay_max_ns = 0
             self._add_event_metadata(event)
-            self.output_queue.put(json.dumps(event))
+            self.output_queue.put(json.dumps(event), self.probe_name)
 
-    def start_polling(self):
-        """ Start infinite loop polling BPF events """
+    def attach(self) -> Callable[[int], None]:
+        """ Start sidecars, load the BPF program and open the event buffer
+
+        :return: function polling the event buffer, optionally accepting a timeout in milliseconds
+        """
         for func, args in self.SIDECARS:
             Thread(target=func, args=args, daemon=True).start()
+        import_start = time.perf_counter()
+        from bcc import BPF  # imported lazily as loading libbcc is expensive
+        compile_start = time.perf_counter()
         self.bpf = BPF(text=self.expanded_bpf_text)
+        attach_start = time.perf_counter()
+        if self.process_filter:
+            with self.process_filter_lock:
+                self.process_filter.apply(self.bpf)
+        if self.CHECKPOINT_DIR and os.path.exists(self.checkpoint_filename()):
+            # BPF programs are attached as soon as they are loaded: detach them while restoring,
+            # so that the kernel only traces restored sessions once their userland state is in place
+            self.detach()
+            self.restore_checkpoint()
+            self.bpf._trace_autoload()
         if self.lost_event_telemetry > 0:
             extra_args = {'lost_cb': self._lost_event_callback}
             poll_func = self._poll_and_check_lost
         else:
             extra_args = {}
             poll_func = self.bpf.perf_buffer_poll
-        self.bpf['events'].open_perf_buffer(self._process_events, **extra_args)
-        while True:
+        callback = self._record_and_process_events if self.RECORDER else self._process_events
+        self.bpf['events'].open_perf_buffer(callback, **extra_args)
+        if self.STARTUP_PROFILE:
+            log_startup_profile(self.probe_name, OrderedDict((
+                ('import', compile_start - import_start),
+                ('compile', attach_start - compile_start),
+                ('attach', time.perf_counter() - attach_start),
+            )))
+        return poll_func
+
+    def start_polling(self):
+        """ Start loop polling BPF events, until `stop` is invoked """
+        poll_func = self.attach()
+        while not self.stopping:
             poll_func()
+        self.drain()
+
+    def stop(self):
+        """ Make the polling loop exit and drain the event buffer. Safe to invoke from signal handlers,
+        as polling is interrupted by signals.
+        """
+        self.stopping = True
+
+    def detach(self):
+        """ Detach BPF programs from kernel functions, so that no more events are produced,
+        while keeping maps and event buffers open (to be used after `attach`)
+        """
+        for event in list(self.bpf.kprobe_fds):
+            self.bpf.detach_kprobe_event(event)
+        for tracepoint in list(self.bpf.tracepoint_fds):
+            self.bpf.detach_tracepoint(tracepoint)
+
+    def drain(self):
+        """ Detach BPF programs and process the events left in the event buffer (to be used after `attach`) """
+        self.detach()
+        self.bpf.perf_buffer_consume()
+
+    def event_fds(self) -> List[int]:
+        """ File descriptors of the open event buffers, to be used after `attach`
+
+        :return: list of file descriptors
+        """
+        from bcc import lib
+        return [lib.perf_reader_fd(reader) for reader in self.bpf.perf_buffers.values()]
 
     def enrich_event(self, event: Any) -> dict:
         """ Transform raw BPF event data into dictionary,
@@ -138,6 +440,218 @@ class BPFProbe:
         """
         raise NotImplementedError
 
+    def read_kernel_counters(self) -> Dict[str, int]:
+        """ Read in-kernel event counters, summing their per-CPU values (to be used after `attach`)
+
+        :return: counter values by name, empty if the BPF program does not define counters
+        """
+        try:
+            table = self.bpf['counters']
+        except KeyError:
+            return {}
+        return OrderedDict(
+            (name, table.sum(table.Key(index)).value)
+            for index, name in enumerate(self.KERNEL_COUNTERS)
+        )
+
+    @never_crash
+    def _novelty_summary_worker(self, interval: float):
+        """ Handler function for novelty filter telemetry thread, which also drops expired pairs
+
+        :param float interval: seconds between suppression summaries
+        """
+        while True:
+            time.sleep(interval)
+            summary = {'type': 'novelty_telemetry', **self.novelty_filter.summary()}
+            self._add_event_metadata(summary)
+            self.output_queue.put(json.dumps(summary), self.probe_name)
+
+    @never_crash
+    def _kernel_counters_worker(self, interval: int):
+        """ Handler function for kernel counters telemetry thread
+
+        :param int interval: seconds between telemetry events
+        """
+        while True:
+            time.sleep(interval)
+            if self.bpf is None:
+                continue
+            counters = self.read_kernel_counters()
+            if not counters:
+                return
+            event = {'type': 'kernel_counters_telemetry', 'counters': counters}
+            self._add_event_metadata(event)
+            self.output_queue.put(json.dumps(event), self.probe_name)
+
+    def flush_pending(self):
+        """ Output events for state still pending completion, e.g. on shutdown when
+        the state is not checkpointed. Probes tracking such state should override this.
+        """
+        pass
+
+    def checkpoint_filename(self) -> str:
+        """ Path of the probe checkpoint in the checkpoint directory """
+        return os.path.join(self.CHECKPOINT_DIR, '{}.checkpoint'.format(self.probe_name))
+
+    def write_checkpoint(self):
+        """ Save probe state to the checkpoint directory, so that it can be restored on the next start """
+        filename = self.checkpoint_filename()
+        write_checkpoint(filename, self.checkpoint_sections())
+        logging.info('Wrote checkpoint for {} to {}'.format(self.probe_name, filename))
+
+    def restore_checkpoint(self):
+        """ Restore probe state from the checkpoint directory, if a valid checkpoint exists.
+        The checkpoint is removed in any case, so that it is never restored twice.
+        """
+        filename = self.checkpoint_filename()
+        if not os.path.exists(filename):
+            return
+        try:
+            self.restore_sections(read_checkpoint(filename))
+        except Exception as e:
+            # a broken checkpoint must never prevent the probe from starting
+            logging.warning('Ignoring checkpoint {}, starting cold: {!r}'.format(filename, e))
+        finally:
+            os.unlink(filename)
+
+    def checkpoint_sections(self) -> Dict[str, bytes]:
+        """ Serialize probe state into checkpoint sections.
+        Probes with more state to save should extend this and `restore_sections`.
+
+        :return: section payloads by name
+        """
+        cache = get_ancestry_cache()
+        sections = OrderedDict()
+        if hasattr(cache, 'dump'):
+            # the monotonic clock is system wide, and checkpoints are only restored within the same boot
+            now = time.monotonic()
+            entries = cache.dump()
+            for entry in entries:
+                entry['stored_at'] = now - entry.pop('age')
+            sections['ancestry'] = json.dumps(entries).encode()
+        return sections
+
+    def restore_sections(self, sections: Mapping[str, bytes]):
+        """ Restore probe state from checkpoint sections.
+        Entries are only restored if still valid, i.e. processes are still running
+        with the same start time and cache entries are not expired in the meantime.
+
+        :param Mapping[str, bytes] sections: section payloads by name
+        """
+        cache = get_ancestry_cache()
+        if 'ancestry' not in sections or cache is None:
+            return
+        now = time.monotonic()
+        restored = 0
+        for entry in json.loads(sections['ancestry'].decode()):
+            if now - entry['stored_at'] >= cache.ttl or not process_matches(entry['pid'], entry['start_time']):
+                continue
+            # entries keep their original age, so that they expire as if the probe was never restarted
+            cache.put((entry['pid'], entry['start_time']), entry['info'], entry['ppid'], entry['stored_at'])
+            restored += 1
+        logging.info('Restored {} ancestry cache entries for {}'.format(restored, self.probe_name))
+
+    def enable_control(self) -> Connection:
+        """ Open a control channel, served by a sidecar thread.
+        Must be invoked before the probe process is forked.
+
+        :return: main process end of the channel
+        """
+        connection, probe_connection = Pipe()
+        self.SIDECARS.append((serve_probe_control, (probe_connection, self.handle_control)))
+        return connection
+
+    def handle_control(self, command: str, args: List[str]) -> Any:
+        """ Execute a command received from the control socket.
+        Probes accepting more commands should extend this and `CONTROL_COMMANDS`.
+
+        :param str command: command name
+        :param List[str] args: command arguments
+        :return: command result, must be JSON serializable
+        """
+        if command == 'stats':
+            cache = get_ancestry_cache()
+            stats = OrderedDict((
+                ('lost_events', self.lost_event_count),
+                ('ancestry_cache', cache.stats() if hasattr(cache, 'stats') else None),
+            ))
+            if self.bpf is not None:
+                stats['kernel_counters'] = self.read_kernel_counters()
+            if self.novelty_filter:
+                stats['novelty_filter'] = {
+                    'suppressed': self.novelty_filter.suppressed,
+                    'tracked': len(self.novelty_filter.expirations),
+                }
+            if self.latency_tracer:
+                # includes timings of each plugin
+                stats['latency'] = self.latency_tracer.summary()
+            return stats
+        if command == 'cache':
+            cache = get_ancestry_cache()
+            if not hasattr(cache, 'dump'):
+                raise ValueError('Ancestry cache not enabled or not supporting listing entries')
+            entries = cache.dump()
+            if args:
+                pid = int(args[0])
+                entries = [entry for entry in entries if entry['pid'] == pid]
+            return entries
+        if command == 'reload-filters':
+            if not self.process_filter_file:
+                raise ValueError('No process filter file configured for {}'.format(self.probe_name))
+            self.update_process_filters(self._read_process_filter_rules({'file': self.process_filter_file}))
+            return 'reloaded'
+        raise ValueError('Unknown command {}'.format(command))
+
+    def update_process_filters(self, rules: dict):
+        """ Replace process allow and deny lists, without reloading the BPF program.
+        Only criteria which were present in the configuration at startup can be used.
+
+        :param dict rules: allow and deny lists, in the format accepted by `ProcessFilter`
+        """
+        if self.process_filter is None:
+            raise ValueError('Process filtering is not enabled for {}'.format(self.probe_name))
+        process_filter = ProcessFilter(rules)
+        missing = process_filter.criteria - self.process_filter.criteria
+        if missing:
+            raise ValueError(
+                'Process filter criteria not enabled at startup for {}: {}'
+                .format(self.probe_name, ', '.join(sorted(missing))),
+            )
+        process_filter.criteria = self.process_filter.criteria
+        with self.process_filter_lock:
+            if self.bpf is not None:
+                process_filter.apply(self.bpf, self.process_filter)
+            self.process_filter = process_filter
+        logging.info('Updated process filters for {}'.format(self.probe_name))
+
+    @staticmethod
+    def _read_process_filter_rules(config: dict) -> dict:
+        """ Get process filter rules from probe configuration
+
+        :param dict config: `process_filters` probe configuration
+        :return: allow and deny lists, read from file if `file` is set
+        """
+        if not config.get('file'):
+            return config
+        import yaml
+        with open(config['file']) as f:
+            return yaml.safe_load(f) or {}
+
+    @never_crash
+    def _process_filter_worker(self, filename: str):
+        """ Handler function for process filter reloading thread.
+        Updates process filters whenever the rules file is modified.
+
+        :param str filename: path to process filter rules file
+        """
+        last_modified = os.stat(filename).st_mtime
+        while True:
+            time.sleep(self.PROCESS_FILTER_CHECK_INTERVAL)
+            modified = os.stat(filename).st_mtime
+            if modified != last_modified:
+                last_modified = modified
+                self.update_process_filters(self._read_process_filter_rules({'file': filename}))
+
     def validate_config(self, config: dict):
         """ Overridable method to implement config validation.
         Should raise exceptions on errors.
@@ -147,29 +661,93 @@ class BPFProbe:
         pass
 
 
+def poll_probes(probes: Iterable[BPFProbe]):
+    """ Poll events for multiple probes from a single event loop.
+
+    All probes are attached in the calling process, and their event buffer
+    file descriptors are watched with epoll: events are consumed only for the
+    probes which have data ready.
+
+    :param Iterable[BPFProbe] probes: probes to poll, until any of them is stopped
+    """
+    probes = list(probes)
+    poller = select.epoll()
+    poll_funcs = {}
+    for probe in probes:
+        poll_func = probe.attach()
+        for fd in probe.event_fds():
+            poller.register(fd, select.EPOLLIN)
+            poll_funcs[fd] = poll_func
+    while not any(probe.stopping for probe in probes):
+        # epoll is transparently retried after signal handlers, so stopping is only noticed on timeout
+        ready = {poll_funcs[fd] for fd, _ in poller.poll(STOP_CHECK_INTERVAL)}
+        for poll_func in ready:
+            poll_func(0)
+    for probe in probes:
+        probe.drain()
+
+
 def load_probes(
     config: dict,
-    output_queue: SimpleQueue,
+    output_queue: OutputQueue,
     extra_probe_path: str = None,
     extra_plugin_path: str = None,
     lost_event_telemetry: int = -1,
+    recorder: EventRecorder = None,
+    share_plugins: bool = False,
+    startup_profile: bool = False,
+    timestamp_format: str = 'iso',
+    latency_report_interval: float = 0,
+    latency_sample_rate: int = 0,
+    process_interning_interval: float = 0,
+    cmdline_max_length: int = 0,
+    kernel_counters_interval: int = 0,
+    checkpoint_dir: str = None,
 ) -> Mapping[str, BPFProbe]:
     """ Find and load probe classes
 
     :param dict config: pidtree-bcc configuration
-    :param Queue output_queue: queue for event output
+    :param OutputQueue output_queue: queue for event output
     :param str extra_probe_path: (optional) additional package path where to look for probes
     :param str extra_probe_path: (optional) additional package path where to look for plugins
     :param int lost_event_telemetry: (optional) every how many messages emit the number of lost messages.
+    :param EventRecorder recorder: (optional) recorder for raw BPF events
+    :param bool share_plugins: (optional) share plugin instances with identical configuration among probes
+    :param bool startup_profile: (optional) time the startup stages of each probe
+    :param str timestamp_format: (optional) event timestamp format, `iso` or `epoch_ns`
+    :param float latency_report_interval: (optional) if > 0, trace latency of event processing stages
+                                          and report it every this many seconds
+    :param int latency_sample_rate: (optional) add stage timings to 1 every this many events
+    :param float process_interning_interval: (optional) if > 0, output process information as separate
+                                             records referenced by events, re-emitted every this many seconds
+    :param int cmdline_max_length: (optional) if > 0, truncate command lines to this length
+    :param int kernel_counters_interval: (optional) if > 0, output in-kernel event counters every this many seconds
+    :param str checkpoint_dir: (optional) directory where probe state is saved on shutdown and restored on start
     :return: dictionary mapping probe name to its instance
     """
     BPFProbe.EXTRA_PLUGIN_PATH = extra_plugin_path
+    BPFProbe.RECORDER = recorder
+    BPFProbe.PLUGIN_CACHE = {} if share_plugins else None
+    BPFProbe.STARTUP_PROFILE = startup_profile
+    BPFProbe.TIMESTAMP_FORMATTER = TimestampFormatter(timestamp_format)
+    BPFProbe.LATENCY_REPORT_INTERVAL = latency_report_interval
+    BPFProbe.LATENCY_SAMPLE_RATE = latency_sample_rate
+    BPFProbe.PROCESS_INTERNING_INTERVAL = process_interning_interval
+    BPFProbe.CMDLINE_MAX_LENGTH = cmdline_max_length
+    BPFProbe.KERNEL_COUNTERS_INTERVAL = kernel_counters_interval
+    BPFProbe.CHECKPOINT_DIR = checkpoint_dir
     packages = [p for p in (__package__, extra_probe_path) if p]
-    return {
-        probe_name: find_subclass(
-            ['{}.{}'.format(p, probe_name) for p in packages],
-            BPFProbe,
-        )(output_queue, probe_config, lost_event_telemetry)
-        for probe_name, probe_config in config.items()
-        if not probe_name.startswith('_')
-    }
+    probes = {}
+    for probe_name, probe_config in config.items():
+        if probe_name.startswith('_'):
+            continue
+        import_start = time.perf_counter()
+        probe_class = find_subclass(['{}.{}'.format(p, probe_name) for p in packages], BPFProbe)
+        import_time = time.perf_counter() - import_start
+        probes[probe_name] = probe_class(output_queue, probe_config, lost_event_telemetry)
+        probes[probe_name].startup_timings['import'] = import_time
+        probes[probe_name].startup_timings.move_to_end('import', last=False)
+        output_queue.register_producer(probes[probe_name].probe_name, probe_config.get('queue_priority', 0))
+    if recorder:
+        recorder.write_header([probe.probe_name for probe in probes.values()])
+    return probes
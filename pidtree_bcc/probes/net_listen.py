@@ -1,16 +1,28 @@
+import ctypes
 import inspect
+import logging
 import socket
 import time
 import traceback
 from collections import namedtuple
 from itertools import chain
-from multiprocessing import SimpleQueue
+from threading import Lock
 from typing import Any
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import Set
+from typing import Tuple
 
 import psutil
 
 from pidtree_bcc.filtering import NetFilter
+from pidtree_bcc.output_queue import OutputQueue
 from pidtree_bcc.probes import BPFProbe
+from pidtree_bcc.procfs import ProcfsError
+from pidtree_bcc.sock_diag import list_listening_sockets
+from pidtree_bcc.sock_diag import SockDiagError
+from pidtree_bcc.sock_diag import SocketInodeResolver
 from pidtree_bcc.utils import crawl_process_tree
 from pidtree_bcc.utils import get_network_namespace
 from pidtree_bcc.utils import int_to_ip
@@ -18,11 +30,24 @@ from pidtree_bcc.utils import ip_to_int
 from pidtree_bcc.utils import never_crash
 
 
-NetListenWrapper = namedtuple('NetListenWrapper', ('pid', 'laddr', 'port', 'protocol'))
+NetListenWrapper = namedtuple('NetListenWrapper', ('pid', 'laddr', 'port', 'protocol', 'type'))
+NetListenWrapper.__new__.__defaults__ = (1,)  # NetListenProbe.LISTEN_EVENT
 
 
 class NetListenProbe(BPFProbe):
 
+    class EVENT_STRUCT(ctypes.Structure):
+        _fields_ = (
+            ('pid', ctypes.c_uint32),
+            ('laddr', ctypes.c_uint32),
+            ('port', ctypes.c_uint16),
+            ('protocol', ctypes.c_uint8),
+            ('type', ctypes.c_uint8),
+            ('cgroup_id', ctypes.c_uint64),
+            ('sock_pointer', ctypes.c_uint64),
+            ('ktime', ctypes.c_uint64),
+        )
+
     PROTO_MAP = {
         value: name.split('_')[1].lower()
         for name, value in inspect.getmembers(socket)
@@ -35,12 +60,18 @@ class NetListenProbe(BPFProbe):
         'excludeports': [],
         'includeports': [],
         'snapshot_periodicity': False,
+        'incremental_snapshot_periodicity': False,
         'same_namespace_only': False,
         'exclude_random_bind': False,
+        'capture_cgroup_id': False,
+        'listener_tracking': False,
     }
+    CONTROL_COMMANDS = BPFProbe.CONTROL_COMMANDS + ('listeners', 'snapshot')
     SUPPORTED_PROTOCOLS = ('udp', 'tcp')
+    LISTEN_EVENT = 1
+    CLOSE_EVENT = 2
 
-    def __init__(self, output_queue: SimpleQueue, config: dict = {}, *args, **kwargs):
+    def __init__(self, output_queue: OutputQueue, config: dict = {}, *args, **kwargs):
         config = {**self.CONFIG_DEFAULTS, **config}
         config['net_namespace'] = get_network_namespace() if config['same_namespace_only'] else None
         self.net_namespace = config['net_namespace']
@@ -65,10 +96,17 @@ class NetListenProbe(BPFProbe):
                 ),
             )
             self.port_filter = lambda port: port not in excludeports
-        if config['snapshot_periodicity'] and config['snapshot_periodicity'] > 0:
+        self.listener_tracking = config['listener_tracking']
+        self.listener_table = {}
+        self.listener_table_lock = Lock()
+        self.use_sock_diag = True
+        self.inode_resolver = SocketInodeResolver()
+        periodicity = config['snapshot_periodicity'] or 0
+        incremental_periodicity = config['incremental_snapshot_periodicity'] or 0
+        if periodicity > 0 or incremental_periodicity > 0:
             self.SIDECARS.append((
                 self._snapshot_worker,
-                (config['snapshot_periodicity'],),
+                (periodicity, incremental_periodicity),
             ))
 
     def validate_config(self, config: dict):
@@ -80,19 +118,33 @@ class NetListenProbe(BPFProbe):
                     .format(proto, self.SUPPORTED_PROTOCOLS),
                 )
 
+    def attach(self) -> Callable[[int], None]:
+        """ Load BPF program and seed the listener table with a snapshot, if tracking is enabled """
+        poll_func = super().attach()
+        if self.listener_tracking:
+            self._reconcile_listener_table()
+        return poll_func
+
     def enrich_event(self, event: Any) -> dict:
         """ Parses network "listen event" and adds process tree data
 
         :param Any event: BPF event
         :return: event dictionary with process tree
         """
+        # only events coming from BPF carry the socket pointer
+        sock_pointer = getattr(event, 'sock_pointer', None) if self.listener_tracking else None
+        if sock_pointer and event.type == self.CLOSE_EVENT:
+            return self._untrack_listener(event)
         error = ''
         try:
-            proctree = crawl_process_tree(event.pid)
+            proctree = crawl_process_tree(event.pid, **self.proctree_options)
+        except ProcfsError as e:
+            error = str(e)
+            proctree = []
         except Exception:
             error = traceback.format_exc()
             proctree = []
-        return {
+        event_dict = {
             'pid': event.pid,
             'port': event.port,
             'proctree': proctree,
@@ -100,6 +152,113 @@ class NetListenProbe(BPFProbe):
             'protocol': self.PROTO_MAP.get(event.protocol, 'unknown'),
             'error': error,
         }
+        if getattr(event, 'type', self.LISTEN_EVENT) == self.CLOSE_EVENT:
+            event_dict['type'] = 'close'
+        if self.capture_cgroup_id and hasattr(event, 'cgroup_id'):
+            # events generated from snapshots do not carry cgroup information
+            event_dict['cgroup_id'] = event.cgroup_id
+        if sock_pointer:
+            self._track_listener(sock_pointer, event_dict)
+        return event_dict
+
+    def get_listeners(self) -> List[dict]:
+        """ Get the current listeners (requires `listener_tracking` to be enabled)
+
+        :return: list of listener info dictionaries
+        """
+        with self.listener_table_lock:
+            return [dict(listener) for listener in self.listener_table.values()]
+
+    def handle_control(self, command: str, args: List[str]) -> Any:
+        """ Adds the `listeners` command, listing the current listeners (with process
+        information only if `listener_tracking` is enabled), and the `snapshot` one,
+        outputting a full snapshot of the listeners right away.
+        """
+        if command == 'listeners':
+            if self.listener_tracking:
+                return self.get_listeners()
+            return [
+                {
+                    'pid': listener.pid,
+                    'port': listener.port,
+                    'laddr': int_to_ip(listener.laddr),
+                    'protocol': self.PROTO_MAP.get(listener.protocol, 'unknown'),
+                }
+                for listener, _ in self._get_listeners()
+            ]
+        if command == 'snapshot':
+            listeners = self._get_listeners()
+            for listener, _ in listeners:
+                self._process_events(None, listener, None, False)
+            return len(listeners)
+        return super().handle_control(command, args)
+
+    def _track_listener(self, sock_pointer: int, event: dict):
+        """ Add listener to the tracking table
+
+        :param int sock_pointer: kernel socket address
+        :param dict event: listen event dictionary
+        """
+        listener = {**event, 'proctree': [dict(proc) for proc in event['proctree']]}
+        with self.listener_table_lock:
+            self.listener_table[sock_pointer] = listener
+            # drop duplicate entry in case the listener was also picked up by the startup snapshot
+            self._pop_snapshot_listener(listener, match_pid=True)
+
+    def _untrack_listener(self, event: Any) -> dict:
+        """ Remove listener from the tracking table, generating close event
+
+        :param Any event: BPF close event
+        :return: close event dictionary
+        """
+        with self.listener_table_lock:
+            listener = self.listener_table.pop(event.sock_pointer, None)
+            if listener is None:
+                listener = self._pop_snapshot_listener({
+                    'pid': event.pid,
+                    'port': event.port,
+                    'laddr': int_to_ip(event.laddr),
+                    'protocol': self.PROTO_MAP.get(event.protocol, 'unknown'),
+                })
+        if listener is None or 'proctree' not in listener:
+            listener = self.enrich_event(NetListenWrapper(
+                listener['pid'] if listener else event.pid,
+                event.laddr,
+                event.port,
+                event.protocol,
+            ))
+        listener['type'] = 'close'
+        return listener
+
+    def _pop_snapshot_listener(self, listener: dict, match_pid: bool = False) -> dict:
+        """ Remove from the tracking table a listener found by the startup snapshot
+
+        :param dict listener: listener info
+        :param bool match_pid: if the PID of the listener should also match
+        :return: removed listener info, if any
+        """
+        for key, value in self.listener_table.items():
+            if (
+                isinstance(key, tuple)
+                and value['port'] == listener['port']
+                and value['laddr'] == listener['laddr']
+                and value['protocol'] == listener['protocol']
+                and (not match_pid or value['pid'] == listener['pid'])
+            ):
+                return self.listener_table.pop(key)
+        return None
+
+    def _reconcile_listener_table(self):
+        """ Seed the tracking table with the listeners existing before the BPF probe was loaded """
+        listeners = self._get_listeners()
+        with self.listener_table_lock:
+            for listener, inode in listeners:
+                self.listener_table[('snapshot', inode) + tuple(listener)] = {
+                    'pid': listener.pid,
+                    'port': listener.port,
+                    'laddr': int_to_ip(listener.laddr),
+                    'protocol': self.PROTO_MAP.get(listener.protocol, 'unknown'),
+                }
 
     def _filter_net_namespace(self, pid: int) -> bool:
         """ Check if network namespace for process is filtered
@@ -112,37 +271,73 @@ class NetListenProbe(BPFProbe):
         net_ns = get_network_namespace(pid)
         return net_ns and net_ns != self.net_namespace
 
+    def _get_listeners(self) -> Set[Tuple[NetListenWrapper, int]]:
+        """ Get the current listening sockets passing the probe filters.
+
+        Sockets are listed via netlink sock_diag, falling back to psutil
+        if that is not supported by the running kernel.
+
+        :return: set of listener info and socket inode pairs
+        """
+        entries = None
+        if self.use_sock_diag:
+            try:
+                sockets = list_listening_sockets(self.log_tcp, self.log_udp)
+                pids = self.inode_resolver.resolve(sockets)
+                entries = [(s.protocol, s.laddr, s.port, s.inode, pids.get(s.inode)) for s in sockets]
+            except (OSError, SockDiagError) as e:
+                logging.warning('Listing sockets via sock_diag failed, falling back to psutil: {}'.format(e))
+                self.use_sock_diag = False
+        if entries is None:
+            entries = self._get_psutil_listeners()
+        return {
+            (NetListenWrapper(pid, laddr, port, protocol), inode)
+            for protocol, laddr, port, inode, pid in entries
+            if pid  # filter out entries without associated PID
+            and not self.filtering.is_filtered(laddr, port)
+            and self.port_filter(port)
+            and not self._filter_net_namespace(pid)
+        }
+
+    def _get_psutil_listeners(self) -> Iterable[Tuple[int, int, int, int, int]]:
+        """ List listening sockets with psutil
+
+        :return: yields protocol, local address, port, inode (always 0) and PID
+        """
+        for conn in psutil.net_connections('inet4'):
+            if self.log_tcp and conn.status == 'LISTEN':
+                protocol = socket.IPPROTO_TCP
+            elif self.log_udp and conn.status == 'NONE' and conn.type == socket.SOCK_DGRAM:
+                protocol = socket.IPPROTO_UDP
+            else:
+                continue
+            yield protocol, ip_to_int(conn.laddr.ip), conn.laddr.port, 0, conn.pid
+
     @never_crash
-    def _snapshot_worker(self, periodicity: int):
+    def _snapshot_worker(self, periodicity: int, incremental_periodicity: int = 0):
         """ Handler function for snapshot thread.
 
-        :param int periodicity: how many seconds to wait between snapshots
+        Full snapshots output all listening processes. In incremental mode, only
+        listeners added or removed since the previous snapshot are output, and
+        full snapshots are only taken on startup and every `periodicity` seconds.
+
+        :param int periodicity: how many seconds to wait between full snapshots
+        :param int incremental_periodicity: how many seconds to wait between incremental snapshots
         """
         time.sleep(300)  # sleep 5 minutes to avoid "noisy" restarts
+        previous = None
+        next_full_snapshot = 0
         while True:
-            socket_stats = psutil.net_connections('inet4')
-            for conn in socket_stats:
-                if not conn.pid:
-                    # filter out entries without associated PID
-                    continue
-                if self.log_tcp and conn.status == 'LISTEN':
-                    protocol = socket.IPPROTO_TCP
-                elif self.log_udp and conn.status == 'NONE' and conn.type == socket.SOCK_DGRAM:
-                    protocol = socket.IPPROTO_UDP
-                else:
-                    protocol = None
-                ip_addr = ip_to_int(conn.laddr.ip)
-                if (
-                    protocol
-                    and not self.filtering.is_filtered(ip_addr, conn.laddr.port)
-                    and self.port_filter(conn.laddr.port)
-                    and not self._filter_net_namespace(conn.pid)
-                ):
-                    event = NetListenWrapper(
-                        conn.pid,
-                        ip_addr,
-                        conn.laddr.port,
-                        protocol,
-                    )
-                    self._process_events(None, event, None, False)
-            time.sleep(periodicity)
+            listeners = self._get_listeners()
+            now = time.monotonic()
+            if previous is None or (periodicity > 0 and now >= next_full_snapshot):
+                next_full_snapshot = now + periodicity
+                added, removed = listeners, ()
+            else:
+                added, removed = listeners - previous, previous - listeners
+            for listener, _ in added:
+                self._process_events(None, listener, None, False)
+            for listener, _ in removed:
+                self._process_events(None, listener._replace(type=self.CLOSE_EVENT), None, False)
+            previous = listeners
+            time.sleep(incremental_periodicity or periodicity)
@@ -1,7 +1,9 @@
+import ctypes
 import traceback
 from typing import Any
 
 from pidtree_bcc.probes import BPFProbe
+from pidtree_bcc.procfs import ProcfsError
 from pidtree_bcc.utils import crawl_process_tree
 from pidtree_bcc.utils import int_to_ip
 from pidtree_bcc.utils import ip_to_int
@@ -9,11 +11,22 @@ from pidtree_bcc.utils import ip_to_int
 
 class TCPConnectProbe(BPFProbe):
 
+    class EVENT_STRUCT(ctypes.Structure):
+        _fields_ = (
+            ('pid', ctypes.c_uint32),
+            ('daddr', ctypes.c_uint32),
+            ('saddr', ctypes.c_uint32),
+            ('dport', ctypes.c_uint16),
+            ('cgroup_id', ctypes.c_uint64),
+            ('ktime', ctypes.c_uint64),
+        )
+
     CONFIG_DEFAULTS = {
         'ip_to_int': ip_to_int,
         'filters': [],
         'includeports': [],
         'excludeports': [],
+        'capture_cgroup_id': False,
     }
 
     def enrich_event(self, event: Any) -> dict:
@@ -24,11 +37,14 @@ class TCPConnectProbe(BPFProbe):
         """
         error = ''
         try:
-            proctree = crawl_process_tree(event.pid)
+            proctree = crawl_process_tree(event.pid, **self.proctree_options)
+        except ProcfsError as e:
+            error = str(e)
+            proctree = []
         except Exception:
             error = traceback.format_exc()
             proctree = []
-        return {
+        event_dict = {
             'pid': event.pid,
             'proctree': proctree,
             # We're turning a little-endian insigned long ('<L')
@@ -40,3 +56,6 @@ class TCPConnectProbe(BPFProbe):
             'port': event.dport,
             'error': error,
         }
+        if self.capture_cgroup_id:
+            event_dict['cgroup_id'] = event.cgroup_id
+        return event_dict
@@ -1,16 +1,29 @@
+import ctypes
+import json
+import logging
 import time
 import traceback
 from collections import namedtuple
-from multiprocessing import SimpleQueue
+from collections import OrderedDict
 from threading import Lock
 from typing import Any
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Tuple
 from typing import Union
 
+from pidtree_bcc.checkpoint import pack_pointers
+from pidtree_bcc.checkpoint import unpack_pointers
+from pidtree_bcc.output_queue import OutputQueue
 from pidtree_bcc.probes import BPFProbe
+from pidtree_bcc.procfs import PROCFS
+from pidtree_bcc.procfs import ProcfsError
 from pidtree_bcc.utils import crawl_process_tree
 from pidtree_bcc.utils import int_to_ip
 from pidtree_bcc.utils import ip_to_int
 from pidtree_bcc.utils import never_crash
+from pidtree_bcc.utils import process_matches
 
 
 SessionEventWrapper = namedtuple('SessionEndEvent', ('type', 'sock_pointer'))
@@ -18,18 +31,31 @@ SessionEventWrapper = namedtuple('SessionEndEvent', ('type', 'sock_pointer'))
 
 class UDPSessionProbe(BPFProbe):
 
+    class EVENT_STRUCT(ctypes.Structure):
+        _fields_ = (
+            ('type', ctypes.c_uint8),
+            ('pid', ctypes.c_uint32),
+            ('sock_pointer', ctypes.c_uint64),
+            ('daddr', ctypes.c_uint32),
+            ('dport', ctypes.c_uint16),
+            ('cgroup_id', ctypes.c_uint64),
+            ('ktime', ctypes.c_uint64),
+        )
+
     CONFIG_DEFAULTS = {
         'ip_to_int': ip_to_int,
         'filters': [],
         'includeports': [],
         'excludeports': [],
+        'capture_cgroup_id': False,
     }
+    CONTROL_COMMANDS = BPFProbe.CONTROL_COMMANDS + ('sessions',)
     SESSION_MAX_DURATION_DEFAULT = 120
     SESSION_START = 1
     SESSION_CONTINUE = 2
     SESSION_END = 3
 
-    def __init__(self, output_queue: SimpleQueue, config: dict = {}, *args, **kwargs):
+    def __init__(self, output_queue: OutputQueue, config: dict = {}, *args, **kwargs):
         super().__init__(output_queue, config, *args, **kwargs)
         self.session_tracking = {}
         self.thread_lock = Lock()
@@ -54,7 +80,10 @@ class UDPSessionProbe(BPFProbe):
         if event.type == self.SESSION_START:
             try:
                 error = ''
-                proctree = crawl_process_tree(event.pid)
+                proctree = crawl_process_tree(event.pid, **self.proctree_options)
+            except ProcfsError as e:
+                error = str(e)
+                proctree = []
             except Exception:
                 error = traceback.format_exc()
                 proctree = []
@@ -65,6 +94,8 @@ class UDPSessionProbe(BPFProbe):
                 'error': error,
                 'last_update': now,
             }
+            if self.capture_cgroup_id:
+                self.session_tracking[sock_key]['cgroup_id'] = event.cgroup_id
         elif sock_key in self.session_tracking:
             if event.type == self.SESSION_CONTINUE:
                 dest_key = (event.daddr, event.dport)
@@ -77,16 +108,106 @@ class UDPSessionProbe(BPFProbe):
             else:
                 session_data = self.session_tracking.pop(sock_key)
                 session_data.pop('last_update')
-                session_data['destinations'] = [
-                    {
-                        'daddr': int_to_ip(addr_port[0]),
-                        'port': addr_port[1],
-                        'duration': now - begin_count[0],
-                        'msg_count': begin_count[1],
-                    }
+                session_data['destinations'] = self._serialize_destinations(session_data['destinations'], now)
+                return session_data
+
+    def handle_control(self, command: str, args: List[str]) -> Any:
+        """ Adds the `sessions` command, listing the sessions currently tracked """
+        if command != 'sessions':
+            return super().handle_control(command, args)
+        now = time.monotonic()
+        sessions = []
+        with self.thread_lock:
+            for session_data in self.session_tracking.values():
+                session = dict(session_data)
+                session['destinations'] = self._serialize_destinations(session['destinations'], now)
+                session['idle'] = now - session.pop('last_update')
+                sessions.append(session)
+        return sessions
+
+    def flush_pending(self):
+        """ Outputs sessions still being tracked, as they would be lost otherwise """
+        with self.thread_lock:
+            sock_pointers = list(self.session_tracking)
+            for session_data in self.session_tracking.values():
+                session_data['error'] = session_data['error'] or 'session_in_progress_at_shutdown'
+        for sock_pointer in sock_pointers:
+            end_event = SessionEventWrapper(self.SESSION_END, sock_pointer)
+            self._process_events(None, end_event, None, False)
+
+    def checkpoint_sections(self) -> Dict[str, bytes]:
+        """ Adds tracked sessions, along with the start time of their processes, and the
+        socket pointers in the kernel `tracing` map, so that sessions are not split in two
+        by a restart (i.e. the first message after the restart is not seen as a new session).
+        """
+        sections = super().checkpoint_sections()
+        now = time.monotonic()
+        sessions = []
+        with self.thread_lock:
+            for sock_pointer, session_data in self.session_tracking.items():
+                try:
+                    _, start_time, _ = PROCFS.read_stat(session_data['pid'])
+                except ProcfsError:
+                    continue
+                session = {k: v for k, v in session_data.items() if k not in ('destinations', 'last_update')}
+                session['sock_pointer'] = sock_pointer
+                session['start_time'] = start_time
+                session['idle'] = now - session_data['last_update']
+                session['destinations'] = [
+                    [addr_port[0], addr_port[1], now - begin_count[0], begin_count[1]]
                     for addr_port, begin_count in session_data['destinations'].items()
                 ]
-                return session_data
+                sessions.append(session)
+        sections['sessions'] = json.dumps(sessions).encode()
+        if self.bpf is not None:
+            sections['tracing'] = pack_pointers(key.value for key in self.bpf['tracing'].keys())
+        return sections
+
+    def restore_sections(self, sections: Mapping[str, bytes]):
+        """ Restores sessions whose process is still running, and marks their sockets as traced in the kernel.
+        Sockets closed while the probe was not running cannot be told apart from new sockets
+        allocated at the same address, so traced sockets without a valid session are dropped.
+        """
+        super().restore_sections(sections)
+        now = time.monotonic()
+        restored = OrderedDict()
+        with self.thread_lock:
+            for session in json.loads(sections.get('sessions', b'[]').decode()):
+                if not process_matches(session['pid'], session.pop('start_time')):
+                    continue
+                sock_pointer = session.pop('sock_pointer')
+                session['last_update'] = now - session.pop('idle')
+                session['destinations'] = {
+                    (daddr, dport): [now - duration, msg_count]
+                    for daddr, dport, duration, msg_count in session['destinations']
+                }
+                restored[sock_pointer] = session
+            self.session_tracking.update(restored)
+        traced = set(unpack_pointers(sections.get('tracing', b'')))
+        if self.bpf is not None:
+            table = self.bpf['tracing']
+            for sock_pointer in restored:
+                if sock_pointer in traced:
+                    table[table.Key(sock_pointer)] = table.Leaf(self.SESSION_START)
+        logging.info('Restored {} UDP sessions'.format(len(restored)))
+
+    @staticmethod
+    def _serialize_destinations(destinations: Dict[Tuple[int, int], List], now: float) -> List[dict]:
+        """ Convert tracked session destinations to event format
+
+        :param Dict[Tuple[int, int], List] destinations: first message time and message count by address and port
+        :param float now: current monotonic time
+        :return: list of destination dictionaries
+        """
+        return [
+            {
+                'daddr': int_to_ip(addr_port[0]),
+                'port': addr_port[1],
+                'duration': now - begin_count[0],
+                'msg_count': begin_count[1],
+            }
+            for addr_port, begin_count in destinations.items()
+        ]
 
     @never_crash
     def _session_expiration_worker(self, session_max_duration: int):
@@ -0,0 +1,158 @@
+import errno
+import os
+import pwd
+import threading
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+
+PROC_ROOT = '/proc'
+BUFFER_SIZE = 4096
+# errors meaning that the process exited while it was being inspected
+GONE_ERRNOS = (errno.ENOENT, errno.ESRCH)
+
+
+class ProcfsError(Exception):
+    pass
+
+
+class ProcessGoneError(ProcfsError):
+    pass
+
+
+class ProcfsReader(threading.local):
+    """ Reads process information directly from procfs.
+
+    Compared to `psutil`, only the files actually needed are read, with a buffer
+    allocated once and parsed in place: `stat` for parent PID and start time, and,
+    only for processes missing from the ancestry cache, `cmdline` and `status`
+    (for the real UID). Being a thread-local object, each thread gets its own buffer.
+    """
+
+    def __init__(self, root: str = PROC_ROOT, buffer_size: int = BUFFER_SIZE):
+        """ Constructor
+
+        :param str root: (optional) procfs mount point
+        :param int buffer_size: (optional) size of the read buffer, larger files are read in multiple chunks
+        """
+        self.root = root
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.boot_time = None  # type: float
+        self.usernames = {}  # type: Dict[int, str]
+
+    def read_stat(self, pid: int) -> Tuple[int, float, str]:
+        """ Read parent PID, start time and command name of a process
+
+        :param int pid: process ID
+        :return: parent PID, start time (seconds since epoch, as reported by `psutil`) and command name
+        """
+        if self.boot_time is None:
+            self.boot_time = self._read_boot_time()
+        data = self._read(pid, 'stat')
+        # the command name is enclosed in parentheses and may contain spaces or parentheses
+        comm_end = data.rfind(b')')
+        fields = data[comm_end + 2:].split(None, 20)
+        try:
+            return (
+                int(fields[1]),
+                self.boot_time + int(fields[19]) / self.clock_ticks,
+                os.fsdecode(data[data.index(b'(') + 1:comm_end]),
+            )
+        except (IndexError, ValueError):
+            raise ProcfsError('Malformed stat file for process {}'.format(pid))
+
+    def read_cmdline(self, pid: int) -> str:
+        """ Read command line of a process
+
+        :param int pid: process ID
+        :return: command line, with arguments separated by spaces
+        """
+        data = self._read(pid, 'cmdline')
+        if data.endswith(b'\0'):
+            data = data[:-1]
+        return os.fsdecode(data.replace(b'\0', b' '))
+
+    def read_uid(self, pid: int) -> int:
+        """ Read real user ID of a process
+
+        :param int pid: process ID
+        :return: user ID
+        """
+        data = self._read(pid, 'status')
+        start = data.find(b'\nUid:')
+        if start < 0:
+            raise ProcfsError('Malformed status file for process {}'.format(pid))
+        return int(data[start + 5:data.index(b'\n', start + 5)].split(None, 1)[0])
+
+    def read_username(self, pid: int) -> str:
+        """ Read name of the real user of a process
+
+        :param int pid: process ID
+        :return: user name, or user ID if the user is unknown
+        """
+        uid = self.read_uid(pid)
+        username = self.usernames.get(uid)
+        if username is None:
+            try:
+                username = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                username = str(uid)
+            self.usernames[uid] = username
+        return username
+
+    def read_link(self, pid: int, name: str) -> Optional[str]:
+        """ Read symbolic link of a process, e.g. `exe`, `cwd` or `ns/pid`
+
+        :param int pid: process ID
+        :param str name: link name
+        :return: link target, or None if not available (e.g. `exe` of kernel threads) or not accessible
+        """
+        try:
+            return os.readlink('{}/{}/{}'.format(self.root, pid, name))
+        except (FileNotFoundError, PermissionError):
+            return None
+        except OSError as e:
+            if e.errno in GONE_ERRNOS:
+                raise ProcessGoneError('Process {} exited'.format(pid))
+            raise ProcfsError('Error reading {} link of process {}: {}'.format(name, pid, e.strerror))
+
+    def _read(self, pid: int, name: str) -> bytes:
+        """ Read a procfs file of a process
+
+        :param int pid: process ID
+        :param str name: file name
+        :return: file contents
+        """
+        path = '{}/{}/{}'.format(self.root, pid, name)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                size = os.readv(fd, (self.buffer,))
+                data = self.view[:size].tobytes()
+                # procfs fills the buffer as much as possible, so only a full buffer may leave data to read
+                while size == len(self.buffer):
+                    size = os.readv(fd, (self.buffer,))
+                    data += self.view[:size]
+            finally:
+                os.close(fd)
+        except OSError as e:
+            if e.errno in GONE_ERRNOS:
+                raise ProcessGoneError('Process {} exited'.format(pid))
+            raise ProcfsError('Error reading {}: {}'.format(path, e.strerror))
+        if not data and name == 'stat':
+            raise ProcessGoneError('Process {} exited'.format(pid))
+        return data
+
+    def _read_boot_time(self) -> float:
+        """ Read system boot time (seconds since epoch) """
+        with open('{}/stat'.format(self.root), 'rb') as f:
+            for line in f:
+                if line.startswith(b'btime'):
+                    return float(line.split()[1])
+        raise ProcfsError('Boot time not found in {}/stat'.format(self.root))
+
+
+PROCFS = ProcfsReader()
@@ -0,0 +1,97 @@
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+
+class SamplingProfiler:
+    """ Statistical profiler sampling the Python stacks of all threads in the current process.
+
+    Samples are aggregated in the "collapsed stack" format (one line per unique stack,
+    frames separated by semicolons followed by the sample count), which can be fed
+    directly to flame graph tools.
+    """
+
+    SAMPLE_INTERVAL = 0.005  # seconds
+
+    # Profiler running in the current process, if any
+    ACTIVE = None  # type: Optional[SamplingProfiler]
+    ACTIVE_LOCK = threading.Lock()
+
+    def __init__(self, output_dir: str, duration: float, name: str = None):
+        """ Constructor
+
+        :param str output_dir: directory where to write the profile
+        :param float duration: seconds to sample stacks for
+        :param str name: (optional) name of the profiled process, defaults to the multiprocessing process name
+        """
+        self.output_dir = output_dir
+        self.duration = duration
+        self.name = name or multiprocessing.current_process().name
+        self.samples = Counter()  # type: Counter
+        self.thread = None
+
+    @classmethod
+    def start_session(cls, output_dir: str, duration: float, name: str = None) -> bool:
+        """ Start profiling session in background, unless one is already running
+
+        :param str output_dir: directory where to write the profile
+        :param float duration: seconds to sample stacks for
+        :param str name: (optional) name of the profiled process
+        :return: True if the session started
+        """
+        with cls.ACTIVE_LOCK:
+            if cls.ACTIVE is not None:
+                return False
+            cls.ACTIVE = cls(output_dir, duration, name)
+        cls.ACTIVE.thread = threading.Thread(target=cls.ACTIVE._run, daemon=True)
+        cls.ACTIVE.thread.start()
+        return True
+
+    def sample(self):
+        """ Take a sample of the stacks of all other threads """
+        own_ident = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, str(ident)))
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def write(self) -> str:
+        """ Write collected samples in collapsed stack format
+
+        :return: path of the written file
+        """
+        filename = os.path.join(
+            self.output_dir,
+            '{}.{}.{}.collapsed'.format(self.name, os.getpid(), time.strftime('%Y%m%d-%H%M%S')),
+        )
+        with open(filename, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        return filename
+
+    def _run(self):
+        """ Handler function for the sampling thread """
+        try:
+            end = time.monotonic() + self.duration
+            while time.monotonic() < end:
+                self.sample()
+                time.sleep(self.SAMPLE_INTERVAL)
+            filename = self.write()
+            logging.info('Profile of {} written to {}'.format(self.name, filename))
+        except Exception as e:
+            logging.error('Error profiling {}: {}'.format(self.name, e))
+        finally:
+            with self.ACTIVE_LOCK:
+                SamplingProfiler.ACTIVE = None
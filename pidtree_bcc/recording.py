@@ -0,0 +1,141 @@
+import ctypes
+import json
+import logging
+import os
+import struct
+import time
+from threading import Lock
+from typing import Any
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import Tuple
+
+
+MAGIC = b'PTREEREC'
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct('=8sHI')  # magic, format version, metadata length
+RECORD_HEADER = struct.Struct('=QHH')  # monotonic timestamp (ns), probe ID, payload size
+
+
+def monotonic_ns() -> int:
+    """ Current CLOCK_MONOTONIC time in nanoseconds, the same clock as `bpf_ktime_get_ns` """
+    return int(time.monotonic() * 1e9)
+
+
+class EventRecorder:
+    """ Writes raw BPF events to a compact binary file.
+
+    The file starts with a header containing the list of recorded probes,
+    followed by records made of a fixed size header (timestamp, probe ID, size)
+    and the raw event struct. Each probe process buffers records and appends
+    them in chunks with a single `write` call on a file descriptor opened with
+    O_APPEND, so that records from different processes never interleave.
+    """
+
+    BUFFER_SIZE = 64 * 1024
+    FLUSH_INTERVAL = 1  # seconds
+
+    def __init__(self, filename: str):
+        """ Constructor
+
+        :param str filename: path of the recording file
+        """
+        self.filename = filename
+        self.probe_ids = {}
+        self.fd = None
+        self.buffer = bytearray()
+        self.buffer_lock = Lock()
+        self.last_flush = time.monotonic()
+
+    def write_header(self, probe_names: List[str]):
+        """ Initialize recording file. To be called before probe processes are forked.
+
+        :param List[str] probe_names: names of the probes being recorded
+        """
+        self.probe_ids = {name: i for i, name in enumerate(probe_names)}
+        metadata = json.dumps({'probes': probe_names}).encode()
+        with open(self.filename, 'wb') as f:
+            f.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION, len(metadata)))
+            f.write(metadata)
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND)
+
+    def record(self, probe_name: str, payload: bytes, timestamp: int = None):
+        """ Add event to the recording
+
+        :param str probe_name: name of the probe generating the event
+        :param bytes payload: raw event data
+        :param int timestamp: (optional) event monotonic timestamp in nanoseconds, e.g. kernel `ktime`
+        """
+        with self.buffer_lock:
+            self.buffer += RECORD_HEADER.pack(
+                timestamp or monotonic_ns(),
+                self.probe_ids[probe_name],
+                len(payload),
+            )
+            self.buffer += payload
+            if len(self.buffer) >= self.BUFFER_SIZE or time.monotonic() - self.last_flush >= self.FLUSH_INTERVAL:
+                self._flush()
+
+    def flush(self):
+        """ Append buffered records to the recording file.
+        Should also be invoked periodically and on exit, as records are otherwise only written when new ones arrive.
+        """
+        with self.buffer_lock:
+            self._flush()
+
+    def _flush(self):
+        """ Actual `flush` implementation, to be invoked holding the buffer lock """
+        if self.buffer:
+            os.write(self.fd, self.buffer)
+            self.buffer = bytearray()
+        self.last_flush = time.monotonic()
+
+
+def read_recording(filename: str) -> Iterator[Tuple[int, str, bytes]]:
+    """ Read events from a recording file
+
+    :param str filename: path of the recording file
+    :return: yields timestamp, probe name and raw event data
+    """
+    with open(filename, 'rb') as f:
+        magic, version, metadata_len = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('{} is not a valid pidtree-bcc recording'.format(filename))
+        probe_names = json.loads(f.read(metadata_len).decode())['probes']
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            timestamp, probe_id, size = RECORD_HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size:
+                break
+            yield timestamp, probe_names[probe_id], payload
+
+
+def replay_events(filename: str, probes: Mapping[str, Any], speed: float = 1):
+    """ Push recorded events through the probes event processing pipeline
+
+    :param str filename: path of the recording file
+    :param Mapping[str, BPFProbe] probes: loaded probes by name
+    :param float speed: replay speed relative to the recorded one (<= 0 for as fast as possible)
+    """
+    first_timestamp = start = None
+    skipped = set()
+    for timestamp, probe_name, payload in read_recording(filename):
+        probe = probes.get(probe_name)
+        if probe is None:
+            if probe_name not in skipped:
+                logging.warning('Skipping recorded events for {} as probe is not loaded'.format(probe_name))
+                skipped.add(probe_name)
+            continue
+        if speed > 0:
+            if first_timestamp is None:
+                first_timestamp, start = timestamp, time.monotonic()
+            delay = (timestamp - first_timestamp) / 1e9 / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        event_struct = probe.EVENT_STRUCT
+        payload = payload.ljust(ctypes.sizeof(event_struct), b'\0')
+        probe._process_events(None, event_struct.from_buffer_copy(payload), None, False)
@@ -0,0 +1,556 @@
+import json
+import logging
+import os
+import queue
+import time
+import zlib
+from datetime import datetime
+from threading import Thread
+from typing import Any
+from typing import BinaryIO
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from pidtree_bcc.utils import never_crash
+
+
+class RotatingFileSink:
+    """ File-like output sink with size or time based rotation.
+
+    Rotated files are compressed in a background thread and an index sidecar
+    file (`<rotated file>.idx`) is written next to each of them. The compressed
+    output is made of independent frames (gzip members or zstd frames), each
+    containing whole lines, and the index maps the first line of each frame to
+    its offset in the compressed file, so that readers can seek without
+    decompressing the whole file.
+    """
+
+    COMPRESSIONS = ('none', 'gzip', 'zstd')
+    COMPRESSION_EXTENSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+    FRAME_SIZE = 4 * 1024 * 1024  # uncompressed bytes
+
+    def __init__(self, filename: str, max_bytes: int = 0, interval: int = 0, compression: str = 'none'):
+        """ Constructor
+
+        :param str filename: output file path
+        :param int max_bytes: rotate file when it exceeds this size (<= 0 to disable)
+        :param int interval: rotate file every this many seconds (<= 0 to disable)
+        :param str compression: compression for rotated files (none, gzip, zstd)
+        """
+        if compression not in self.COMPRESSIONS:
+            raise ValueError('{} is not among supported compressions {}'.format(compression, self.COMPRESSIONS))
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.compression = compression
+        self.compress_frame = self._get_frame_compressor(compression)
+        self.compression_queue = queue.Queue()
+        self.compression_thread = Thread(target=self._compression_worker, daemon=True)
+        self.compression_thread.start()
+        self._open()
+
+    def write(self, data: str) -> int:
+        """ Write data to current file
+
+        :param str data: data to write
+        :return: number of characters written
+        """
+        # encoded here rather than by a text handle, so that the size is counted in bytes
+        encoded = data.encode('utf-8')
+        self.size += len(encoded)
+        self.fh.write(encoded)
+        return len(data)
+
+    def flush(self):
+        """ Flush current file and rotate it if needed.
+
+        Rotation happens only on flush so that rotated files always contain whole lines.
+        """
+        self.fh.flush()
+        if (
+            (self.max_bytes > 0 and self.size >= self.max_bytes)
+            or (self.interval > 0 and time.monotonic() - self.opened_monotonic >= self.interval)
+        ):
+            self.rotate()
+
+    def rotate(self):
+        """ Close the current file, rename it, queue it for compression and open a new one """
+        self._close_current()
+        self._open()
+
+    def close(self, timeout: float = None):
+        """ Close current file and wait for pending compressions to complete
+
+        :param float timeout: (optional) max seconds to wait for compression
+        """
+        self._close_current()
+        self.compression_queue.put(None)
+        self.compression_thread.join(timeout)
+
+    def _close_current(self):
+        """ Close the current file, rename it and queue it for compression """
+        self.fh.close()
+        if self.size == 0:
+            os.unlink(self.filename)
+            return
+        rotated = '{}.{}'.format(self.filename, datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+        suffix = 0
+        extension = self.COMPRESSION_EXTENSIONS[self.compression]
+        # previous rotations may have already been compressed and their uncompressed file removed
+        while any(
+            os.path.exists(rotated + ('.{}'.format(suffix) if suffix else '') + ext)
+            for ext in ('', extension)
+        ):
+            suffix += 1
+        rotated += '.{}'.format(suffix) if suffix else ''
+        os.rename(self.filename, rotated)
+        self.compression_queue.put((rotated, self.opened_at, datetime.utcnow().isoformat() + 'Z'))
+
+    def _open(self):
+        """ Open output file in append mode """
+        self.fh = open(self.filename, 'ab')
+        self.size = self.fh.tell()
+        self.opened_at = datetime.utcnow().isoformat() + 'Z'
+        self.opened_monotonic = time.monotonic()
+
+    @staticmethod
+    def _get_frame_compressor(compression: str) -> Callable[[bytes], bytes]:
+        """ Get function compressing a chunk of data into an independent frame
+
+        :param str compression: compression algorithm
+        :return: compression function
+        """
+        if compression == 'gzip':
+            def compress_gzip(data: bytes) -> bytes:
+                compressor = zlib.compressobj(wbits=31)  # 16 + MAX_WBITS -> gzip member
+                return compressor.compress(data) + compressor.flush()
+            return compress_gzip
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError('zstd compression requires the `zstandard` package to be installed')
+            return zstandard.ZstdCompressor().compress
+        return lambda data: data
+
+    def compress_file(self, filename: str, opened_at: str = None, closed_at: str = None):
+        """ Compress file in independent frames and write index sidecar
+
+        :param str filename: path of the file to compress
+        :param str opened_at: (optional) ISO timestamp of the file creation
+        :param str closed_at: (optional) ISO timestamp of the file rotation
+        """
+        output_filename = filename + self.COMPRESSION_EXTENSIONS[self.compression]
+        frames = []  # type: List[List[int]]
+        line_count = offset = compressed_offset = 0
+        fout = open(output_filename, 'wb') if self.compression != 'none' else None
+        with open(filename, 'rb') as fin:
+            while True:
+                lines = fin.readlines(self.FRAME_SIZE)
+                if not lines:
+                    break
+                chunk = b''.join(lines)
+                frames.append([line_count, offset, compressed_offset])
+                compressed_offset += fout.write(self.compress_frame(chunk)) if fout else len(chunk)
+                line_count += len(lines)
+                offset += len(chunk)
+        if fout:
+            fout.close()
+            os.unlink(filename)
+        with open(output_filename + '.idx', 'w') as f:
+            json.dump(
+                {
+                    'file': os.path.basename(output_filename),
+                    'compression': self.compression,
+                    'opened_at': opened_at,
+                    'closed_at': closed_at,
+                    'lines': line_count,
+                    'bytes': offset,
+                    'compressed_bytes': compressed_offset,
+                    # [first line number, uncompressed offset, compressed offset]
+                    'frames': frames,
+                },
+                f,
+            )
+
+    @never_crash
+    def _compression_worker(self):
+        """ Handler function for the compression thread """
+        while True:
+            item = self.compression_queue.get()
+            if item is None:
+                return
+            try:
+                self.compress_file(*item)
+            except Exception as e:
+                logging.error('Error compressing {}: {}'.format(item[0], e))
+
+
+class CompressedStreamSink:
+    """ File-like output sink compressing the output stream, e.g. towards a FIFO or stdout.
+
+    The output is a single gzip or zstd stream, which is flushed so that everything
+    written so far can be decompressed by the reader only on batch boundaries: when
+    enough data was buffered, or when the oldest buffered data is older than the
+    flush interval. Flushing on every line would make compression pointless.
+    """
+
+    COMPRESSIONS = ('gzip', 'zstd')
+    BATCH_SIZE = 256 * 1024  # uncompressed bytes
+    FLUSH_INTERVAL = 1  # seconds
+
+    def __init__(self, stream: BinaryIO, compression: str):
+        """ Constructor
+
+        :param BinaryIO stream: binary output stream
+        :param str compression: compression algorithm (gzip, zstd)
+        """
+        if compression not in self.COMPRESSIONS:
+            raise ValueError('{} is not among supported compressions {}'.format(compression, self.COMPRESSIONS))
+        self.stream = stream
+        self.compression = compression
+        if compression == 'gzip':
+            self.compressor = zlib.compressobj(wbits=31)  # 16 + MAX_WBITS -> gzip format
+            self.flush_mode = zlib.Z_SYNC_FLUSH
+            self.finish_mode = zlib.Z_FINISH
+        else:
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError('zstd compression requires the `zstandard` package to be installed')
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+            self.flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            self.finish_mode = zstandard.COMPRESSOBJ_FLUSH_FINISH
+        self.pending = 0
+        self.oldest_pending = None
+
+    def write(self, data: str) -> int:
+        """ Compress data into the stream
+
+        :param str data: data to write
+        :return: number of characters written
+        """
+        encoded = data.encode()
+        compressed = self.compressor.compress(encoded)
+        if compressed:
+            self.stream.write(compressed)
+        if self.oldest_pending is None:
+            self.oldest_pending = time.monotonic()
+        self.pending += len(encoded)
+        return len(data)
+
+    def flush(self):
+        """ Flush compressed stream if the current batch is complete """
+        if self.oldest_pending is None:
+            return
+        if self.pending >= self.BATCH_SIZE or time.monotonic() - self.oldest_pending >= self.FLUSH_INTERVAL:
+            self.stream.write(self.compressor.flush(self.flush_mode))
+            self.stream.flush()
+            self.pending = 0
+            self.oldest_pending = None
+
+    def fileno(self) -> int:
+        """ File descriptor of the output stream """
+        return self.stream.fileno()
+
+    def close(self):
+        """ Terminate compressed stream and close the output stream """
+        self.stream.write(self.compressor.flush(self.finish_mode))
+        self.stream.flush()
+        self.stream.close()
+
+
+class ColumnarSink:
+    """ Output sink writing events in typed columnar batches, to Arrow IPC or Parquet files.
+
+    Events are buffered column by column in a separate table for each probe (plus
+    `process` records and an `other` table for telemetry and events of unknown
+    probes), with the process tree stored as a nested list column. Complete batches
+    are converted and written by a background thread, each batch being a row group
+    (Parquet) or record batch (Arrow IPC). Files are rolled over every `interval`
+    seconds, and are only given their final name once complete. If the writer falls
+    behind, batches are dropped rather than stalling the output loop.
+    """
+
+    FORMATS = ('arrow', 'parquet')
+    FORMAT_EXTENSIONS = {'arrow': '.arrow', 'parquet': '.parquet'}
+    FLUSH_INTERVAL = 10  # seconds, precision of roll-overs
+    MAX_QUEUED_BATCHES = 16
+    # Columns common to all probe tables, followed by probe specific ones. Keys of
+    # the event which are not mapped to a column are serialized in `extra`.
+    COMMON_COLUMNS = ('timestamp', 'pid', 'proctree', 'cgroup_id', 'error')
+    PROBE_COLUMNS = {
+        'tcp_connect': ('daddr', 'saddr', 'port'),
+        'net_listen': ('laddr', 'port', 'protocol', 'type'),
+        'udp_session': ('destinations',),
+    }
+    PROCESS_COLUMNS = ('pid', 'cmdline', 'username')
+    ROLLOVER = object()
+
+    def __init__(
+        self,
+        directory: str,
+        file_format: str = 'parquet',
+        row_group_size: int = 65536,
+        interval: int = 3600,
+        timestamp_format: str = 'iso',
+        interned: bool = False,
+    ):
+        """ Constructor
+
+        :param str directory: output directory
+        :param str file_format: output file format (arrow, parquet)
+        :param int row_group_size: number of events in each batch
+        :param int interval: roll over output files every this many seconds
+        :param str timestamp_format: format of event timestamps (iso, epoch_ns)
+        :param bool interned: process trees contain process identifiers rather than process information
+        """
+        if file_format not in self.FORMATS:
+            raise ValueError('{} is not among supported formats {}'.format(file_format, self.FORMATS))
+        try:
+            import pyarrow
+        except ImportError:
+            raise RuntimeError('columnar output requires the `pyarrow` package to be installed')
+        self.pa = pyarrow
+        self.directory = directory
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.interval = interval
+        self.interned = interned
+        self.schemas = self._build_schemas(pyarrow, timestamp_format, interned)
+        self.batches = {}  # type: Dict[str, Dict[str, list]]
+        self.writers = {}  # type: Dict[str, tuple]
+        self.opened = time.monotonic()
+        self.dropped = 0
+        self.batch_queue = queue.Queue(self.MAX_QUEUED_BATCHES)
+        self.writer_thread = Thread(target=self._writer_worker, daemon=True)
+        self.writer_thread.start()
+
+    @classmethod
+    def table_columns(cls, table: str) -> Tuple[str, ...]:
+        """ Get the columns of a table
+
+        :param str table: table name
+        :return: column names
+        """
+        if table == 'process':
+            return ('timestamp', 'probe', 'id') + cls.PROCESS_COLUMNS + ('extra',)
+        if table == 'other':
+            return ('timestamp', 'probe', 'type', 'event')
+        return cls.COMMON_COLUMNS + cls.PROBE_COLUMNS[table] + ('extra',)
+
+    @classmethod
+    def table_name(cls, event: dict) -> str:
+        """ Get the table an event belongs to
+
+        :param dict event: event dictionary
+        :return: table name
+        """
+        event_type = event.get('type')
+        if event_type == 'process':
+            return 'process'
+        if event.get('probe') in cls.PROBE_COLUMNS and not (event_type and event_type.endswith('_telemetry')):
+            return event['probe']
+        return 'other'
+
+    @classmethod
+    def event_row(cls, table: str, event: dict, interned: bool = False) -> dict:
+        """ Map event to table row
+
+        :param str table: table name
+        :param dict event: event dictionary (modified in place)
+        :param bool interned: process trees contain process identifiers rather than process information
+        :return: column values
+        """
+        if table == 'other':
+            return {
+                'timestamp': event.get('timestamp'),
+                'probe': event.get('probe'),
+                'type': event.get('type'),
+                'event': json.dumps(event),
+            }
+        row = {column: event.pop(column, None) for column in cls.table_columns(table)}
+        if table == 'process':
+            event.pop('type', None)
+        else:
+            event.pop('probe', None)
+            if row['proctree'] and not interned:
+                row['proctree'] = [cls._process_row(proc) for proc in row['proctree']]
+        row['extra'] = json.dumps(event) if event else None
+        return row
+
+    @classmethod
+    def _process_row(cls, proc: dict) -> dict:
+        """ Map process tree entry to nested row
+
+        :param dict proc: process information
+        :return: process row, with values not mapped to a field serialized in `extra`
+        """
+        row = {column: proc.get(column) for column in cls.PROCESS_COLUMNS}
+        extra = {key: value for key, value in proc.items() if key not in row}
+        row['extra'] = json.dumps(extra) if extra else None
+        return row
+
+    @staticmethod
+    def _build_schemas(pa: Any, timestamp_format: str, interned: bool) -> dict:
+        """ Build Arrow schemas of all tables
+
+        :param Any pa: pyarrow module
+        :param str timestamp_format: format of event timestamps (iso, epoch_ns)
+        :param bool interned: process trees contain process identifiers rather than process information
+        :return: schemas by table name
+        """
+        process_fields = [
+            ('pid', pa.int64()),
+            ('cmdline', pa.string()),
+            ('username', pa.string()),
+            ('extra', pa.string()),
+        ]
+        types = {
+            'timestamp': pa.timestamp('ns', tz='UTC') if timestamp_format == 'epoch_ns' else pa.string(),
+            'pid': pa.int64(),
+            'proctree': pa.list_(pa.string() if interned else pa.struct(process_fields)),
+            'cgroup_id': pa.uint64(),
+            'port': pa.int32(),
+            'destinations': pa.list_(pa.struct([
+                ('daddr', pa.string()),
+                ('port', pa.int32()),
+                ('duration', pa.float64()),
+                ('msg_count', pa.int64()),
+            ])),
+        }
+        return {
+            table: pa.schema([
+                (column, types.get(column, pa.string()))
+                for column in ColumnarSink.table_columns(table)
+            ])
+            for table in list(ColumnarSink.PROBE_COLUMNS) + ['process', 'other']
+        }
+
+    def add(self, line: str):
+        """ Add serialized event to the batch of its table
+
+        :param str line: JSON event
+        """
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return
+        table = self.table_name(event)
+        columns = self.batches.get(table)
+        if columns is None:
+            columns = self.batches[table] = {column: [] for column in self.table_columns(table)}
+        for column, value in self.event_row(table, event, self.interned).items():
+            columns[column].append(value)
+        if len(columns['timestamp']) >= self.row_group_size:
+            self._queue_batch(table, self.batches.pop(table))
+
+    def flush(self):
+        """ Roll over output files if the interval elapsed """
+        if time.monotonic() - self.opened >= self.interval:
+            self._queue_partial_batches()
+            try:
+                self.batch_queue.put_nowait(self.ROLLOVER)
+                self.opened = time.monotonic()
+            except queue.Full:
+                pass  # retried on next flush
+
+    def close(self, timeout: float = None):
+        """ Write partial batches and close output files
+
+        :param float timeout: (optional) max seconds to wait for pending writes
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self._queue_partial_batches(deadline)
+        try:
+            self.batch_queue.put(None, timeout=max(deadline - time.monotonic(), 0) if deadline else None)
+        except queue.Full:
+            return  # the writer thread is a daemon, pending batches are abandoned
+        self.writer_thread.join(max(deadline - time.monotonic(), 0) if deadline else None)
+
+    def _queue_partial_batches(self, deadline: float = 0):
+        """ Queue all non-empty batches for writing
+
+        :param float deadline: (optional) monotonic time until which to wait for space in the queue,
+                               0 not to wait at all and None to wait indefinitely
+        """
+        for table in list(self.batches):
+            timeout = max(deadline - time.monotonic(), 0) if deadline else deadline
+            self._queue_batch(table, self.batches.pop(table), timeout)
+
+    def _queue_batch(self, table: str, columns: Dict[str, list], timeout: float = 0):
+        """ Queue batch for writing, dropping it if the writer does not free up space in time
+
+        :param str table: table name
+        :param Dict[str, list] columns: column values
+        :param float timeout: (optional) max seconds to wait for space in the queue (None to wait indefinitely)
+        """
+        try:
+            if timeout == 0:
+                self.batch_queue.put_nowait((table, columns))
+            else:
+                self.batch_queue.put((table, columns), timeout=timeout)
+        except queue.Full:
+            self.dropped += len(columns['timestamp'])
+            logging.warning('Columnar output is falling behind, dropped {} events so far'.format(self.dropped))
+
+    def _write_batch(self, table: str, columns: Dict[str, list]):
+        """ Convert batch to Arrow format and write it to the table output file
+
+        :param str table: table name
+        :param Dict[str, list] columns: column values
+        """
+        schema = self.schemas[table]
+        batch = self.pa.RecordBatch.from_arrays(
+            [self.pa.array(columns[field.name], type=field.type) for field in schema],
+            schema=schema,
+        )
+        if table not in self.writers:
+            filename = os.path.join(
+                self.directory,
+                '{}.{}'.format(table, datetime.utcnow().strftime('%Y%m%d-%H%M%S')),
+            )
+            suffix = 0
+            extension = self.FORMAT_EXTENSIONS[self.file_format]
+            while os.path.exists(filename + ('.{}'.format(suffix) if suffix else '') + extension):
+                suffix += 1
+            filename += ('.{}'.format(suffix) if suffix else '') + extension
+            in_progress = filename + '.inprogress'
+            if self.file_format == 'parquet':
+                import pyarrow.parquet
+                sink = None
+                writer = pyarrow.parquet.ParquetWriter(in_progress, schema)
+            else:
+                sink = self.pa.OSFile(in_progress, 'wb')
+                writer = self.pa.ipc.new_file(sink, schema)
+            self.writers[table] = (writer, sink, filename)
+        writer = self.writers[table][0]
+        if self.file_format == 'parquet':
+            writer.write_table(self.pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+
+    def _close_writers(self):
+        """ Close output files and give them their final name """
+        for writer, sink, filename in self.writers.values():
+            writer.close()
+            if sink:
+                sink.close()
+            os.rename(filename + '.inprogress', filename)
+        self.writers = {}
+
+    def _writer_worker(self):
+        """ Handler function for the writer thread """
+        while True:
+            item = self.batch_queue.get()
+            try:
+                if item is None or item is self.ROLLOVER:
+                    self._close_writers()
+                else:
+                    self._write_batch(*item)
+            except Exception as e:
+                logging.error('Error writing columnar output: {}'.format(e))
+            if item is None:
+                return
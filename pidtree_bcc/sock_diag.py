@@ -0,0 +1,176 @@
+import os
+import socket
+import struct
+from collections import namedtuple
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Set
+
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+TCP_CLOSE = 7
+TCP_LISTEN = 10
+
+NLMSG_HEADER = struct.Struct('=IHHII')  # length, type, flags, sequence number, port ID
+INET_DIAG_REQ_V2 = struct.Struct('=BBBBI48x')  # family, protocol, extensions, padding, states, socket ID
+INET_DIAG_MSG_MIN_SIZE = 72
+RECV_BUFFER_SIZE = 65536
+
+DiagSocket = namedtuple('DiagSocket', ('protocol', 'laddr', 'port', 'uid', 'inode'))
+
+
+class SockDiagError(Exception):
+    pass
+
+
+def _parse_diag_messages(data: bytes, protocol: int) -> Iterable[DiagSocket]:
+    """ Parse netlink response buffer into socket info
+
+    :param bytes data: netlink response data
+    :param int protocol: protocol the sockets were requested for
+    :return: yields socket info, or None when the end of the dump is reached
+    """
+    offset = 0
+    while offset + NLMSG_HEADER.size <= len(data):
+        msg_len, msg_type, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+        if msg_len < NLMSG_HEADER.size:
+            raise SockDiagError('Malformed netlink message')
+        payload_offset = offset + NLMSG_HEADER.size
+        if msg_type == NLMSG_DONE:
+            yield None
+            return
+        if msg_type == NLMSG_ERROR:
+            errno = -struct.unpack_from('=i', data, payload_offset)[0]
+            raise SockDiagError('sock_diag request failed: {}'.format(os.strerror(errno)))
+        if msg_type == SOCK_DIAG_BY_FAMILY and msg_len - NLMSG_HEADER.size >= INET_DIAG_MSG_MIN_SIZE:
+            # inet_diag_msg: family, state, timer, retrans (u8), socket ID (sport, dport,
+            # src[4], dst[4] in network order; interface, cookie[2]), expires, rqueue,
+            # wqueue, uid, inode (u32)
+            port = struct.unpack_from('>H', data, payload_offset + 4)[0]
+            laddr = struct.unpack_from('=I', data, payload_offset + 8)[0]
+            uid, inode = struct.unpack_from('=II', data, payload_offset + 64)
+            yield DiagSocket(protocol, laddr, port, uid, inode)
+        offset += (msg_len + 3) & ~3  # NLMSG_ALIGN
+
+
+def list_sockets(protocol: int, states: int) -> List[DiagSocket]:
+    """ List IPv4 sockets via NETLINK_SOCK_DIAG
+
+    :param int protocol: IPPROTO_TCP or IPPROTO_UDP
+    :param int states: bitmask of the TCP states to match
+    :return: list of socket info
+    """
+    request = INET_DIAG_REQ_V2.pack(socket.AF_INET, protocol, 0, 0, states)
+    header = NLMSG_HEADER.pack(
+        NLMSG_HEADER.size + len(request),
+        SOCK_DIAG_BY_FAMILY,
+        NLM_F_REQUEST | NLM_F_DUMP,
+        1,
+        0,
+    )
+    result = []
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_SOCK_DIAG) as sock:
+        sock.sendall(header + request)
+        while True:
+            data = sock.recv(RECV_BUFFER_SIZE)
+            if not data:
+                return result
+            for entry in _parse_diag_messages(data, protocol):
+                if entry is None:
+                    return result
+                result.append(entry)
+
+
+def list_listening_sockets(tcp: bool = True, udp: bool = False) -> List[DiagSocket]:
+    """ List IPv4 TCP listening sockets and bound unconnected UDP sockets
+
+    :param bool tcp: include TCP sockets
+    :param bool udp: include UDP sockets
+    :return: list of socket info
+    """
+    result = []
+    if tcp:
+        result.extend(list_sockets(socket.IPPROTO_TCP, 1 << TCP_LISTEN))
+    if udp:
+        result.extend(
+            entry for entry in list_sockets(socket.IPPROTO_UDP, 1 << TCP_CLOSE)
+            if entry.port != 0
+        )
+    return result
+
+
+class SocketInodeResolver:
+    """ Maps socket inodes to the PIDs holding them.
+
+    Resolved (pid, fd) pairs are cached and validated with a single `readlink` on
+    subsequent lookups; `/proc` is only scanned for inodes not yet known, and the
+    scan skips non-root processes not owned by any of the socket owners.
+    """
+
+    def __init__(self):
+        self.cache = {}  # type: Dict[int, tuple]
+
+    def resolve(self, sockets: Iterable[DiagSocket]) -> Dict[int, int]:
+        """ Get PID for each socket
+
+        :param Iterable[DiagSocket] sockets: socket info
+        :return: mapping from socket inode to PID (unresolved inodes are omitted)
+        """
+        result = {}
+        missing = {}  # type: Dict[int, int]
+        for entry in sockets:
+            cached = self.cache.get(entry.inode)
+            if cached and self._check_fd(cached[0], cached[1], entry.inode):
+                result[entry.inode] = cached[0]
+            else:
+                missing[entry.inode] = entry.uid
+        if missing:
+            result.update(self._scan_proc(set(missing), set(missing.values())))
+        self.cache = {inode: self.cache[inode] for inode in result}
+        return result
+
+    @staticmethod
+    def _check_fd(pid: int, fd: str, inode: int) -> bool:
+        """ Check if process file descriptor points to socket inode """
+        try:
+            return os.readlink('/proc/{}/fd/{}'.format(pid, fd)) == 'socket:[{}]'.format(inode)
+        except OSError:
+            return False
+
+    def _scan_proc(self, inodes: Set[int], uids: Set[int]) -> Dict[int, int]:
+        """ Look for socket inodes in process file descriptors
+
+        :param Set[int] inodes: inodes to look for
+        :param Set[int] uids: owners of the sockets
+        :return: mapping from inode to PID
+        """
+        targets = {'socket:[{}]'.format(inode): inode for inode in inodes}
+        result = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                owner = os.stat('/proc/{}'.format(pid)).st_uid
+                if owner != 0 and 0 not in uids and owner not in uids:
+                    continue
+                fds = os.listdir('/proc/{}/fd'.format(pid))
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    link = os.readlink('/proc/{}/fd/{}'.format(pid, fd))
+                except OSError:
+                    continue
+                inode = targets.pop(link, None)
+                if inode is not None:
+                    result[inode] = int(pid)
+                    self.cache[inode] = (int(pid), fd)
+                    if not targets:
+                        return result
+        return result
@@ -0,0 +1,81 @@
+import time
+from typing import Union
+
+
+TIMESTAMP_FORMATS = ('iso', 'epoch_ns')
+
+
+class KernelClock:
+    """ Converts kernel monotonic timestamps (`bpf_ktime_get_ns`) to wall clock time.
+
+    The offset between the monotonic and the wall clock is re-calibrated
+    periodically, so that wall clock adjustments are picked up.
+    """
+
+    CALIBRATION_INTERVAL = 60  # seconds
+
+    def __init__(self):
+        self.offset_ns = 0
+        self.next_calibration = 0
+
+    def calibrate(self):
+        """ Measure offset between monotonic and wall clock """
+        # take the sample with the smallest gap between the two monotonic reads
+        best = None
+        for _ in range(3):
+            before = time.monotonic()
+            wall = time.time()
+            after = time.monotonic()
+            if best is None or after - before < best[0]:
+                best = (after - before, wall - (before + after) / 2)
+        self.offset_ns = int(best[1] * 1e9)
+        self.next_calibration = time.monotonic() + self.CALIBRATION_INTERVAL
+
+    def to_wall_ns(self, ktime_ns: int) -> int:
+        """ Convert kernel monotonic timestamp to wall clock epoch nanoseconds
+
+        :param int ktime_ns: monotonic timestamp in nanoseconds
+        :return: nanoseconds since epoch
+        """
+        if time.monotonic() >= self.next_calibration:
+            self.calibrate()
+        return ktime_ns + self.offset_ns
+
+
+class TimestampFormatter:
+    """ Formats event timestamps.
+
+    ISO timestamps are built caching the formatted date and time up to
+    the second, so that only the sub-second part is formatted per event.
+    """
+
+    def __init__(self, timestamp_format: str = 'iso'):
+        """ Constructor
+
+        :param str timestamp_format: either `iso` (ISO 8601 UTC string) or `epoch_ns` (integer nanoseconds)
+        """
+        if timestamp_format not in TIMESTAMP_FORMATS:
+            raise ValueError('{} is not among supported timestamp formats {}'.format(
+                timestamp_format, TIMESTAMP_FORMATS,
+            ))
+        self.timestamp_format = timestamp_format
+        # second and its formatted prefix, replaced as a whole so that formatters shared
+        # across threads never mix a second with the prefix of another one
+        self._cache = (None, '')
+
+    def format(self, epoch_ns: int = None) -> Union[str, int]:
+        """ Format timestamp
+
+        :param int epoch_ns: (optional) nanoseconds since epoch, defaults to the current time
+        :return: formatted timestamp
+        """
+        if epoch_ns is None:
+            epoch_ns = int(time.time() * 1e9)
+        if self.timestamp_format == 'epoch_ns':
+            return epoch_ns
+        second, nanos = divmod(epoch_ns, 1000000000)
+        cached_second, prefix = self._cache
+        if second != cached_second:
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+            self._cache = (second, prefix)
+        return '{}.{:06d}Z'.format(prefix, nanos // 1000)
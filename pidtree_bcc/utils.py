@@ -3,37 +3,251 @@ import importlib
 import inspect
 import logging
 import os
+import re
 import socket
 import struct
 import sys
+import time
+from collections import OrderedDict
+from typing import Any
 from typing import Callable
+from typing import Container
 from typing import List
+from typing import Optional
+from typing import Pattern
+from typing import Sequence
 from typing import TextIO
+from typing import Tuple
 from typing import Type
 from typing import Union
 
-import psutil
+from pidtree_bcc.procfs import PROCFS
+from pidtree_bcc.procfs import ProcfsError
 
 
-def crawl_process_tree(pid: int) -> List[dict]:
-    """ Takes a process and returns all process ancestry until the ppid is 0
+class ProcessInfoCache:
+    """ Bounded LRU cache of process information used when crawling process trees.
+
+    Entries are keyed by PID and process start time, so that recycled PIDs never
+    match stale data, and expire after a fixed time to pick up changes caused by
+    `exec` or re-parenting. Being a plain in-memory structure, it is shared by all
+    probes running in the same process.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 30):
+        """ Constructor
+
+        :param int max_size: maximum number of processes kept in cache (<= 0 disables caching)
+        :param float ttl: seconds after which cached entries expire
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # type: OrderedDict
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[int, float]) -> Optional[Tuple[dict, int]]:
+        """ Get cached process information
+
+        :param Tuple[int, float] key: PID and process start time
+        :return: process info dictionary and parent PID, or None if missing or expired
+        """
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[2] > self.ttl:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, key: Tuple[int, float], info: dict, ppid: int, stored_at: float = None):
+        """ Store process information, evicting the least recently used entry if full
+
+        :param Tuple[int, float] key: PID and process start time
+        :param dict info: process info dictionary
+        :param int ppid: parent PID
+        :param float stored_at: (optional) monotonic time the information was read at, defaults to now
+        """
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (info, ppid, time.monotonic() if stored_at is None else stored_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """ Cache statistics
+
+        :return: dictionary with hits, misses and number of entries
+        """
+        return OrderedDict((('hits', self.hits), ('misses', self.misses), ('entries', len(self.entries))))
+
+    def dump(self) -> List[dict]:
+        """ List valid entries, least recently used first
+
+        :return: dictionaries with PID, start time, parent PID, age (seconds) and process info of each entry
+        """
+        now = time.monotonic()
+        # copied in a single step, as the cache is used by the polling thread while control requests are served
+        entries = list(self.entries.items())
+        return [
+            {
+                'pid': key[0],
+                'start_time': key[1],
+                'ppid': ppid,
+                'age': round(now - stored_at, 3),
+                'info': info,
+            }
+            for key, (info, ppid, stored_at) in entries
+            if now - stored_at <= self.ttl
+        ]
+
+
+ANCESTRY_CACHE = None  # type: ProcessInfoCache
+PROCTREE_FIELDS = ('cmdline', 'username', 'uid', 'exe', 'start_time', 'cwd')
+DEFAULT_PROCTREE_FIELDS = ('cmdline', 'username')
+NAMESPACE_TYPES = ('cgroup', 'ipc', 'mnt', 'net', 'pid', 'time', 'user', 'uts')
+
+
+def set_ancestry_cache(cache: ProcessInfoCache):
+    """ Set the default cache used when crawling process trees, which are not cached otherwise.
+    To be invoked before probe processes are forked.
+
+    :param ProcessInfoCache cache: cache instance (or any object with the same `get` and `put` methods)
+    """
+    global ANCESTRY_CACHE
+    ANCESTRY_CACHE = cache
+
+
+def get_ancestry_cache() -> ProcessInfoCache:
+    """ Get the default cache used when crawling process trees, None if not set """
+    return ANCESTRY_CACHE
+
+
+def process_matches(pid: int, start_time: float) -> bool:
+    """ Check that a process is still running, and is not a different one with a recycled PID
+
+    :param int pid: process ID
+    :param float start_time: process start time
+    :return: True if the process is running
+    """
+    try:
+        return PROCFS.read_stat(pid)[1] == start_time
+    except ProcfsError:
+        return False
+
+
+def parse_proctree_config(config: dict) -> dict:
+    """ Validate process tree crawling configuration
+
+    :param dict config: probe `proctree` configuration
+    :return: keyword arguments for `crawl_process_tree`
+    """
+    unknown = set(config) - {'max_depth', 'stop_pids', 'stop_comm', 'stop_namespace', 'fields'}
+    if unknown:
+        raise ValueError('Unknown proctree options: {}'.format(', '.join(sorted(unknown))))
+    options = {}
+    if config.get('max_depth'):
+        if int(config['max_depth']) < 0:
+            raise ValueError('proctree max_depth must not be negative')
+        options['max_depth'] = int(config['max_depth'])
+    if config.get('stop_pids'):
+        options['stop_pids'] = frozenset(int(pid) for pid in config['stop_pids'])
+    if config.get('stop_comm'):
+        options['stop_comm'] = re.compile(config['stop_comm'])
+    if config.get('stop_namespace'):
+        if config['stop_namespace'] not in NAMESPACE_TYPES:
+            raise ValueError('Invalid proctree stop_namespace: {}'.format(config['stop_namespace']))
+        options['stop_namespace'] = config['stop_namespace']
+    if config.get('fields') is not None:
+        invalid = set(config['fields']) - set(PROCTREE_FIELDS)
+        if invalid:
+            raise ValueError('Invalid proctree fields: {}'.format(', '.join(sorted(invalid))))
+        options['fields'] = tuple(config['fields'])
+    return options
+
+
+def read_process_field(pid: int, field: str, start_time: float) -> Any:
+    """ Read a piece of process information
+
+    :param int pid: process ID
+    :param str field: one of PROCTREE_FIELDS
+    :param float start_time: process start time, already read to identify the process
+    :return: field value
+    """
+    if field == 'cmdline':
+        return PROCFS.read_cmdline(pid)
+    if field == 'username':
+        return PROCFS.read_username(pid)
+    if field == 'uid':
+        return PROCFS.read_uid(pid)
+    if field == 'start_time':
+        return round(start_time, 2)
+    return PROCFS.read_link(pid, field)
+
+
+def crawl_process_tree(
+    pid: int,
+    cache: ProcessInfoCache = None,
+    max_depth: int = 0,
+    stop_pids: Container[int] = (),
+    stop_comm: Pattern = None,
+    stop_namespace: str = None,
+    fields: Sequence[str] = DEFAULT_PROCTREE_FIELDS,
+) -> List[dict]:
+    """ Takes a process and returns its ancestry until the ppid is 0, or a stop condition is met
+
+    The leaf process is always inspected, while information about its ancestors
+    is taken from cache when available. Only the requested fields are collected:
+    cached entries are extended as needed, so that probes collecting different
+    fields can share the same cache.
 
     :param int pid: child process ID
-    :return: yields dicts with pid, cmdline and username navigating up the tree
+    :param ProcessInfoCache cache: (optional) cache for ancestor process information,
+                                   defaults to the one set with `set_ancestry_cache`, if any
+    :param int max_depth: (optional) max number of processes to collect (<= 0 for no limit)
+    :param Container[int] stop_pids: (optional) stop at any of these processes (included)
+    :param Pattern stop_comm: (optional) stop at the first process whose command name matches (included)
+    :param str stop_namespace: (optional) stop at the first process in a different namespace
+                               of this type (e.g. `pid`) than the leaf process (excluded)
+    :param Sequence[str] fields: (optional) process information to collect besides the PID, from PROCTREE_FIELDS
+    :return: yields dicts with pid and the requested fields navigating up the tree
+    :raise ProcfsError: process information could not be read, `ProcessGoneError` if any process exited
     """
+    if cache is None:
+        cache = ANCESTRY_CACHE
     result = []
-    while True:
-        if pid == 0:
+    namespace = None
+    while pid != 0:
+        # parent PID is always read, so that re-parenting is picked up for cached processes too
+        ppid, start_time, comm = PROCFS.read_stat(pid)
+        if stop_namespace:
+            process_namespace = PROCFS.read_link(pid, 'ns/' + stop_namespace)
+            if not result:
+                namespace = process_namespace
+            elif process_namespace != namespace:
+                break
+        key = (pid, start_time)
+        cached = cache.get(key) if result and cache is not None else None
+        info = cached[0] if cached else {'pid': pid}
+        missing = [field for field in fields if field not in info]
+        if missing:
+            info = dict(info)
+            for field in missing:
+                info[field] = read_process_field(pid, field, start_time)
+            if cache is not None:
+                cache.put(key, info, ppid)
+        proc = {'pid': pid}
+        for field in fields:
+            proc[field] = info[field]
+        result.append(proc)
+        if (
+            len(result) == max_depth
+            or pid in stop_pids
+            or (stop_comm and stop_comm.search(comm))
+        ):
             break
-        proc = psutil.Process(pid)
-        result.append(
-            {
-                'pid': proc.pid,
-                'cmdline': ' '.join(proc.cmdline()),
-                'username': proc.username(),
-            },
-        )
-        pid = proc.ppid()
+        pid = ppid
     return result
 
 
@@ -128,3 +342,14 @@ def get_network_namespace(pid: int = None) -> int:
         return int(ns_link.strip()[5:-1])
     except Exception:
         return None
+
+
+def event_destinations(event: dict) -> List[Tuple[str, int]]:
+    """ Get the addresses and ports an event refers to
+
+    :param dict event: event dictionary
+    :return: list of address and port pairs
+    """
+    if 'destinations' in event:
+        return [(dest.get('daddr'), dest.get('port')) for dest in event['destinations']]
+    return [(event.get('daddr', event.get('laddr')), event.get('port'))]
@@ -0,0 +1,82 @@
+import multiprocessing
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.ancestry_store import SharedAncestryStore
+from pidtree_bcc.ancestry_store import SLOT_HEADER
+
+
+def test_shared_ancestry_store_get_put():
+    store = SharedAncestryStore(slots=64)
+    info = {'pid': 123, 'cmdline': 'bash', 'username': 'user'}
+    assert store.get((123, 1.5)) is None
+    store.put((123, 1.5), info, 1)
+    assert store.get((123, 1.5)) == (info, 1)
+    assert store.get((123, 2.5)) is None
+    store.put((123, 1.5), {'pid': 123, 'cmdline': 'zsh', 'username': 'user'}, 1)
+    assert store.get((123, 1.5))[0]['cmdline'] == 'zsh'
+    assert (store.hits, store.misses) == (2, 2)
+
+
+def test_shared_ancestry_store_oversized():
+    store = SharedAncestryStore(slots=8, slot_size=SLOT_HEADER.size + 16)
+    store.put((1, 0.0), {'cmdline': 'x' * 100}, 0)
+    assert store.skipped == 1
+    assert store.get((1, 0.0)) is None
+
+
+@patch('pidtree_bcc.ancestry_store.time')
+def test_shared_ancestry_store_eviction(mock_time):
+    store = SharedAncestryStore(slots=8, ttl=100)
+    for pid in range(1, 9):
+        mock_time.monotonic.return_value = pid
+        store.put((pid, 0.0), {'pid': pid}, 0)
+    assert store.evictions == 0
+    mock_time.monotonic.return_value = 10
+    store.put((9, 0.0), {'pid': 9}, 0)
+    assert store.evictions == 1
+    assert store.get((1, 0.0)) is None  # the least recently stored entry
+    assert all(store.get((pid, 0.0)) == ({'pid': pid}, 0) for pid in range(2, 10))
+    # expired entries are reused before evicting
+    mock_time.monotonic.return_value = 105
+    assert store.get((2, 0.0)) is None
+    store.put((10, 0.0), {'pid': 10}, 0)
+    assert store.evictions == 1
+    # entries stored with their original time expire accordingly
+    store.put((11, 0.0), {'pid': 11}, 0, stored_at=0)
+    assert store.get((11, 0.0)) is None
+
+
+def test_shared_ancestry_store_torn_read():
+    store = SharedAncestryStore(slots=8)
+    store.put((1, 0.0), {'pid': 1}, 0)
+    # simulate writer in progress on every slot
+    for offset in range(0, store.slots * store.slot_size, store.slot_size):
+        store.memory[offset:offset + 8] = (1).to_bytes(8, 'little')
+    assert store.get((1, 0.0)) is None
+
+
+def _publish(store, key):
+    store.put(key, {'pid': key[0]}, 1)
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='requires fork')
+def test_shared_ancestry_store_across_processes():
+    store = SharedAncestryStore(slots=64)
+    worker = multiprocessing.get_context('fork').Process(target=_publish, args=(store, (42, 3.0)))
+    worker.start()
+    worker.join()
+    assert store.get((42, 3.0)) == ({'pid': 42}, 1)
+
+
+def test_shared_ancestry_store_dump():
+    store = SharedAncestryStore(slots=64)
+    store.put((123, 1.5), {'pid': 123, 'cmdline': 'bash'}, 1)
+    store.get((123, 1.5))
+    entries = store.dump()
+    assert len(entries) == 1
+    assert entries[0]['pid'] == 123
+    assert entries[0]['ppid'] == 1
+    assert entries[0]['info'] == {'pid': 123, 'cmdline': 'bash'}
+    assert store.stats()['hits'] == 1
@@ -1,4 +1,15 @@
+import json
+import time
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+
 from pidtree_bcc.probes import BPFProbe
+from pidtree_bcc.probes import COMPILED_TEMPLATES
+from pidtree_bcc.probes import poll_probes
+from pidtree_bcc.probes import render_template
+from pidtree_bcc.utils import ProcessInfoCache
 
 
 class MockProbe(BPFProbe):
@@ -17,3 +28,204 @@ some other text'''
     assert mock_probe.expanded_bpf_text == '''some text
 some_value
 some other text'''
+
+
+@patch('pidtree_bcc.probes.select')
+def test_poll_probes(mock_select):
+    probe_a, probe_b = MagicMock(stopping=False), MagicMock(stopping=False)
+    probe_a.event_fds.return_value = [3, 4]
+    probe_b.event_fds.return_value = [5]
+    mock_poller = mock_select.epoll.return_value
+    ready = [[(3, 1), (4, 1)], [(5, 1)]]
+
+    def poll(timeout):
+        assert timeout > 0
+        if len(ready) == 1:
+            probe_b.stopping = True
+        return ready.pop(0)
+
+    mock_poller.poll.side_effect = poll
+    poll_probes([probe_a, probe_b])
+    assert mock_poller.register.call_count == 3
+    probe_a.attach.return_value.assert_called_once_with(0)
+    probe_b.attach.return_value.assert_called_once_with(0)
+    probe_a.drain.assert_called_once_with()
+    probe_b.drain.assert_called_once_with()
+
+
+def test_start_polling_drain():
+    probe = MockProbe(None, {'some_variable': 'some_value'})
+    poll_func = MagicMock(side_effect=lambda: probe.stop())
+    probe.bpf = MagicMock(kprobe_fds={'p_tcp_v4_connect': 3}, tracepoint_fds={})
+    with patch.object(probe, 'attach', return_value=poll_func):
+        probe.start_polling()
+    poll_func.assert_called_once_with()
+    probe.bpf.detach_kprobe_event.assert_called_once_with('p_tcp_v4_connect')
+    probe.bpf.perf_buffer_consume.assert_called_once_with()
+
+
+def test_render_template_cache():
+    source = 'value: {{ some_variable }}'
+    assert render_template(source, '/tmp', {'some_variable': 1}) == 'value: 1'
+    template = COMPILED_TEMPLATES[('/tmp', source)]
+    assert render_template(source, '/tmp', {'some_variable': 2}) == 'value: 2'
+    assert COMPILED_TEMPLATES[('/tmp', source)] is template
+
+
+@patch('pidtree_bcc.probes.monotonic_ns')
+def test_process_events_kernel_timestamp(mock_monotonic_ns):
+    mock_monotonic_ns.return_value = 5000000
+    output_queue = MagicMock()
+    probe = MockProbe(output_queue, {'some_variable': 'some_value'})
+    probe.bpf = MagicMock()
+    probe.bpf['events'].event.return_value = MagicMock(ktime=3000000)
+    probe.enrich_event = lambda event: {'pid': 1}
+    with patch.object(probe, 'CLOCK') as mock_clock:
+        mock_clock.to_wall_ns.return_value = 1600000000123456789
+        probe._process_events(None, None, None)
+        mock_clock.to_wall_ns.assert_called_once_with(3000000)
+    output_queue.put.assert_called_once_with(
+        '{"pid": 1, "timestamp": "2020-09-13T12:26:40.123456Z", "probe": "bpf_probe_test"}',
+        'bpf_probe_test',
+    )
+    assert (probe.delay_count, probe.delay_max_ns) == (1, 2000000)
+
+
+@patch('pidtree_bcc.probes.monotonic_ns')
+def test_process_events_latency_tracing(mock_monotonic_ns):
+    mock_monotonic_ns.side_effect = range(1000000, 100000000, 1000)
+    output_queue = MagicMock()
+    with patch.object(MockProbe, 'LATENCY_REPORT_INTERVAL', 60), patch.object(MockProbe, 'LATENCY_SAMPLE_RATE', 1):
+        probe = MockProbe(output_queue, {'some_variable': 'some_value'})
+    probe.bpf = MagicMock()
+    probe.bpf['events'].event.return_value = MagicMock(ktime=500000)
+    probe.enrich_event = lambda event: {'pid': 1}
+    probe._process_events(None, None, None)
+    event = json.loads(output_queue.put.call_args[0][0])
+    assert event['_timing'] == {'kernel': 500, 'enrich': 1}
+    assert list(probe.latency_tracer.histograms) == ['kernel', 'enrich', 'serialize', 'queue_put']
+
+
+def test_update_process_filters(tmp_path):
+    rules_file = tmp_path / 'rules.yml'
+    rules_file.write_text('exclude:\n  comm: [consul]\n')
+    probe = MockProbe(None, {'some_variable': 'some_value', 'process_filters': {'file': str(rules_file)}})
+    assert probe.process_filter.is_filtered('consul', 0)
+    assert probe.SIDECARS[-1][0] == probe._process_filter_worker
+    probe.bpf = MagicMock()
+    probe.update_process_filters({'exclude': {'comm': ['envoy']}})
+    assert probe.process_filter.is_filtered('envoy', 0)
+    assert not probe.process_filter.is_filtered('consul', 0)
+    probe.bpf.__getitem__.return_value.__delitem__.assert_called_once()
+    with pytest.raises(ValueError):
+        probe.update_process_filters({'exclude': {'cgroup_id': [1]}})
+
+
+def test_process_events_novelty_filter():
+    output_queue = MagicMock()
+    probe = MockProbe(output_queue, {'some_variable': 'some_value', 'novelty_filter': {'ttl': 60}})
+    probe.enrich_event = lambda event: {'pid': event, 'proctree': [], 'daddr': '1.1.1.1', 'port': 443}
+    probe._process_events(None, 1, None, False)
+    probe._process_events(None, 2, None, False)
+    assert output_queue.put.call_count == 1
+    assert probe.novelty_filter.suppressed == 1
+    worker, args = probe.SIDECARS[-1]
+    assert worker == probe._novelty_summary_worker and args == (300,)
+    with patch('pidtree_bcc.probes.time') as mock_time:
+        mock_time.sleep.side_effect = [None, Exception('foobar')]  # to stop inf loop
+        with pytest.raises(Exception, match='foobar'):
+            probe._novelty_summary_worker.__wrapped__(probe, 300)
+    summary = json.loads(output_queue.put.call_args[0][0])
+    assert summary['type'] == 'novelty_telemetry' and summary['suppressed'] == 1
+
+
+def test_read_kernel_counters():
+    probe = MockProbe(None, {'some_variable': 'some_value'})
+    probe.bpf = MagicMock()
+    table = probe.bpf.__getitem__.return_value
+    table.Key.side_effect = lambda index: index
+    table.sum.side_effect = lambda index: MagicMock(value=index * 10)
+    counters = probe.read_kernel_counters()
+    probe.bpf.__getitem__.assert_called_once_with('counters')
+    assert list(counters) == list(BPFProbe.KERNEL_COUNTERS)
+    assert counters['entered'] == 0
+    assert counters['submitted'] == 60
+    assert counters['closed'] == 70
+    probe.bpf.__getitem__.side_effect = KeyError
+    assert probe.read_kernel_counters() == {}
+
+
+def test_handle_control(tmp_path):
+    rules_file = tmp_path / 'rules.yml'
+    rules_file.write_text('exclude:\n  comm: [consul]\n')
+    probe = MockProbe(None, {'some_variable': 'some_value'})
+    stats = probe.handle_control('stats', [])
+    assert stats['lost_events'] == 0
+    assert stats['ancestry_cache'] is None
+    assert 'kernel_counters' not in stats
+    with pytest.raises(ValueError):
+        probe.handle_control('cache', [])
+    with patch('pidtree_bcc.probes.get_ancestry_cache', return_value=ProcessInfoCache()):
+        stats = probe.handle_control('stats', [])
+    assert set(stats['ancestry_cache']) == {'hits', 'misses', 'entries'}
+    with patch('pidtree_bcc.probes.get_ancestry_cache') as mock_cache:
+        mock_cache.return_value.dump.return_value = [{'pid': 1}, {'pid': 2}]
+        assert probe.handle_control('cache', ['2']) == [{'pid': 2}]
+    with pytest.raises(ValueError):
+        probe.handle_control('reload-filters', [])
+    with pytest.raises(ValueError):
+        probe.handle_control('foo', [])
+    probe = MockProbe(None, {'some_variable': 'some_value', 'process_filters': {'file': str(rules_file)}})
+    rules_file.write_text('exclude:\n  comm: [envoy]\n')
+    assert probe.handle_control('reload-filters', []) == 'reloaded'
+    assert probe.process_filter.is_filtered('envoy', 0)
+    connection = probe.enable_control()
+    assert probe.SIDECARS[-1][1][1] == probe.handle_control
+    connection.close()
+
+
+@patch('pidtree_bcc.probes.process_matches')
+def test_checkpoint_restore(mock_matches, tmp_path):
+    probe = MockProbe(None, {'some_variable': 'some_value'})
+    probe.CHECKPOINT_DIR = str(tmp_path)
+    with patch('pidtree_bcc.probes.get_ancestry_cache') as mock_cache:
+        mock_cache.return_value.dump.return_value = [
+            {'pid': 1, 'start_time': 10.0, 'ppid': 0, 'age': 1, 'info': {'pid': 1}},
+            {'pid': 2, 'start_time': 20.0, 'ppid': 1, 'age': 1, 'info': {'pid': 2}},
+            {'pid': 3, 'start_time': 30.0, 'ppid': 1, 'age': 60, 'info': {'pid': 3}},
+        ]
+        probe.write_checkpoint()
+    mock_matches.side_effect = lambda pid, start_time: pid != 2
+    with patch('pidtree_bcc.probes.get_ancestry_cache') as mock_cache:
+        mock_cache.return_value.ttl = 30
+        probe.restore_checkpoint()
+        mock_cache.return_value.put.assert_called_once()
+        args = mock_cache.return_value.put.call_args[0]
+        assert args[:3] == ((1, 10.0), {'pid': 1}, 0)
+        # restored entries keep their original age
+        assert 1 <= time.monotonic() - args[3] < 10
+    assert not list(tmp_path.iterdir())
+    # invalid checkpoints are ignored and removed
+    (tmp_path / '{}.checkpoint'.format(probe.probe_name)).write_bytes(b'foo')
+    probe.restore_checkpoint()
+    assert not list(tmp_path.iterdir())
+    # as well as checkpoints failing to restore for any reason
+    probe.write_checkpoint()
+    with patch.object(probe, 'restore_sections', side_effect=KeyError('sessions')):
+        probe.restore_checkpoint()
+    assert not list(tmp_path.iterdir())
+
+
+def test_attach_restores_checkpoint_first(tmp_path):
+    probe = MockProbe(None, {'some_variable': 'some_value'})
+    probe.CHECKPOINT_DIR = str(tmp_path)
+    probe.write_checkpoint()
+    mock_bpf = MagicMock(kprobe_fds={'p_tcp_v4_connect': 3}, tracepoint_fds={})
+    calls = []
+    mock_bpf.detach_kprobe_event.side_effect = lambda event: calls.append('detach')
+    mock_bpf._trace_autoload.side_effect = lambda: calls.append('attach')
+    mock_bpf.__getitem__.return_value.open_perf_buffer.side_effect = lambda *args: calls.append('open')
+    with patch.dict('sys.modules', bcc=MagicMock(BPF=MagicMock(return_value=mock_bpf))), \
+            patch.object(probe, 'restore_sections', side_effect=lambda sections: calls.append('restore')):
+        probe.attach()
+    assert calls == ['detach', 'restore', 'attach', 'open']
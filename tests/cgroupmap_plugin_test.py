@@ -0,0 +1,84 @@
+import json
+import os
+
+import pytest
+
+from pidtree_bcc.plugins.cgroupmap import CgroupMap
+from pidtree_bcc.plugins.cgroupmap import parse_cgroup_dirname
+
+
+CONTAINER_ID = 'a' * 64
+OTHER_CONTAINER_ID = 'b' * 64
+POD_UID = '12345678-1234-1234-1234-123456789abc'
+
+
+@pytest.fixture
+def cgroup_root(tmpdir):
+    root = tmpdir.mkdir('cgroup')
+    root.mkdir('system.slice').mkdir('docker-{}.scope'.format(CONTAINER_ID))
+    root.mkdir('kubepods').mkdir('burstable').mkdir('pod{}'.format(POD_UID)).mkdir(OTHER_CONTAINER_ID)
+    return root
+
+
+def test_parse_cgroup_dirname():
+    assert parse_cgroup_dirname('user.slice', None) is None
+    assert parse_cgroup_dirname('docker-{}.scope'.format(CONTAINER_ID), None) == {'container_id': CONTAINER_ID}
+    assert parse_cgroup_dirname(
+        'kubepods-burstable-pod{}.slice'.format(POD_UID.replace('-', '_')), None,
+    ) == {'pod_uid': POD_UID}
+    assert parse_cgroup_dirname(CONTAINER_ID, {'pod_uid': POD_UID}) == {
+        'pod_uid': POD_UID,
+        'container_id': CONTAINER_ID,
+    }
+    parent = {'container_id': CONTAINER_ID}
+    assert parse_cgroup_dirname('init.scope', parent) is parent
+
+
+def test_cgroupmap_process(cgroup_root):
+    plugin = CgroupMap({'cgroup_root': str(cgroup_root)})
+    plugin.refresh_thread = True  # avoid spawning the refresh thread
+    docker_cgroup = os.stat(str(cgroup_root.join('system.slice', 'docker-{}.scope'.format(CONTAINER_ID)))).st_ino
+    pod_cgroup = os.stat(
+        str(cgroup_root.join('kubepods', 'burstable', 'pod{}'.format(POD_UID), OTHER_CONTAINER_ID)),
+    ).st_ino
+    assert plugin.process({'cgroup_id': docker_cgroup}) == {
+        'cgroup_id': docker_cgroup,
+        'container': {'container_id': CONTAINER_ID},
+    }
+    assert plugin.process({'cgroup_id': pod_cgroup})['container'] == {
+        'pod_uid': POD_UID,
+        'container_id': OTHER_CONTAINER_ID,
+    }
+    host_cgroup = os.stat(str(cgroup_root.join('system.slice'))).st_ino
+    assert plugin.process({'cgroup_id': host_cgroup}) == {'cgroup_id': host_cgroup}
+    assert plugin.process({'pid': 1}) == {'pid': 1}
+
+
+def test_cgroupmap_refresh_index(cgroup_root):
+    plugin = CgroupMap({'cgroup_root': str(cgroup_root)})
+    new_dir = cgroup_root.join('system.slice').mkdir('docker-{}.scope'.format(OTHER_CONTAINER_ID))
+    new_cgroup = os.stat(str(new_dir)).st_ino
+    old_dir = cgroup_root.join('system.slice', 'docker-{}.scope'.format(CONTAINER_ID))
+    old_cgroup = os.stat(str(old_dir)).st_ino
+    old_dir.remove()
+    plugin.refresh_index()
+    assert plugin.index[new_cgroup] == {'container_id': OTHER_CONTAINER_ID}
+    assert old_cgroup not in plugin.index
+
+
+def test_cgroupmap_container_names(cgroup_root, tmpdir):
+    docker_root = tmpdir.mkdir('docker')
+    config_file = docker_root.mkdir('containers').mkdir(CONTAINER_ID).join('config.v2.json')
+    config_file.write(json.dumps({'Name': '/foo', 'Config': {'Labels': {'io.kubernetes.pod.name': 'bar'}}}))
+    plugin = CgroupMap({'cgroup_root': str(cgroup_root), 'docker_root': str(docker_root)})
+    docker_cgroup = os.stat(str(cgroup_root.join('system.slice', 'docker-{}.scope'.format(CONTAINER_ID)))).st_ino
+    assert plugin.index[docker_cgroup] == {
+        'container_id': CONTAINER_ID,
+        'container_name': 'foo',
+        'pod_name': 'bar',
+    }
+
+
+def test_cgroupmap_invalid_root():
+    with pytest.raises(RuntimeError):
+        CgroupMap({'cgroup_root': '/bananas_in_spaaaaaaaaaaace'})
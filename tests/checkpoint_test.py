@@ -0,0 +1,39 @@
+import os
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.checkpoint import FILE_HEADER
+from pidtree_bcc.checkpoint import pack_pointers
+from pidtree_bcc.checkpoint import read_checkpoint
+from pidtree_bcc.checkpoint import unpack_pointers
+from pidtree_bcc.checkpoint import write_checkpoint
+
+
+def test_checkpoint_roundtrip(tmp_path):
+    filename = str(tmp_path / 'probe.checkpoint')
+    write_checkpoint(filename, {'ancestry': b'[]', 'tracing': pack_pointers([1, 2 ** 64 - 1])})
+    assert not os.path.exists(filename + '.tmp')
+    sections = read_checkpoint(filename)
+    assert list(sections) == ['ancestry', 'tracing']
+    assert sections['ancestry'] == b'[]'
+    assert unpack_pointers(sections['tracing']) == [1, 2 ** 64 - 1]
+
+
+def test_checkpoint_validation(tmp_path):
+    filename = str(tmp_path / 'probe.checkpoint')
+    write_checkpoint(filename, {'sessions': b'[{}]'})
+    with patch('pidtree_bcc.checkpoint.get_boot_id', return_value=b'\0' * 16):
+        with pytest.raises(ValueError, match='reboot'):
+            read_checkpoint(filename)
+    with patch('pidtree_bcc.checkpoint.time.time', return_value=1e12):
+        with pytest.raises(ValueError, match='older'):
+            read_checkpoint(filename)
+    with open(filename, 'r+b') as f:
+        f.truncate(FILE_HEADER.size + 5)
+    with pytest.raises(ValueError, match='Truncated'):
+        read_checkpoint(filename)
+    with open(filename, 'wb') as f:
+        f.write(b'\0' * FILE_HEADER.size)
+    with pytest.raises(ValueError, match='Not a checkpoint'):
+        read_checkpoint(filename)
@@ -0,0 +1,82 @@
+import json
+import os
+import socket
+from multiprocessing import Pipe
+from threading import Thread
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.control import ControlServer
+from pidtree_bcc.control import ProbeControl
+from pidtree_bcc.control import serve_probe_control
+
+
+def test_control_server(tmpdir):
+    path = str(tmpdir.join('control.sock'))
+    tmpdir.join('control.sock').write('')
+    with pytest.raises(RuntimeError):
+        ControlServer(path, {})
+    os.unlink(path)
+    server = ControlServer(path, {
+        'echo': (lambda args: args, 'Echo arguments'),
+        'fail': (lambda args: 1 / 0, 'Fail'),
+    })
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        with client, client.makefile('rw') as f:
+            f.write('echo a b\nfail\nhelp\nfoo\n')
+            f.flush()
+            replies = [json.loads(f.readline()) for _ in range(4)]
+    finally:
+        server.close()
+    assert replies[0] == {'result': ['a', 'b']}
+    assert replies[1] == {'error': 'division by zero'}
+    assert list(replies[2]['result']) == ['echo', 'fail', 'help']
+    assert 'Unknown command foo' in replies[3]['error']
+    assert not os.path.exists(path)
+
+
+def mock_probe(commands, handler):
+    probe = MagicMock(CONTROL_COMMANDS=commands)
+
+    def enable_control():
+        connection, probe_connection = Pipe()
+        Thread(target=serve_probe_control, args=(probe_connection, handler), daemon=True).start()
+        return connection
+
+    probe.enable_control = enable_control
+    return probe
+
+
+def test_probe_control():
+    control = ProbeControl({
+        'probe_a': mock_probe(('stats', 'sessions'), lambda command, args: ['a', command] + args),
+        'probe_b': mock_probe(('stats',), lambda command, args: 1 / 0),
+    })
+    assert control.request('stats', []) == {
+        'probe_a': {'result': ['a', 'stats']},
+        'probe_b': {'error': 'division by zero'},
+    }
+    assert control.request('sessions', ['1']) == {'probe_a': {'result': ['a', 'sessions', '1']}}
+    assert control.request('stats', ['probe_a', '1']) == {'probe_a': {'result': ['a', 'stats', '1']}}
+    with pytest.raises(ValueError):
+        control.request('sessions', ['probe_b'])
+    with pytest.raises(ValueError):
+        control.request('listeners', [])
+
+
+@patch.object(ProbeControl, 'TIMEOUT', 0.1)
+def test_probe_control_timeout():
+    probe = MagicMock(CONTROL_COMMANDS=('stats',))
+    connection, probe_connection = Pipe()
+    probe.enable_control.return_value = connection
+    control = ProbeControl({'probe': probe})
+    assert 'did not reply' in control.request('stats', [])['probe']['error']
+    # late replies are discarded
+    request_id, _, _ = probe_connection.recv()
+    probe_connection.send((request_id, {'result': 'late'}))
+    Thread(target=serve_probe_control, args=(probe_connection, lambda command, args: 'ok'), daemon=True).start()
+    assert control.request('stats', []) == {'probe': {'result': 'ok'}}
@@ -0,0 +1,114 @@
+import json
+import queue
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.event_store import EventStore
+from pidtree_bcc.event_store import parse_duration
+from pidtree_bcc.event_store import query_events
+from pidtree_bcc.event_store import query_main
+
+
+def _make_line(pid, daddr, port, probe='tcp_connect'):
+    return json.dumps({'pid': pid, 'proctree': [], 'daddr': daddr, 'port': port, 'probe': probe})
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'events.db')
+
+
+def test_event_store_query(store_path):
+    store = EventStore(store_path)
+    store.add(_make_line(1, '1.1.1.1', 443))
+    store.add(_make_line(2, '8.8.8.8', 53))
+    store.add(json.dumps({
+        'pid': 3,
+        'destinations': [{'daddr': '8.8.8.8', 'port': 53}, {'daddr': '1.1.1.1', 'port': 53}],
+        'probe': 'udp_session',
+    }))
+    store.add('not json')
+    store.close()
+    assert [json.loads(e)['pid'] for e in query_events(store_path, daddr='8.8.8.8')] == [2, 3]
+    assert [json.loads(e)['pid'] for e in query_events(store_path, port=53)] == [2, 3]
+    assert [json.loads(e)['pid'] for e in query_events(store_path, daddr='1.1.1.1', port=443)] == [1]
+    assert [json.loads(e)['pid'] for e in query_events(store_path, pid=3)] == [3]
+    assert [json.loads(e)['pid'] for e in query_events(store_path, probe='udp_session')] == [3]
+    assert len(query_events(store_path)) == 4
+    assert len(query_events(store_path, limit=2)) == 2
+
+
+def test_event_store_batching(store_path):
+    store = EventStore(store_path)
+    store.add(_make_line(1, '1.1.1.1', 443))
+    store.flush()
+    assert store.write_queue.empty()
+    with patch.object(EventStore, 'BATCH_SIZE', 2):
+        store.add(_make_line(2, '1.1.1.1', 443))
+        store.flush()
+    assert store.pending == []
+    store.close()
+    assert len(query_events(store_path)) == 2
+
+
+@patch('pidtree_bcc.event_store.time')
+def test_event_store_time_retention(mock_time, store_path):
+    mock_time.monotonic.return_value = 0
+    mock_time.time.return_value = 1000
+    store = EventStore(store_path)
+    store.add(_make_line(1, '1.1.1.1', 443))
+    mock_time.time.return_value = 1050
+    store.add(_make_line(2, '1.1.1.1', 443))
+    store.close()
+    mock_time.time.return_value = 1100
+    store = EventStore(store_path, retention_seconds=60)
+    assert store.apply_retention() == 1
+    assert [json.loads(e)['pid'] for e in query_events(store_path, daddr='1.1.1.1')] == [2]
+    assert store.connection.execute('SELECT count(*) FROM destinations').fetchone() == (1,)
+    assert query_events(store_path, since=1060) == []
+    store.close()
+
+
+def test_event_store_size_retention(store_path):
+    store = EventStore(store_path)
+    for i in range(2000):
+        store.add(_make_line(i, '10.0.{}.{}'.format(i // 256, i % 256), 443))
+    store.close()
+    store = EventStore(store_path)
+    store.retention_bytes = store.used_bytes() // 2
+    with patch.object(EventStore, 'RETENTION_CHUNK', 100):
+        assert store.apply_retention() > 0
+    assert store.used_bytes() <= store.retention_bytes
+    remaining = query_events(store_path, limit=2000)
+    assert json.loads(remaining[-1])['pid'] == 1999
+    store.close()
+
+
+def test_parse_duration():
+    assert parse_duration('30') == 30
+    assert parse_duration('6h') == 6 * 3600
+    assert parse_duration('1.5m') == 90
+    with pytest.raises(ValueError):
+        parse_duration('6 hours')
+
+
+def test_query_main(store_path, capsys):
+    store = EventStore(store_path)
+    store.add(_make_line(1, '1.1.1.1', 443))
+    store.close()
+    query_main([store_path, '--since', '6h', '--daddr', '1.1.1.1'])
+    assert json.loads(capsys.readouterr().out)['pid'] == 1
+
+
+def test_event_store_drop_when_behind(store_path):
+    store = EventStore(store_path)
+    # replace the queue with a full one, as if the writer had fallen behind
+    write_queue, store.write_queue = store.write_queue, queue.Queue(1)
+    store.write_queue.put([])
+    store.add(_make_line(1, '1.1.1.1', 443))
+    store.flush(force=True)
+    assert store.dropped == 1
+    assert store.pending == []
+    store.write_queue = write_queue
+    store.close()
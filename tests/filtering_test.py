@@ -1,6 +1,7 @@
 import pytest
 
 from pidtree_bcc.filtering import NetFilter
+from pidtree_bcc.filtering import ProcessFilter
 from pidtree_bcc.utils import ip_to_int
 
 
@@ -44,3 +45,51 @@ def test_filter_ip_except_port(net_filtering):
 def test_filter_ip_include_port(net_filtering):
     assert net_filtering.is_filtered('192.168.0.1', 123)
     assert not net_filtering.is_filtered('192.168.0.1', 80)
+
+
+class FakeTable(dict):
+    Key = staticmethod(lambda value: value)
+    Leaf = staticmethod(lambda value: value)
+
+
+def test_process_filter_deny():
+    process_filter = ProcessFilter({'exclude': {'comm': ['consul'], 'uid': [65534]}})
+    assert process_filter.is_filtered('consul', 1000)
+    assert process_filter.is_filtered('curl', 65534)
+    assert not process_filter.is_filtered('curl', 1000)
+    assert process_filter.criteria == {'comm', 'uid'}
+
+
+def test_process_filter_allow():
+    process_filter = ProcessFilter({'include': {'cgroup_id': [1234]}, 'exclude': {'comm': ['consul']}})
+    assert not process_filter.is_filtered('curl', 0, cgroup_id=1234)
+    assert process_filter.is_filtered('curl', 0, cgroup_id=5678)
+    assert process_filter.is_filtered('consul', 0, cgroup_id=1234)
+    assert process_filter.criteria == {'comm', 'uid', 'cgroup_id'}
+
+
+def test_process_filter_comm_truncated():
+    process_filter = ProcessFilter({'exclude': {'comm': ['a-very-long-command-name']}})
+    assert process_filter.rules['comm'] == {b'a-very-long-com': ProcessFilter.DENY}
+    assert process_filter.is_filtered('a-very-long-command-name', 0)
+
+
+def test_process_filter_invalid():
+    with pytest.raises(ValueError):
+        ProcessFilter({'exclude': {'pid': [1]}})
+    with pytest.raises(ValueError):
+        ProcessFilter({'deny': {'uid': [1]}})
+    with pytest.raises(ValueError):
+        ProcessFilter({'exclude': {'uid': [1]}, 'include': {'uid': [1]}})
+
+
+def test_process_filter_apply():
+    bpf = {name: FakeTable() for name in list(ProcessFilter.MAP_NAMES.values()) + ['process_filter_allow']}
+    previous = ProcessFilter({'exclude': {'comm': ['consul'], 'uid': [65534]}})
+    previous.apply(bpf)
+    assert bpf['process_filter_comm'] == {b'consul': ProcessFilter.DENY}
+    assert bpf['process_filter_allow'] == {0: 0, 1: 0, 2: 0, 3: 0}
+    ProcessFilter({'exclude': {'comm': ['envoy']}, 'include': {'uid': [0]}}).apply(bpf, previous)
+    assert bpf['process_filter_comm'] == {b'envoy': ProcessFilter.DENY}
+    assert bpf['process_filter_uid'] == {0: ProcessFilter.ALLOW}
+    assert bpf['process_filter_allow'] == {0: 0, 1: 1, 2: 0, 3: 0}
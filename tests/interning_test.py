@@ -0,0 +1,54 @@
+from unittest.mock import patch
+
+from pidtree_bcc.interning import ProcessInterner
+from pidtree_bcc.interning import truncate_cmdlines
+
+
+def _make_event():
+    return {
+        'pid': 3,
+        'proctree': [
+            {'pid': 3, 'cmdline': 'curl 1.1.1.1', 'username': 'foo'},
+            {'pid': 2, 'cmdline': 'bash', 'username': 'foo'},
+            {'pid': 1, 'cmdline': 'init', 'username': 'root'},
+        ],
+    }
+
+
+def test_truncate_cmdlines():
+    proctree = [{'pid': 1, 'cmdline': 'a' * 10}, {'pid': 2, 'cmdline': 'b'}, {'pid': 3}]
+    truncate_cmdlines(proctree, 4)
+    assert proctree == [{'pid': 1, 'cmdline': 'aaaa'}, {'pid': 2, 'cmdline': 'b'}, {'pid': 3}]
+
+
+@patch('pidtree_bcc.interning.time')
+def test_process_interner(mock_time):
+    mock_time.monotonic.return_value = 0
+    interner = ProcessInterner(60)
+    event = _make_event()
+    records = interner.intern(event)
+    assert [record['pid'] for record in records] == [3, 2, 1]
+    assert all(record['type'] == 'process' for record in records)
+    assert event['proctree'] == [record['id'] for record in records]
+    assert event['proctree'][0].startswith('3-')
+    # same processes are not emitted again
+    second_event = _make_event()
+    assert interner.intern(second_event) == []
+    assert second_event['proctree'] == event['proctree']
+    # changed process information results in a new record
+    third_event = _make_event()
+    third_event['proctree'][0]['cmdline'] = 'wget 1.1.1.1'
+    records = interner.intern(third_event)
+    assert len(records) == 1
+    assert records[0]['cmdline'] == 'wget 1.1.1.1'
+    assert third_event['proctree'][0] != event['proctree'][0]
+    # records are re-emitted after the refresh interval
+    mock_time.monotonic.return_value = 61
+    assert len(interner.intern(_make_event())) == 3
+    assert interner.intern({'type': 'lost_event_telemetry'}) == []
+
+
+def test_process_interner_truncation():
+    interner = ProcessInterner(60, cmdline_max_length=4)
+    records = interner.intern(_make_event())
+    assert [record['cmdline'] for record in records] == ['curl', 'bash', 'init']
@@ -0,0 +1,46 @@
+from unittest.mock import patch
+
+from pidtree_bcc.latency import LatencyHistogram
+from pidtree_bcc.latency import LatencyTracer
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    for value in range(1, 1001):
+        histogram.record(value * 1000)
+    assert histogram.count == 1000
+    assert histogram.max == 1000000
+    for percentile, expected in ((50, 500000), (90, 900000), (99, 990000)):
+        # bounded relative error
+        assert abs(histogram.percentile(percentile) - expected) / expected < 1 / 32
+    summary = histogram.summary()
+    assert summary['count'] == 1000
+    assert summary['max_us'] == 1000
+    assert set(summary) == {'count', 'p50_us', 'p90_us', 'p99_us', 'p99_9_us', 'max_us'}
+
+
+def test_latency_histogram_small_values():
+    histogram = LatencyHistogram()
+    for value in (0, 1, 2, 3, -5):
+        histogram.record(value)
+    assert histogram.percentile(50) == 1
+    assert histogram.percentile(100) == 3
+
+
+@patch('pidtree_bcc.latency.time')
+def test_latency_tracer(mock_time):
+    mock_time.monotonic.return_value = 0
+    tracer = LatencyTracer(10, sample_rate=3)
+    assert [tracer.sample() for _ in range(6)] == [False, False, True, False, False, True]
+    tracer.record((('enrich', 1000), ('serialize', 2000)))
+    tracer.record((('enrich', 3000),))
+    assert not tracer.report_due()
+    mock_time.monotonic.return_value = 10
+    assert tracer.report_due()
+    report = tracer.report()
+    assert list(report) == ['enrich', 'serialize']
+    assert report['enrich']['count'] == 2
+    assert report['enrich']['max_us'] == 3
+    assert tracer.histograms == {}
+    assert not tracer.report_due()
+    assert not LatencyTracer(10).sample()
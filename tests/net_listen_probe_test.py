@@ -7,6 +7,7 @@ import pytest
 
 from pidtree_bcc.probes.net_listen import NetListenProbe
 from pidtree_bcc.probes.net_listen import NetListenWrapper
+from pidtree_bcc.sock_diag import DiagSocket
 
 
 @patch('pidtree_bcc.probes.net_listen.crawl_process_tree')
@@ -40,8 +41,11 @@ def test_net_listen_enrich_event(mock_crawl):
 
 @patch('pidtree_bcc.probes.net_listen.time')
 @patch('pidtree_bcc.probes.net_listen.psutil')
-def test_net_listen_snapshot_worker(mock_psutil, mock_time):
+@patch('pidtree_bcc.probes.net_listen.list_listening_sockets')
+def test_net_listen_snapshot_worker_psutil(mock_list_sockets, mock_psutil, mock_time):
+    mock_list_sockets.side_effect = OSError('not supported')
     mock_time.sleep.side_effect = [None, Exception('foobar')]  # to stop inf loop
+    mock_time.monotonic.return_value = 0
     mock_psutil.net_connections.return_value = [
         MagicMock(
             pid=111,
@@ -72,9 +76,118 @@ def test_net_listen_snapshot_worker(mock_psutil, mock_time):
             # the undecorated method is not bound to the object,
             # so we need to pass `probe` as `self`
             undecorated_method(probe, 123)
-        mock_process.assert_has_calls([
-            call(None, NetListenWrapper(111, 16777343, 1337, 6), None, False),
-            call(None, NetListenWrapper(113, 16777343, 7331, 17), None, False),
-        ])
+        mock_process.assert_has_calls(
+            [
+                call(None, NetListenWrapper(111, 16777343, 1337, 6), None, False),
+                call(None, NetListenWrapper(113, 16777343, 7331, 17), None, False),
+            ],
+            any_order=True,
+        )
     mock_psutil.net_connections.assert_called_once_with('inet4')
     mock_time.sleep.assert_has_calls([call(300), call(123)])
+    assert not probe.use_sock_diag
+
+
+@patch('pidtree_bcc.probes.net_listen.time')
+@patch('pidtree_bcc.probes.net_listen.list_listening_sockets')
+def test_net_listen_snapshot_worker_incremental(mock_list_sockets, mock_time):
+    mock_time.sleep.side_effect = [None, None, None, Exception('foobar')]  # to stop inf loop
+    mock_time.monotonic.side_effect = [0, 10, 20]
+    mock_list_sockets.side_effect = [
+        [DiagSocket(6, 16777343, 1337, 0, 1001), DiagSocket(6, 16777343, 80, 0, 1002)],
+        [DiagSocket(6, 16777343, 1337, 0, 1001), DiagSocket(17, 16777343, 7331, 0, 1003)],
+        [DiagSocket(6, 16777343, 1337, 0, 1001)],
+    ]
+    probe = NetListenProbe(
+        None,
+        {
+            'protocols': ['udp', 'tcp'],
+            'snapshot_periodicity': 20,
+            'incremental_snapshot_periodicity': 10,
+        },
+    )
+    probe.inode_resolver = MagicMock()
+    probe.inode_resolver.resolve.return_value = {1001: 111, 1002: 112, 1003: 113}
+    with patch.object(probe, '_process_events') as mock_process:
+        undecorated_method = probe._snapshot_worker.__wrapped__
+        with pytest.raises(Exception, match='foobar'):
+            undecorated_method(probe, 20, 10)
+        events = [c[0][1] for c in mock_process.call_args_list]
+    assert set(events[:2]) == {
+        NetListenWrapper(111, 16777343, 1337, 6),
+        NetListenWrapper(112, 16777343, 80, 6),
+    }
+    # incremental snapshot: one added, one removed
+    assert events[2:4] == [
+        NetListenWrapper(113, 16777343, 7331, 17),
+        NetListenWrapper(112, 16777343, 80, 6, NetListenProbe.CLOSE_EVENT),
+    ]
+    # full snapshot
+    assert events[4:] == [NetListenWrapper(111, 16777343, 1337, 6)]
+    mock_time.sleep.assert_has_calls([call(300), call(10), call(10), call(10)])
+
+
+@patch('pidtree_bcc.probes.net_listen.crawl_process_tree')
+def test_net_listen_enrich_close_event(mock_crawl):
+    probe = NetListenProbe(None)
+    mock_crawl.return_value = []
+    event = probe.enrich_event(NetListenWrapper(123, 0, 1337, 6, NetListenProbe.CLOSE_EVENT))
+    assert event['type'] == 'close'
+    assert event['port'] == 1337
+
+
+@patch('pidtree_bcc.probes.net_listen.crawl_process_tree')
+def test_net_listen_listener_tracking(mock_crawl):
+    probe = NetListenProbe(None, {'listener_tracking': True, 'protocols': ['tcp', 'udp']})
+    assert 'kprobe__inet_release' in probe.expanded_bpf_text
+    mock_crawl.return_value = [{'pid': 123, 'cmdline': 'nc -lp 1337', 'username': 'foo'}]
+    probe.listener_table[('snapshot', 999, 50, 0, 22, 6, 1)] = {
+        'pid': 50, 'port': 22, 'laddr': '0.0.0.0', 'protocol': 'tcp',
+    }
+    listen_event = NetListenProbe.EVENT_STRUCT(
+        pid=123, laddr=16777343, port=1337, protocol=6, type=1, sock_pointer=0xdead,
+    )
+    probe.enrich_event(listen_event)
+    assert len(probe.get_listeners()) == 2
+    close_event = NetListenProbe.EVENT_STRUCT(
+        pid=0, laddr=16777343, port=1337, protocol=6, type=2, sock_pointer=0xdead,
+    )
+    assert probe.enrich_event(close_event) == {
+        'pid': 123,
+        'port': 1337,
+        'proctree': [{'pid': 123, 'cmdline': 'nc -lp 1337', 'username': 'foo'}],
+        'laddr': '127.0.0.1',
+        'protocol': 'tcp',
+        'error': '',
+        'type': 'close',
+    }
+    mock_crawl.assert_called_once_with(123)
+    # close of a listener found by the startup snapshot
+    close_event = NetListenProbe.EVENT_STRUCT(
+        pid=0, laddr=0, port=22, protocol=6, type=2, sock_pointer=0xbeef,
+    )
+    assert probe.enrich_event(close_event)['pid'] == 50
+    mock_crawl.assert_called_with(50)
+    assert probe.get_listeners() == []
+
+
+@patch('pidtree_bcc.probes.net_listen.list_listening_sockets')
+def test_net_listen_reconcile_listener_table(mock_list_sockets):
+    mock_list_sockets.return_value = [DiagSocket(6, 0, 22, 0, 1001)]
+    probe = NetListenProbe(None, {'listener_tracking': True})
+    probe.inode_resolver = MagicMock()
+    probe.inode_resolver.resolve.return_value = {1001: 50}
+    probe._reconcile_listener_table()
+    assert probe.get_listeners() == [{'pid': 50, 'port': 22, 'laddr': '0.0.0.0', 'protocol': 'tcp'}]
+
+
+@patch('pidtree_bcc.probes.net_listen.list_listening_sockets')
+def test_net_listen_control(mock_list_sockets):
+    mock_list_sockets.return_value = [DiagSocket(6, 0, 22, 0, 1001)]
+    probe = NetListenProbe(None)
+    probe.inode_resolver = MagicMock()
+    probe.inode_resolver.resolve.return_value = {1001: 50}
+    assert probe.handle_control('listeners', []) == [{'pid': 50, 'port': 22, 'laddr': '0.0.0.0', 'protocol': 'tcp'}]
+    probe._process_events = MagicMock()
+    assert probe.handle_control('snapshot', []) == 1
+    probe._process_events.assert_called_once_with(None, NetListenWrapper(50, 0, 22, 6), None, False)
@@ -0,0 +1,89 @@
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.novelty import NoveltyFilter
+
+
+def _make_event(pid=3, daddr='1.1.1.1', port=443):
+    return {
+        'pid': pid,
+        'proctree': [
+            {'pid': pid, 'cmdline': 'curl {}'.format(daddr), 'username': 'foo'},
+            {'pid': 1, 'cmdline': 'init', 'username': 'root'},
+        ],
+        'daddr': daddr,
+        'port': port,
+    }
+
+
+@patch('pidtree_bcc.novelty.time')
+def test_novelty_filter_ttl(mock_time):
+    mock_time.monotonic.return_value = 0
+    novelty_filter = NoveltyFilter(60)
+    assert novelty_filter.check(_make_event())
+    # same lineage and destination, different pid
+    assert not novelty_filter.check(_make_event(pid=4))
+    assert not novelty_filter.check(_make_event(pid=5))
+    assert novelty_filter.check(_make_event(port=80))
+    mock_time.monotonic.return_value = 61
+    event = _make_event()
+    assert novelty_filter.check(event)
+    assert event['repeats'] == 2
+
+
+@patch('pidtree_bcc.novelty.time')
+def test_novelty_filter_eviction(mock_time):
+    mock_time.monotonic.return_value = 0
+    novelty_filter = NoveltyFilter(60, max_entries=2)
+    for port in (1, 2, 3):
+        assert novelty_filter.check(_make_event(port=port))
+    assert novelty_filter.evicted == 1
+    assert len(novelty_filter.expirations) == 2
+    # oldest pair was evicted and is reported again
+    assert novelty_filter.check(_make_event(port=1))
+    assert not novelty_filter.check(_make_event(port=3))
+
+
+@patch('pidtree_bcc.novelty.time')
+def test_novelty_filter_summary(mock_time):
+    mock_time.monotonic.return_value = 0
+    novelty_filter = NoveltyFilter(60, summary_interval=300)
+    novelty_filter.check(_make_event())
+    novelty_filter.check(_make_event())
+    mock_time.monotonic.return_value = 30
+    novelty_filter.check(_make_event(port=80))
+    mock_time.monotonic.return_value = 70
+    assert novelty_filter.summary() == {'suppressed': 1, 'evicted': 0, 'tracked': 1}
+    assert novelty_filter.summary() == {'suppressed': 0, 'evicted': 0, 'tracked': 1}
+
+
+def test_novelty_filter_invalid():
+    with pytest.raises(ValueError):
+        NoveltyFilter(0)
+
+
+@patch('pidtree_bcc.novelty.time')
+def test_novelty_filter_repeats_across_summary(mock_time):
+    mock_time.monotonic.return_value = 0
+    novelty_filter = NoveltyFilter(60, max_entries=2)
+    assert novelty_filter.check(_make_event())
+    assert not novelty_filter.check(_make_event())
+    assert not novelty_filter.check(_make_event())
+    mock_time.monotonic.return_value = 70
+    # the pair expired and is purged, but its suppressed repeats are kept
+    assert novelty_filter.summary()['tracked'] == 0
+    event = _make_event()
+    assert novelty_filter.check(event)
+    assert event['repeats'] == 2
+    assert novelty_filter.repeats == {}
+
+
+@patch('pidtree_bcc.novelty.time')
+def test_novelty_filter_repeats_bounded(mock_time):
+    mock_time.monotonic.return_value = 0
+    novelty_filter = NoveltyFilter(60, max_entries=2)
+    for port in range(3):
+        novelty_filter.check(_make_event(port=port))
+        novelty_filter.check(_make_event(port=port))
+    assert len(novelty_filter.repeats) == 2
@@ -0,0 +1,86 @@
+import queue
+
+import pytest
+
+from pidtree_bcc.output_queue import OutputQueue
+
+
+def drain(output_queue: OutputQueue) -> list:
+    items = []
+    while True:
+        try:
+            items.append(output_queue.get(timeout=0.1))
+        except queue.Empty:
+            return items
+
+
+def test_output_queue_invalid_policy():
+    with pytest.raises(ValueError):
+        OutputQueue(10, 'foobar')
+
+
+def test_output_queue_drop_newest():
+    output_queue = OutputQueue(2, 'drop_newest')
+    output_queue.register_producer('foo')
+    for i in range(4):
+        output_queue.put(str(i), 'foo')
+    assert drain(output_queue) == ['0', '1']
+    assert dict(output_queue.dropped_counts()) == {'foo': 2}
+
+
+def test_output_queue_drop_oldest():
+    output_queue = OutputQueue(2, 'drop_oldest')
+    output_queue.register_producer('foo')
+    for i in range(4):
+        output_queue.put(str(i), 'foo')
+    assert drain(output_queue) == ['2', '3']
+    assert dict(output_queue.dropped_counts()) == {'foo': 2}
+
+
+def test_output_queue_priority():
+    output_queue = OutputQueue(4, 'priority')
+    output_queue.register_producer('low', 0)
+    output_queue.register_producer('high', 1)
+    for i in range(3):
+        output_queue.put('low{}'.format(i), 'low')
+    for i in range(3):
+        output_queue.put('high{}'.format(i), 'high')
+    assert drain(output_queue) == ['low0', 'low1', 'high0', 'high1']
+    assert dict(output_queue.dropped_counts()) == {'low': 1, 'high': 1}
+
+
+def test_output_queue_unbounded():
+    output_queue = OutputQueue(0, 'drop_newest')
+    assert output_queue.policy == 'block'
+    for i in range(100):
+        output_queue.put(str(i))
+    assert len(drain(output_queue)) == 100
+
+
+def test_output_queue_drop_oldest_nothing_evicted(monkeypatch):
+    output_queue = OutputQueue(1, 'drop_oldest')
+    output_queue.register_producer('foo')
+    results = [queue.Full, None]
+
+    def put_nowait(item):
+        result = results.pop(0)
+        if result:
+            raise result
+
+    def get(block, timeout):
+        raise queue.Empty
+
+    monkeypatch.setattr(output_queue.queue, 'put_nowait', put_nowait)
+    monkeypatch.setattr(output_queue.queue, 'get', get)
+    output_queue.put('0', 'foo')
+    # the queue freed up on its own, so nothing was dropped
+    assert dict(output_queue.dropped_counts()) == {'foo': 0}
+
+
+def test_output_queue_drop_oldest_keeps_end_of_stream():
+    output_queue = OutputQueue(1, 'drop_oldest')
+    output_queue.register_producer('foo')
+    output_queue.put_end_of_stream()
+    output_queue.put('0', 'foo')
+    assert drain(output_queue) == [None]
+    assert dict(output_queue.dropped_counts()) == {'foo': 1}
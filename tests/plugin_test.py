@@ -21,6 +21,16 @@ def test_plugins_loads_multiple_plugins():
     assert len(plugins) == 2
 
 
+def test_plugins_shared_instances():
+    plugin_cache = {}
+    plugins_a = load_plugins({'identityplugin': {}}, 'tcp_connect', plugin_cache=plugin_cache)
+    plugins_b = load_plugins({'identityplugin': {}}, 'udp_session', plugin_cache=plugin_cache)
+    plugins_c = load_plugins({'identityplugin': {'some_arg': 1}}, 'udp_session', plugin_cache=plugin_cache)
+    assert plugins_a[0] is plugins_b[0]
+    assert plugins_a[0] is not plugins_c[0]
+    assert len(plugin_cache) == 2
+
+
 def test_plugins_loads_identity_plugin():
     plugins = load_plugins({'identityplugin': {}}, 'mock_probe')
     assert isinstance(plugins[0], Identityplugin)
@@ -0,0 +1,57 @@
+import os
+
+import psutil
+import pytest
+
+from pidtree_bcc.procfs import ProcessGoneError
+from pidtree_bcc.procfs import ProcfsError
+from pidtree_bcc.procfs import ProcfsReader
+
+
+@pytest.fixture
+def fake_procfs(tmpdir):
+    tmpdir.join('stat').write('cpu  1 2 3 4\nbtime 1600000000\n')
+    proc = tmpdir.mkdir('42')
+    # command name with spaces and parentheses, start time 1234 ticks after boot
+    proc.join('stat').write(
+        '42 (my (weird) comm) S 7 42 42 0 -1 4194560 100 0 0 0 1 2 0 0 20 0 1 0 1234 1000 100\n',
+    )
+    proc.join('status').write('Name:\tcomm\nUmask:\t0022\nState:\tS (sleeping)\nUid:\t0\t1000\t1000\t1000\n')
+    proc.join('cmdline').write_binary(b'python\0-c\0' + b'x' * 100 + b'\0')
+    return ProcfsReader(root=str(tmpdir), buffer_size=16)
+
+
+def test_procfs_reader(fake_procfs, tmpdir):
+    assert fake_procfs.read_stat(42) == (7, 1600000000 + 1234 / os.sysconf('SC_CLK_TCK'), 'my (weird) comm')
+    # larger than the read buffer
+    assert fake_procfs.read_cmdline(42) == 'python -c ' + 'x' * 100
+    assert fake_procfs.read_uid(42) == 0
+    assert fake_procfs.read_username(42) == 'root'
+    tmpdir.join('42', 'cwd').mksymlinkto('/tmp')
+    assert fake_procfs.read_link(42, 'cwd') == '/tmp'
+    # e.g. kernel threads
+    assert fake_procfs.read_link(42, 'exe') is None
+
+
+def test_procfs_reader_errors(fake_procfs, tmpdir):
+    with pytest.raises(ProcessGoneError):
+        fake_procfs.read_stat(43)
+    tmpdir.join('42', 'status').write('Name:\tcomm\n')
+    with pytest.raises(ProcfsError, match='Malformed status'):
+        fake_procfs.read_uid(42)
+    tmpdir.join('42', 'stat').write('42 (comm) S 7')
+    with pytest.raises(ProcfsError, match='Malformed stat'):
+        fake_procfs.read_stat(42)
+
+
+def test_procfs_reader_matches_psutil():
+    reader = ProcfsReader()
+    proc = psutil.Process(os.getpid())
+    ppid, start_time, comm = reader.read_stat(proc.pid)
+    assert comm == proc.name()
+    assert ppid == proc.ppid()
+    assert start_time == pytest.approx(proc.create_time(), abs=0.01)
+    assert reader.read_cmdline(proc.pid) == ' '.join(proc.cmdline())
+    assert reader.read_username(proc.pid) == proc.username()
+    assert reader.read_link(proc.pid, 'exe') == proc.exe()
+    assert reader.read_link(proc.pid, 'cwd') == proc.cwd()
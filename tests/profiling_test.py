@@ -0,0 +1,41 @@
+import os
+import threading
+import time
+
+from pidtree_bcc.profiling import SamplingProfiler
+
+
+def _busy_function(stop: threading.Event):
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+def test_sampling_profiler(tmp_path):
+    stop = threading.Event()
+    worker = threading.Thread(target=_busy_function, args=(stop,), name='busy-thread')
+    worker.start()
+    try:
+        profiler = SamplingProfiler(str(tmp_path), 0, name='test')
+        for _ in range(5):
+            profiler.sample()
+        filename = profiler.write()
+    finally:
+        stop.set()
+        worker.join()
+    assert os.path.basename(filename).startswith('test.{}.'.format(os.getpid()))
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    busy_stacks = [line for line in lines if line.startswith('busy-thread;')]
+    assert busy_stacks
+    stack, count = busy_stacks[0].rsplit(' ', 1)
+    assert '_busy_function (profiling_test.py:' in stack
+    assert int(count) <= 5
+
+
+def test_sampling_profiler_single_session(tmp_path):
+    assert SamplingProfiler.start_session(str(tmp_path), 0.5, name='session')
+    profiler = SamplingProfiler.ACTIVE
+    assert not SamplingProfiler.start_session(str(tmp_path), 0.5, name='session')
+    profiler.thread.join()
+    assert SamplingProfiler.ACTIVE is None
+    assert len(list(tmp_path.glob('session.*.collapsed'))) == 1
@@ -0,0 +1,66 @@
+from unittest.mock import call
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.probes.tcp_connect import TCPConnectProbe
+from pidtree_bcc.recording import EventRecorder
+from pidtree_bcc.recording import read_recording
+from pidtree_bcc.recording import replay_events
+from pidtree_bcc.utils import ip_to_int
+
+
+def test_record_and_read(tmpdir):
+    filename = str(tmpdir.join('recording'))
+    recorder = EventRecorder(filename)
+    recorder.write_header(['foo', 'bar'])
+    recorder.record('bar', b'123', 1000)
+    recorder.record('foo', b'45678', 2000)
+    recorder.flush()
+    assert list(read_recording(filename)) == [
+        (1000, 'bar', b'123'),
+        (2000, 'foo', b'45678'),
+    ]
+
+
+def test_read_invalid_recording(tmpdir):
+    filename = tmpdir.join('recording')
+    filename.write('some garbage which is not a recording')
+    with pytest.raises(ValueError):
+        list(read_recording(str(filename)))
+
+
+@patch('pidtree_bcc.recording.time')
+def test_replay_events(mock_time, tmpdir):
+    mock_time.monotonic.return_value = 0
+    filename = str(tmpdir.join('recording'))
+    event = TCPConnectProbe.EVENT_STRUCT(
+        pid=123,
+        daddr=ip_to_int('1.1.1.1'),
+        saddr=ip_to_int('127.0.0.1'),
+        dport=80,
+    )
+    recorder = EventRecorder(filename)
+    recorder.write_header(['tcp_connect', 'udp_session'])
+    recorder.record('tcp_connect', bytes(event), 1000000000)
+    recorder.record('udp_session', b'\0' * 32, 1500000000)
+    recorder.record('tcp_connect', bytes(event), 3000000000)
+    recorder.flush()
+    probe = MagicMock(EVENT_STRUCT=TCPConnectProbe.EVENT_STRUCT)
+    replay_events(filename, {'tcp_connect': probe}, speed=2)
+    assert probe._process_events.call_count == 2
+    replayed = probe._process_events.call_args[0][1]
+    assert (replayed.pid, replayed.daddr, replayed.dport) == (123, ip_to_int('1.1.1.1'), 80)
+    mock_time.sleep.assert_has_calls([call(1.0)])
+
+
+def test_record_kernel_timestamp():
+    probe = TCPConnectProbe(None)
+    probe.RECORDER = MagicMock()
+    event = TCPConnectProbe.EVENT_STRUCT(pid=123, ktime=42000)
+    data = bytes(event)
+    with patch.object(probe, '_process_events') as mock_process:
+        probe._record_and_process_events(0, data, len(data))
+    probe.RECORDER.record.assert_called_once_with('tcp_connect', data, 42000)
+    mock_process.assert_called_once_with(0, data, len(data))
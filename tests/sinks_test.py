@@ -0,0 +1,212 @@
+import gzip
+import io
+import json
+import os
+import queue
+import time
+import zlib
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.sinks import ColumnarSink
+from pidtree_bcc.sinks import CompressedStreamSink
+from pidtree_bcc.sinks import RotatingFileSink
+
+
+def test_rotating_file_sink_size_rotation(tmpdir):
+    filename = str(tmpdir.join('output'))
+    sink = RotatingFileSink(filename, max_bytes=10, compression='gzip')
+    for i in range(3):
+        print('line{:06d}'.format(i), file=sink)
+        sink.flush()
+    sink.close(timeout=5)
+    rotated = sorted(f for f in os.listdir(str(tmpdir)) if f.endswith('.gz'))
+    assert len(rotated) == 3
+    assert not os.path.exists(filename)
+    contents = []
+    for name in rotated:
+        with gzip.open(str(tmpdir.join(name)), 'rt') as f:
+            contents.extend(f.read().splitlines())
+        with open(str(tmpdir.join(name + '.idx'))) as f:
+            index = json.load(f)
+        assert index['lines'] == 1
+        assert index['frames'] == [[0, 0, 0]]
+    assert sorted(contents) == ['line000000', 'line000001', 'line000002']
+
+
+def test_rotating_file_sink_size_in_bytes(tmpdir):
+    filename = str(tmpdir.join('output'))
+    sink = RotatingFileSink(filename, max_bytes=1000)
+    print('caf\u00e9', file=sink)
+    assert sink.size == 6
+    sink.close(timeout=5)
+    rotated = [f for f in os.listdir(str(tmpdir)) if f.startswith('output.') and not f.endswith('.idx')]
+    with open(str(tmpdir.join(rotated[0])), encoding='utf-8') as f:
+        assert f.read() == 'caf\u00e9\n'
+
+
+@patch('pidtree_bcc.sinks.time')
+def test_rotating_file_sink_time_rotation(mock_time, tmpdir):
+    mock_time.monotonic.side_effect = [0, 5, 11, 11]
+    filename = str(tmpdir.join('output'))
+    sink = RotatingFileSink(filename, interval=10)
+    with patch.object(sink, 'compression_queue') as mock_queue:
+        sink.write('foo\n')
+        sink.flush()
+        mock_queue.put.assert_not_called()
+        sink.write('bar\n')
+        sink.flush()
+        mock_queue.put.assert_called_once()
+    rotated = mock_queue.put.call_args[0][0][0]
+    with open(rotated) as f:
+        assert f.read() == 'foo\nbar\n'
+    assert os.path.getsize(filename) == 0
+
+
+def test_rotating_file_sink_compress_frames(tmpdir):
+    filename = str(tmpdir.join('output.1'))
+    with open(filename, 'w') as f:
+        for i in range(10):
+            f.write('line{}\n'.format(i))
+    sink = RotatingFileSink(str(tmpdir.join('output')), compression='gzip')
+    sink.FRAME_SIZE = 11
+    sink.compress_file(filename)
+    with open(filename + '.gz.idx') as f:
+        index = json.load(f)
+    assert index['lines'] == 10
+    assert len(index['frames']) == 5
+    with open(filename + '.gz', 'rb') as f:
+        compressed = f.read()
+    # each frame can be decompressed independently
+    line, _, offset = index['frames'][2]
+    assert line == 4
+    frame = zlib.decompressobj(wbits=31).decompress(compressed[offset:])
+    assert frame == b'line4\nline5\n'
+
+
+def test_rotating_file_sink_invalid_compression(tmpdir):
+    with pytest.raises(ValueError):
+        RotatingFileSink(str(tmpdir.join('output')), compression='foobar')
+
+
+@patch('pidtree_bcc.sinks.time')
+def test_compressed_stream_sink_gzip(mock_time):
+    mock_time.monotonic.return_value = 0
+    stream = io.BytesIO()
+    stream.close = lambda: None
+    sink = CompressedStreamSink(stream, 'gzip')
+    print('line1', file=sink)
+    sink.flush()
+    # batch is not complete yet: not everything can be decompressed
+    decompressor = zlib.decompressobj(wbits=31)
+    assert decompressor.decompress(stream.getvalue()) == b''
+    mock_time.monotonic.return_value = CompressedStreamSink.FLUSH_INTERVAL
+    sink.flush()
+    decompressor = zlib.decompressobj(wbits=31)
+    assert decompressor.decompress(stream.getvalue()) == b'line1\n'
+    print('line2', file=sink)
+    sink.close()
+    assert gzip.decompress(stream.getvalue()) == b'line1\nline2\n'
+
+
+def test_compressed_stream_sink_batch_size():
+    stream = io.BytesIO()
+    sink = CompressedStreamSink(stream, 'gzip')
+    line = 'x' * 1023
+    for _ in range(CompressedStreamSink.BATCH_SIZE // 1024):
+        print(line, file=sink)
+    sink.flush()
+    decompressor = zlib.decompressobj(wbits=31)
+    assert len(decompressor.decompress(stream.getvalue())) == CompressedStreamSink.BATCH_SIZE
+    with pytest.raises(ValueError):
+        CompressedStreamSink(stream, 'lz4')
+
+
+def test_columnar_sink_event_row():
+    event = {
+        'pid': 2,
+        'proctree': [{'pid': 2, 'cmdline': 'curl', 'username': 'foo', 'loginuid': 1000}],
+        'daddr': '1.1.1.1',
+        'saddr': '127.0.0.1',
+        'port': 443,
+        'error': '',
+        'timestamp': '2020-09-13T12:26:40.123456Z',
+        'probe': 'tcp_connect',
+        'source_host': 'foo.bar',
+    }
+    assert ColumnarSink.table_name(event) == 'tcp_connect'
+    row = ColumnarSink.event_row('tcp_connect', event)
+    assert row['proctree'] == [{'pid': 2, 'cmdline': 'curl', 'username': 'foo', 'extra': '{"loginuid": 1000}'}]
+    assert row['port'] == 443
+    assert row['cgroup_id'] is None
+    assert row['extra'] == '{"source_host": "foo.bar"}'
+    assert set(row) == set(ColumnarSink.table_columns('tcp_connect'))
+    assert ColumnarSink.table_name({'type': 'lost_event_telemetry', 'probe': 'tcp_connect'}) == 'other'
+    assert ColumnarSink.table_name({'type': 'process', 'probe': 'tcp_connect'}) == 'process'
+    assert ColumnarSink.table_name({'probe': 'custom_probe'}) == 'other'
+
+
+def test_columnar_sink_missing_pyarrow(tmpdir):
+    with patch.dict('sys.modules', {'pyarrow': None}):
+        with pytest.raises(RuntimeError):
+            ColumnarSink(tmpdir.strpath)
+
+
+@pytest.mark.parametrize('file_format', ColumnarSink.FORMATS)
+def test_columnar_sink_write(file_format, tmpdir):
+    pa = pytest.importorskip('pyarrow')
+    sink = ColumnarSink(tmpdir.strpath, file_format, row_group_size=2, timestamp_format='epoch_ns')
+    for i in range(3):
+        sink.add(json.dumps({
+            'pid': i,
+            'proctree': [{'pid': i, 'cmdline': 'curl', 'username': 'foo'}],
+            'destinations': [{'daddr': '1.1.1.1', 'port': 53, 'duration': 0.5, 'msg_count': 1}],
+            'error': '',
+            'timestamp': 1600000000123456789,
+            'probe': 'udp_session',
+        }))
+    sink.add(json.dumps({'type': 'lost_event_telemetry', 'count': 0, 'timestamp': 1, 'probe': 'udp_session'}))
+    sink.close()
+    files = sorted(os.listdir(tmpdir.strpath))
+    assert [f.split('.')[0] for f in files] == ['other', 'udp_session']
+    path = os.path.join(tmpdir.strpath, files[1])
+    if file_format == 'parquet':
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        assert parquet_file.metadata.num_row_groups == 2
+        table = parquet_file.read()
+    else:
+        table = pa.ipc.open_file(path).read_all()
+    assert table.num_rows == 3
+    assert table.column('pid').to_pylist() == [0, 1, 2]
+    assert table.column('proctree').to_pylist()[0] == [{'pid': 0, 'cmdline': 'curl', 'username': 'foo', 'extra': None}]
+    assert table.column('destinations').to_pylist()[2][0]['port'] == 53
+
+
+def test_columnar_sink_drop_when_behind(tmpdir):
+    pytest.importorskip('pyarrow')
+    sink = ColumnarSink(tmpdir.strpath, row_group_size=1)
+    # replace the queue with a full one, as if the writer had fallen behind
+    batch_queue, sink.batch_queue = sink.batch_queue, queue.Queue(1)
+    sink.batch_queue.put(ColumnarSink.ROLLOVER)
+    sink.add(json.dumps({'pid': 1, 'timestamp': '2020-01-01T00:00:00Z', 'probe': 'tcp_connect'}))
+    assert sink.dropped == 1
+    sink.batch_queue = batch_queue
+    sink.close()
+
+
+def test_columnar_sink_close_timeout(tmpdir):
+    pytest.importorskip('pyarrow')
+    sink = ColumnarSink(tmpdir.strpath)
+    batch_queue, sink.batch_queue = sink.batch_queue, queue.Queue(1)
+    sink.batch_queue.put(ColumnarSink.ROLLOVER)
+    sink.add(json.dumps({'pid': 1, 'timestamp': '2020-01-01T00:00:00Z', 'probe': 'tcp_connect'}))
+    sink.add(json.dumps({'pid': 1, 'timestamp': '2020-01-01T00:00:00Z', 'probe': 'udp_session'}))
+    start = time.monotonic()
+    # the timeout bounds the whole close, not the wait for each partial batch
+    sink.close(timeout=0.3)
+    assert time.monotonic() - start < 0.5
+    assert sink.dropped == 2
+    sink.batch_queue = batch_queue
+    sink.close()
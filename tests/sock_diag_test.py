@@ -0,0 +1,63 @@
+import struct
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc import sock_diag
+from pidtree_bcc.sock_diag import DiagSocket
+from pidtree_bcc.sock_diag import SockDiagError
+from pidtree_bcc.sock_diag import SocketInodeResolver
+
+
+def make_diag_message(port: int, laddr: bytes, uid: int, inode: int) -> bytes:
+    payload = (
+        struct.pack('=BBBB', 2, 10, 0, 0)
+        + struct.pack('>HH', port, 0)
+        + laddr.ljust(16, b'\0')
+        + b'\0' * 16
+        + struct.pack('=III', 0, 0, 0)
+        + struct.pack('=IIIII', 0, 0, 0, uid, inode)
+    )
+    return sock_diag.NLMSG_HEADER.pack(16 + len(payload), sock_diag.SOCK_DIAG_BY_FAMILY, 2, 1, 0) + payload
+
+
+def test_parse_diag_messages():
+    data = (
+        make_diag_message(1337, b'\x7f\x00\x00\x01', 1000, 123)
+        + make_diag_message(80, b'\x00\x00\x00\x00', 0, 456)
+        + sock_diag.NLMSG_HEADER.pack(20, sock_diag.NLMSG_DONE, 2, 1, 0) + b'\0' * 4
+    )
+    assert list(sock_diag._parse_diag_messages(data, 6)) == [
+        DiagSocket(6, 16777343, 1337, 1000, 123),
+        DiagSocket(6, 0, 80, 0, 456),
+        None,
+    ]
+
+
+def test_parse_diag_messages_error():
+    data = sock_diag.NLMSG_HEADER.pack(20, sock_diag.NLMSG_ERROR, 0, 1, 0) + struct.pack('=i', -2)
+    with pytest.raises(SockDiagError):
+        list(sock_diag._parse_diag_messages(data, 6))
+
+
+@patch('pidtree_bcc.sock_diag.os')
+def test_socket_inode_resolver(mock_os):
+    links = {
+        '/proc/100/fd/3': 'socket:[123]',
+        '/proc/200/fd/4': 'socket:[456]',
+        '/proc/200/fd/5': '/dev/null',
+    }
+    mock_os.listdir.side_effect = lambda path: {
+        '/proc': ['self', '100', '200'],
+        '/proc/100/fd': ['3'],
+        '/proc/200/fd': ['4', '5'],
+    }[path]
+    mock_os.readlink.side_effect = lambda path: links[path]
+    mock_os.stat.return_value.st_uid = 0
+    resolver = SocketInodeResolver()
+    sockets = [DiagSocket(6, 0, 80, 0, 123), DiagSocket(6, 0, 81, 0, 456)]
+    assert resolver.resolve(sockets) == {123: 100, 456: 200}
+    # cached entries are validated without scanning /proc
+    mock_os.listdir.reset_mock()
+    assert resolver.resolve(sockets) == {123: 100, 456: 200}
+    mock_os.listdir.assert_not_called()
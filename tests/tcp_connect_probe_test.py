@@ -2,6 +2,7 @@ from unittest.mock import MagicMock
 from unittest.mock import patch
 
 from pidtree_bcc.probes.tcp_connect import TCPConnectProbe
+from pidtree_bcc.procfs import ProcessGoneError
 from pidtree_bcc.utils import ip_to_int
 
 
@@ -32,3 +33,37 @@ def test_tcp_connect_enrich_event(mock_crawl):
         'error': '',
     }
     mock_crawl.assert_called_once_with(123)
+
+
+@patch('pidtree_bcc.probes.tcp_connect.crawl_process_tree')
+def test_tcp_connect_enrich_event_cgroup_id(mock_crawl):
+    probe = TCPConnectProbe(None, {'capture_cgroup_id': True})
+    mock_event = MagicMock(
+        pid=123,
+        dport=80,
+        daddr=ip_to_int('1.1.1.1'),
+        saddr=ip_to_int('127.0.0.1'),
+        cgroup_id=4242,
+    )
+    mock_crawl.return_value = []
+    assert probe.enrich_event(mock_event)['cgroup_id'] == 4242
+    assert 'bpf_get_current_cgroup_id()' in probe.expanded_bpf_text
+
+
+@patch('pidtree_bcc.probes.tcp_connect.crawl_process_tree')
+def test_tcp_connect_enrich_event_process_gone(mock_crawl):
+    probe = TCPConnectProbe(None)
+    mock_event = MagicMock(pid=123, dport=80, daddr=ip_to_int('1.1.1.1'), saddr=ip_to_int('127.0.0.1'))
+    mock_crawl.side_effect = ProcessGoneError('Process 123 exited')
+    event = probe.enrich_event(mock_event)
+    assert event['proctree'] == []
+    assert event['error'] == 'Process 123 exited'
+
+
+@patch('pidtree_bcc.probes.tcp_connect.crawl_process_tree')
+def test_tcp_connect_enrich_event_proctree_options(mock_crawl):
+    probe = TCPConnectProbe(None, {'proctree': {'max_depth': 3, 'fields': ['cmdline']}})
+    mock_event = MagicMock(pid=123, dport=80, daddr=ip_to_int('1.1.1.1'), saddr=ip_to_int('127.0.0.1'))
+    mock_crawl.return_value = []
+    probe.enrich_event(mock_event)
+    mock_crawl.assert_called_once_with(123, max_depth=3, fields=('cmdline',))
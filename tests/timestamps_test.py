@@ -0,0 +1,36 @@
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.timestamps import KernelClock
+from pidtree_bcc.timestamps import TimestampFormatter
+
+
+def test_timestamp_formatter_iso():
+    formatter = TimestampFormatter()
+    assert formatter.format(1600000000123456789) == '2020-09-13T12:26:40.123456Z'
+    assert formatter.format(1600000000000001000) == '2020-09-13T12:26:40.000001Z'
+    assert formatter._cache[0] == 1600000000
+    assert formatter.format(1600000001500000000) == '2020-09-13T12:26:41.500000Z'
+
+
+def test_timestamp_formatter_epoch_ns():
+    formatter = TimestampFormatter('epoch_ns')
+    assert formatter.format(1600000000123456789) == 1600000000123456789
+    assert isinstance(formatter.format(), int)
+    with pytest.raises(ValueError):
+        TimestampFormatter('rfc2822')
+
+
+@patch('pidtree_bcc.timestamps.time')
+def test_kernel_clock(mock_time):
+    mock_time.monotonic.return_value = 100.0
+    mock_time.time.return_value = 1600000000.0
+    clock = KernelClock()
+    assert clock.to_wall_ns(99 * 10 ** 9) == 1599999999 * 10 ** 9
+    # offset is kept until the next calibration
+    mock_time.time.return_value = 1600000005.0
+    assert clock.to_wall_ns(100 * 10 ** 9) == 1600000000 * 10 ** 9
+    mock_time.monotonic.return_value = 100.0 + KernelClock.CALIBRATION_INTERVAL
+    mock_time.time.return_value = 1600000005.0 + KernelClock.CALIBRATION_INTERVAL
+    assert clock.to_wall_ns(100 * 10 ** 9) == 1600000005 * 10 ** 9
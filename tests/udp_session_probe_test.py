@@ -72,3 +72,69 @@ def test_udp_session_expiration_worker(mock_time):
         mock_process.assert_called_once_with(
             None, SessionEventWrapper(3, 2), None, False,
         )
+
+
+@patch('pidtree_bcc.probes.udp_session.crawl_process_tree')
+@patch('pidtree_bcc.probes.udp_session.time')
+def test_udp_session_control_sessions(mock_time, mock_crawl):
+    probe = UDPSessionProbe(None)
+    mock_time.monotonic.side_effect = [0, 1, 5]
+    mock_crawl.return_value = [{'pid': 123, 'cmdline': 'some_program', 'username': 'foo'}]
+    probe.enrich_event(MagicMock(type=1, pid=123, sock_pointer=1, daddr=168430090, dport=1337))
+    probe.enrich_event(MagicMock(type=2, pid=123, sock_pointer=1, daddr=168430090, dport=1337))
+    assert probe.handle_control('sessions', []) == [{
+        'pid': 123,
+        'proctree': [{'pid': 123, 'cmdline': 'some_program', 'username': 'foo'}],
+        'destinations': [{'daddr': '10.10.10.10', 'port': 1337, 'duration': 5, 'msg_count': 2}],
+        'error': '',
+        'idle': 4,
+    }]
+    assert 'lost_events' in probe.handle_control('stats', [])
+
+
+@patch('pidtree_bcc.probes.udp_session.process_matches')
+@patch('pidtree_bcc.probes.udp_session.PROCFS')
+@patch('pidtree_bcc.probes.udp_session.crawl_process_tree')
+@patch('pidtree_bcc.probes.udp_session.time')
+def test_udp_session_checkpoint(mock_time, mock_crawl, mock_procfs, mock_matches):
+    probe = UDPSessionProbe(None)
+    probe.bpf = MagicMock()
+    probe.bpf['tracing'].keys.return_value = [MagicMock(value=1), MagicMock(value=2)]
+    mock_time.monotonic.side_effect = [0, 0, 1, 5]
+    mock_crawl.return_value = [{'pid': 123, 'cmdline': 'some_program', 'username': 'foo'}]
+    mock_procfs.read_stat.return_value = (1, 100.0, 'some_program')
+    probe.enrich_event(MagicMock(type=1, pid=123, sock_pointer=1, daddr=168430090, dport=1337))
+    probe.enrich_event(MagicMock(type=1, pid=456, sock_pointer=2, daddr=168430090, dport=53))
+    probe.enrich_event(MagicMock(type=2, pid=123, sock_pointer=1, daddr=168430090, dport=1337))
+    sections = probe.checkpoint_sections()
+    # process 456 was replaced by another one in the meantime
+    mock_matches.side_effect = lambda pid, start_time: pid == 123 and start_time == 100.0
+    mock_time.monotonic.side_effect = [100]
+    probe = UDPSessionProbe(None)
+    probe.bpf = MagicMock()
+    probe.restore_sections(sections)
+    assert probe.session_tracking == {
+        1: {
+            'pid': 123,
+            'proctree': [{'pid': 123, 'cmdline': 'some_program', 'username': 'foo'}],
+            'destinations': {(168430090, 1337): [95, 2]},
+            'error': '',
+            'last_update': 96,
+        },
+    }
+    table = probe.bpf['tracing']
+    table.__setitem__.assert_called_once_with(table.Key(1), table.Leaf(UDPSessionProbe.SESSION_START))
+
+
+def test_udp_session_flush_pending():
+    probe = UDPSessionProbe(None)
+    probe.session_tracking = {
+        1: {'error': ''},
+        2: {'error': 'crawl failed'},
+    }
+    with patch.object(probe, '_process_events') as mock_process:
+        probe.flush_pending()
+    assert mock_process.call_count == 2
+    mock_process.assert_any_call(None, SessionEventWrapper(3, 1), None, False)
+    assert probe.session_tracking[1]['error'] == 'session_in_progress_at_shutdown'
+    assert probe.session_tracking[2]['error'] == 'crawl failed'
@@ -1,9 +1,13 @@
 import os
+import re
 import sys
 from unittest.mock import call
 from unittest.mock import patch
 
+import pytest
+
 from pidtree_bcc import utils
+from pidtree_bcc.procfs import ProcessGoneError
 
 
 def test_crawl_process_tree():
@@ -14,6 +18,120 @@ def test_crawl_process_tree():
     assert tree[-1]['pid'] == 1  # should be init
 
 
+@patch('pidtree_bcc.utils.PROCFS')
+def test_crawl_process_tree_cache(mock_procfs):
+    processes = {
+        3: {'cmdline': 'curl', 'username': 'user', 'ppid': 2, 'start_time': 123.0},
+        2: {'cmdline': 'bash', 'username': 'user', 'ppid': 1, 'start_time': 123.0},
+        1: {'cmdline': 'init', 'username': 'root', 'ppid': 0, 'start_time': 123.0},
+    }
+    mock_procfs.read_stat.side_effect = lambda pid: (processes[pid]['ppid'], processes[pid]['start_time'], 'comm')
+    mock_procfs.read_cmdline.side_effect = lambda pid: processes[pid]['cmdline']
+    mock_procfs.read_username.side_effect = lambda pid: processes[pid]['username']
+    cache = utils.ProcessInfoCache()
+    expected = [
+        {'pid': 3, 'cmdline': 'curl', 'username': 'user'},
+        {'pid': 2, 'cmdline': 'bash', 'username': 'user'},
+        {'pid': 1, 'cmdline': 'init', 'username': 'root'},
+    ]
+    assert utils.crawl_process_tree(3, cache) == expected
+    assert (cache.hits, cache.misses) == (0, 2)
+    processes[2]['cmdline'] = 'changed'
+    processes[3]['cmdline'] = 'wget'
+    # leaf is always inspected, ancestors come from cache
+    expected[0]['cmdline'] = 'wget'
+    assert utils.crawl_process_tree(3, cache) == expected
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert mock_procfs.read_cmdline.call_count == 4
+    # recycled PID does not match cached entry
+    processes[2]['start_time'] = 456.0
+    expected[1]['cmdline'] = 'changed'
+    assert utils.crawl_process_tree(3, cache) == expected
+    # without a cache every ancestor is inspected
+    mock_procfs.read_cmdline.reset_mock()
+    assert utils.get_ancestry_cache() is None
+    assert utils.crawl_process_tree(3) == expected
+    assert mock_procfs.read_cmdline.call_count == 3
+
+
+@patch('pidtree_bcc.utils.PROCFS')
+def test_crawl_process_tree_options(mock_procfs):
+    # 5 (curl) -> 4 (bash) -> 3 (containerd-shim) -> 2 (containerd) -> 1 (init)
+    comms = {5: 'curl', 4: 'bash', 3: 'containerd-shim', 2: 'containerd', 1: 'init'}
+    mock_procfs.read_stat.side_effect = lambda pid: (pid - 1, 100.123, comms[pid])
+    mock_procfs.read_cmdline.side_effect = lambda pid: comms[pid]
+    mock_procfs.read_uid.side_effect = lambda pid: 1000 + pid
+    mock_procfs.read_link.side_effect = lambda pid, name: '{}:{}'.format(name, 'host' if pid < 4 else 'container')
+    cache = utils.ProcessInfoCache()
+
+    def pids(**kwargs):
+        return [proc['pid'] for proc in utils.crawl_process_tree(5, cache, **kwargs)]
+
+    assert pids() == [5, 4, 3, 2, 1]
+    assert pids(max_depth=2) == [5, 4]
+    assert pids(stop_pids={3, 2}) == [5, 4, 3]
+    assert pids(stop_comm=re.compile('^containerd')) == [5, 4, 3]
+    assert pids(stop_namespace='pid') == [5, 4]
+    mock_procfs.read_cmdline.reset_mock()
+    tree = utils.crawl_process_tree(5, cache, max_depth=2, fields=('uid', 'exe', 'start_time'))
+    assert tree == [
+        {'pid': 5, 'uid': 1005, 'exe': 'exe:container', 'start_time': 100.12},
+        {'pid': 4, 'uid': 1004, 'exe': 'exe:container', 'start_time': 100.12},
+    ]
+    mock_procfs.read_cmdline.assert_not_called()
+    # cached entries are extended with the new fields
+    cached_info, _ = cache.get((4, 100.123))
+    assert cached_info['cmdline'] == 'bash'
+    assert cached_info['uid'] == 1004
+
+
+def test_parse_proctree_config():
+    assert utils.parse_proctree_config({}) == {}
+    options = utils.parse_proctree_config({
+        'max_depth': 10,
+        'stop_pids': [1],
+        'stop_comm': '^containerd-shim',
+        'stop_namespace': 'pid',
+        'fields': ['cmdline', 'exe'],
+    })
+    assert options['max_depth'] == 10
+    assert options['stop_pids'] == {1}
+    assert options['stop_comm'].search('containerd-shim-runc-v2')
+    assert options['stop_namespace'] == 'pid'
+    assert options['fields'] == ('cmdline', 'exe')
+    with pytest.raises(ValueError):
+        utils.parse_proctree_config({'fields': ['environ']})
+    with pytest.raises(ValueError):
+        utils.parse_proctree_config({'stop_namespace': 'foo'})
+    with pytest.raises(ValueError):
+        utils.parse_proctree_config({'depth': 3})
+
+
+@patch('pidtree_bcc.utils.PROCFS')
+def test_crawl_process_tree_process_gone(mock_procfs):
+    mock_procfs.read_stat.side_effect = ProcessGoneError('Process 3 exited')
+    with pytest.raises(ProcessGoneError):
+        utils.crawl_process_tree(3, utils.ProcessInfoCache())
+
+
+@patch('pidtree_bcc.utils.time')
+def test_process_info_cache_eviction(mock_time):
+    mock_time.monotonic.return_value = 0
+    cache = utils.ProcessInfoCache(max_size=2, ttl=10)
+    cache.put((1, 0), {'pid': 1}, 0)
+    cache.put((2, 0), {'pid': 2}, 1)
+    assert cache.get((1, 0)) == ({'pid': 1}, 0)
+    cache.put((3, 0), {'pid': 3}, 1)
+    assert cache.get((2, 0)) is None
+    assert cache.get((3, 0)) == ({'pid': 3}, 1)
+    mock_time.monotonic.return_value = 11
+    assert cache.get((1, 0)) is None
+    cache.put((4, 0), {'pid': 4}, 1, stored_at=5)
+    assert cache.get((4, 0)) == ({'pid': 4}, 1)
+    mock_time.monotonic.return_value = 16
+    assert cache.get((4, 0)) is None
+
+
 def test_smart_open():
     this_file = os.path.abspath(__file__)
     assert utils.smart_open() == sys.stdout
@@ -42,3 +160,11 @@ def test_get_network_namespace(mock_os):
     ])
     mock_os.readlink.side_effect = Exception
     assert utils.get_network_namespace() is None
+
+
+def test_event_destinations():
+    assert utils.event_destinations({'daddr': '1.1.1.1', 'port': 80}) == [('1.1.1.1', 80)]
+    assert utils.event_destinations({'laddr': '0.0.0.0', 'port': 22}) == [('0.0.0.0', 22)]
+    assert utils.event_destinations({
+        'destinations': [{'daddr': '1.1.1.1', 'port': 53}, {'daddr': '8.8.8.8', 'port': 53}],
+    }) == [('1.1.1.1', 53), ('8.8.8.8', 53)]